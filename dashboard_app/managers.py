@@ -24,7 +24,10 @@ import logging
 
 class BundleManager(models.Manager):
 
-    def create_with_content(self, bundle_stream, uploaded_by, content_filename, content):
+    def create_with_content(self, bundle_stream, uploaded_by, content_filename, content, compress=False):
+        """
+        Create a bundle and save its content, gzipped if compress is set.
+        """
         logger = logging.getLogger(__name__)
         logger.debug("Creating bundle object")
         bundle = self.create(
@@ -37,8 +40,12 @@ class BundleManager(models.Manager):
         bundle.save()
         try:
             logger.debug("saving bundle content (file) and bundle object")
-            bundle.content.save("bundle-{0}".format(bundle.pk),
-                                ContentFile(content))
+            if compress:
+                bundle._gz_content.save("bundle-{0}".format(bundle.pk),  # pylint: disable=protected-access
+                                        ContentFile(content))
+            else:
+                bundle.content.save("bundle-{0}".format(bundle.pk),
+                                    ContentFile(content))
         except IntegrityError as exc:
             logger.debug("integrity error: %r", exc)
             # https://docs.djangoproject.com/en/dev/topics/db/transactions/#handling-exceptions-within-postgresql-transactions
@@ -22,6 +22,7 @@ Unit tests for Dashboard API (XML-RPC interface)
 import xmlrpclib
 
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 from django_testscenarios.ubertest import TransactionTestCase
 
 from dashboard_app.models import Bundle, BundleStream
@@ -285,6 +286,36 @@ class DashboardAPIPutTests(DashboardXMLRPCViewsTestCase):
         self.assertEqual(self.bundle.bundle_stream.pathname, self.pathname)
 
 
+class DashboardAPIPutAsyncTests(DashboardXMLRPCViewsTestCase):
+
+    def setUp(self):
+        super(DashboardAPIPutAsyncTests, self).setUp()
+        self.bundle_stream = fixtures.create_bundle_stream('/anonymous/')
+        self.bundle = None
+
+    def tearDown(self):
+        if self.bundle:
+            self.bundle.delete_files()
+        super(DashboardAPIPutAsyncTests, self).tearDown()
+
+    @override_settings(BUNDLE_IMPORT_ASYNC=True)
+    def test_put_async(self):
+        content = '"unterminated string'
+        content_sha1 = self.xml_rpc_call("put", content, 'bad.json', '/anonymous/')
+        self.bundle = Bundle.objects.get(content_sha1=content_sha1)
+        # stored compressed, not imported yet
+        self.assertTrue(self.bundle._gz_content)  # pylint: disable=protected-access
+        self.assertEqual(self.bundle.content.read(), content)
+        self.assertFalse(self.bundle.is_deserialized)
+        self.assertEqual(self.xml_rpc_call("import_status", content_sha1),
+                         {'status': 'pending', 'error': ''})
+        # as done by the bundle-import command
+        self.bundle.deserialize()
+        status = self.xml_rpc_call("import_status", content_sha1)
+        self.assertEqual(status['status'], 'failed')
+        self.assertNotEqual(status['error'], '')
+
+
 class DashboardAPIPutFailureTests(DashboardXMLRPCViewsTestCase):
 
     scenarios = [
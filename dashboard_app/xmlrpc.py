@@ -29,6 +29,7 @@ import hashlib
 import json
 import os
 import subprocess
+from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core.urlresolvers import reverse
 from django.db import IntegrityError
@@ -41,6 +42,7 @@ from linaro_django_xmlrpc.models import (
 from dashboard_app.filters import evaluate_filter
 from dashboard_app.models import (
     Bundle,
+    BundleDeserializationError,
     BundleStream,
     Test,
     TestRunFilter,
@@ -125,7 +127,9 @@ class DashboardAPI(ExposedAPI):
                 errors.FORBIDDEN, "You cannot upload to this stream")
         try:
             self.logger.debug("Creating bundle object")
-            bundle = Bundle.objects.create_with_content(bundle_stream, self.user, content_filename, content)
+            bundle = Bundle.objects.create_with_content(
+                bundle_stream, self.user, content_filename, content,
+                compress=settings.BUNDLE_IMPORT_ASYNC)
         except (IntegrityError, ValueError) as exc:
             self.logger.debug("Raising xmlrpclib.Fault(errors.CONFLICT)")
             raise xmlrpclib.Fault(errors.CONFLICT, str(exc))
@@ -133,6 +137,9 @@ class DashboardAPI(ExposedAPI):
             self.logger.exception("big oops")
             raise
         else:
+            if settings.BUNDLE_IMPORT_ASYNC:
+                # imported by the bundle-import command
+                return bundle
             self.logger.debug("Deserializing bundle")
             bundle.deserialize()
             return bundle
@@ -742,6 +749,58 @@ class DashboardAPI(ExposedAPI):
                 bundle.deserialization_error.error_message)
         return True
 
+    def import_status(self, content_sha1):
+        """
+        Name
+        ----
+        `import_status` (`content_sha1`)
+
+        Deprecated
+        ----------
+        This function will cease to operate when V1 is disabled.
+
+        Description
+        -----------
+        Get the import status of a bundle. When the server imports the
+        bundles asynchronously, `put` returns before the bundle is imported.
+
+        Arguments
+        ---------
+        `content_sha1`: string
+            SHA1 hash of the content of the bundle. This *MUST* designate
+            a bundle or ``Fault(404, "...")`` is raised.
+
+        Return value
+        ------------
+        This function returns an XML-RPC struct with the following fields:
+
+        `status`: string
+            ['pending'|'imported'|'failed']
+        `error`: string
+            The import error of a failed bundle, empty otherwise
+
+        Exceptions raised
+        -----------------
+        - 404 Bundle not found
+        - 403 Permission denied
+        """
+        try:
+            bundle = Bundle.objects.select_related(
+                'bundle_stream', 'deserialization_error').get(content_sha1=content_sha1)
+        except Bundle.DoesNotExist:
+            raise xmlrpclib.Fault(errors.NOT_FOUND, "Bundle not found")
+        if not bundle.bundle_stream.is_accessible_by(self.user):
+            raise xmlrpclib.Fault(
+                403, "Permission denied.  User does not have permissions "
+                "to access this bundle.")
+        if bundle.is_deserialized:
+            return {'status': 'imported', 'error': ''}
+        try:
+            return {'status': 'failed',
+                    'error': bundle.deserialization_error.error_message}
+        except BundleDeserializationError.DoesNotExist:
+            return {'status': 'pending', 'error': ''}
+
     def make_stream(self, pathname, name):
         """
         Name
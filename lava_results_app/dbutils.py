@@ -19,32 +19,35 @@
 # pylint: disable=no-member,too-many-locals,too-many-nested-blocks,
 # pylint: disable=too-many-return-statements,ungrouped-imports
 import os
+import csv
+import re
+import time
 import yaml
 import urllib
 import logging
-import django
 import decimal
-from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction, DatabaseError, DataError, IntegrityError
+from django.db.models import F
 from collections import OrderedDict  # pylint: disable=unused-import
+from multiprocessing.pool import ThreadPool
 from lava_results_app.models import (
+    PASSFAIL_RESULTS,
+    Query,
+    QueryUpdatedError,
     TestSuite,
     TestSet,
     TestCase,
     TestData,
     ActionData,
     MetaType,
+    NamedTestAttribute,
+    passfail_annotations,
 )
-from lava_results_app.utils import debian_package_version
+from lava_results_app.utils import debian_package_version, StreamEcho
 from django.core.exceptions import MultipleObjectsReturned
 from lava_dispatcher.pipeline.action import Timeout
 
-if django.VERSION > (1, 10):
-    from django.urls.exceptions import NoReverseMatch
-    from django.urls import reverse
-else:
-    from django.core.urlresolvers import reverse
-    from django.core.urlresolvers import NoReverseMatch
-
 
 def _check_for_testset(result_dict, suite):
     """
@@ -107,111 +110,246 @@ def create_metadata_store(results, job, level):
     return meta_filename
 
 
-def map_scanned_results(results, job, meta_filename):  # pylint: disable=too-many-branches,too-many-statements,too-many-return-statements
+# Patterns of the lava.results.testcase URL (see lava_results_app/urls.py)
+# used to validate the suite and test case names without calling reverse().
+SUITE_NAME_PATTERN = re.compile(r'^[-_a-zA-Z0-9.]+$')
+CASE_NAME_PATTERN = re.compile(r'^[-_a-zA-Z0-9.\(\)+]+$')
+
+# Number of pending test cases triggering a flush of a ResultsBuffer
+RESULTS_BATCH_SIZE = 500
+# Maximum time (in seconds) a test case is kept in a ResultsBuffer
+RESULTS_FLUSH_INTERVAL = 5
+
+
+def add_suite_counters(cases):
     """
-    Sanity checker on the logged results dictionary
-    :param results: results logged via the slave
-    :param job: the current test job
-    :param meta_filename: YAML store for results metadata
-    :return: False on error, else True
+    Add new test cases to the result counters of their suites, with one
+    update per suite.
     """
-    logger = logging.getLogger('dispatcher-master')
+    counts = {}
+    for case in cases:
+        field = 'count_%s' % TestCase.RESULT_REVERSE[case.result]
+        suite_counts = counts.setdefault(case.suite_id, {})
+        suite_counts[field] = suite_counts.get(field, 0) + 1
+    for (suite_id, suite_counts) in counts.items():
+        TestSuite.objects.filter(id=suite_id).update(
+            **dict((field, F(field) + count) for (field, count) in suite_counts.items()))
 
-    if not isinstance(results, dict):
-        append_failure_comment(job, "[%d] %s is not a dictionary" % (job.id, results))
-        return False
 
-    if not {"definition", "case", "result"}.issubset(set(results.keys())):
-        append_failure_comment(job, "Missing some keys (\"definition\", \"case\" or \"result\") in %s" % results)
-        return False
+def update_suite_counters(job_id):
+    """
+    Reconcile the result counters of the suites of a job with the test
+    cases, in one aggregate query. Only the suites with wrong counters are
+    updated.
+    """
+    counts = dict((suite['id'], suite) for suite in TestSuite.objects.filter(
+        job_id=job_id).values('id').annotate(**passfail_annotations('testcase__')))
+    for suite in TestSuite.objects.filter(job_id=job_id):
+        counters = dict(('count_%s' % name, counts[suite.id][name])
+                        for name in PASSFAIL_RESULTS)
+        if any(getattr(suite, field) != value for (field, value) in counters.items()):
+            TestSuite.objects.filter(id=suite.id).update(**counters)
 
-    if 'extra' in results:
-        results['extra'] = meta_filename
 
-    metadata_check = yaml.dump(results)
-    if len(metadata_check) > 4096:  # bug 2471 - test_length unit test
-        msg = "[%d] Result metadata is too long. %s" % (job.id, metadata_check)
-        logger.error(msg)
-        append_failure_comment(job, msg)
-        return False
+class ResultsBuffer(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Result ingestion buffer for a single job.
 
-    suite, created = TestSuite.objects.get_or_create(name=results["definition"], job=job)
-    if created:
-        suite.save()
-    testset = _check_for_testset(results, suite)
+    The suites and test sets of the job are cached for the life of the
+    buffer and the test cases are written with bulk_create when flushing.
+    The owner of the buffer is responsible for calling flush() when
+    needs_flush() returns True and when the job ends.
+    """
 
-    name = results["case"].strip()
-    try:
-        reverse('lava.results.testcase', args=[job.id, suite.name, name])
-    except NoReverseMatch:
-        append_failure_comment(
-            job,
-            "[%d] Unable to parse test case name as URL %s in suite %s" % (job.id, name, suite.name))
-        return False
-    if suite.name == "lava":
-        match_action = None
-        if "level" in results:
-            match_action = ActionData.objects.filter(
-                action_level=str(results['level']),
-                testdata__testjob=suite.job)
-            if match_action:
-                match_action = match_action[0]
-                if 'duration' in results:
-                    match_action.duration = results['duration']
-                if 'timeout' in results:
-                    match_action.timeout = results['timeout']  # duration, positive integer
+    def __init__(self, job):
+        self.job = job
+        self.suites = {}
+        self.testsets = {}
+        self.pending = []
+        self.first_pending = None
+        self.last_usage = time.time()
+        self.logger = logging.getLogger('dispatcher-master')
+
+    def _suite(self, name):
+        if name not in self.suites:
+            suite, created = TestSuite.objects.get_or_create(name=name, job=self.job)
+            if created:
+                suite.save()
+            self.suites[name] = suite
+        return self.suites[name]
+
+    def _testset(self, results, suite):
+        if 'set' not in results:
+            return None
+        key = (suite.name, results['set'])
+        if key not in self.testsets:
+            testset = _check_for_testset(results, suite)
+            if testset is None:
+                # invalid name, already reported.
+                return None
+            self.testsets[key] = testset
+        return self.testsets[key]
+
+    def _queue(self, case):
+        if not self.pending:
+            self.first_pending = time.time()
+        self.pending.append(case)
+
+    def needs_flush(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= RESULTS_BATCH_SIZE or \
+            time.time() - self.first_pending > RESULTS_FLUSH_INTERVAL
+
+    def flush(self):
+        if not self.pending:
+            return
         try:
-            result_val = TestCase.RESULT_MAP[results['result']]
-        except KeyError:
-            logger.error("[%d] Unable to MAP result \"%s\"", job.id, results['result'])
+            with transaction.atomic():
+                TestCase.objects.bulk_create(self.pending)
+                add_suite_counters(self.pending)
+        except (DataError, IntegrityError, decimal.InvalidOperation):
+            # only drop the faulty test cases
+            for case in self.pending:
+                try:
+                    with transaction.atomic():
+                        case.save()
+                        add_suite_counters([case])
+                except (DataError, IntegrityError, decimal.InvalidOperation):
+                    self.logger.exception("[%d] Unable to create test case %s", self.job.id, case.name)
+        self.pending = []
+        self.first_pending = None
+
+    def add(self, results, meta_filename):  # pylint: disable=too-many-branches,too-many-statements,too-many-return-statements
+        """
+        Sanity checker on the logged results dictionary
+        :param results: results logged via the slave
+        :param meta_filename: YAML store for results metadata
+        :return: False on error, else True
+        """
+        job = self.job
+        logger = self.logger
+        self.last_usage = time.time()
+
+        if not isinstance(results, dict):
+            append_failure_comment(job, "[%d] %s is not a dictionary" % (job.id, results))
             return False
 
-        measurement = None
-        units = ''
-        if 'duration' in results:
-            measurement = results['duration']
-            units = 'seconds'
-        case = TestCase.objects.create(name=name,
-                                       suite=suite,
-                                       test_set=testset,
-                                       metadata=yaml.dump(results),
-                                       measurement=measurement,
-                                       units=units,
-                                       result=result_val)
-        with transaction.atomic():
-            if match_action:
+        if not {"definition", "case", "result"}.issubset(set(results.keys())):
+            append_failure_comment(job, "Missing some keys (\"definition\", \"case\" or \"result\") in %s" % results)
+            return False
+
+        if 'extra' in results:
+            results['extra'] = meta_filename
+
+        metadata = yaml.dump(results)
+        if len(metadata) > 4096:  # bug 2471 - test_length unit test
+            msg = "[%d] Result metadata is too long. %s" % (job.id, metadata)
+            logger.error(msg)
+            append_failure_comment(job, msg)
+            return False
+
+        suite = self._suite(results["definition"])
+        testset = self._testset(results, suite)
+
+        name = results["case"].strip()
+        if not SUITE_NAME_PATTERN.match(suite.name) or not CASE_NAME_PATTERN.match(name):
+            append_failure_comment(
+                job,
+                "[%d] Unable to parse test case name as URL %s in suite %s" % (job.id, name, suite.name))
+            return False
+        if suite.name == "lava":
+            match_action = None
+            if "level" in results:
+                match_action = ActionData.objects.filter(
+                    action_level=str(results['level']),
+                    testdata__testjob=suite.job)
+                if match_action:
+                    match_action = match_action[0]
+                    if 'duration' in results:
+                        match_action.duration = results['duration']
+                    if 'timeout' in results:
+                        match_action.timeout = results['timeout']  # duration, positive integer
+            try:
+                result_val = TestCase.RESULT_MAP[results['result']]
+            except KeyError:
+                logger.error("[%d] Unable to MAP result \"%s\"", job.id, results['result'])
+                return False
+
+            measurement = None
+            units = ''
+            if 'duration' in results:
+                measurement = results['duration']
+                units = 'seconds'
+            case = TestCase(name=name,
+                            suite=suite,
+                            test_set=testset,
+                            metadata=metadata,
+                            measurement=measurement,
+                            units=units,
+                            result=result_val)
+            if not match_action:
+                self._queue(case)
+                return True
+            # The action needs the primary key of the test case, keep the
+            # order of the test cases by flushing the pending ones first.
+            self.flush()
+            with transaction.atomic():
+                case.save()
+                add_suite_counters([case])
+            with transaction.atomic():
                 match_action.testcase = case
                 match_action.save(update_fields=['testcase', 'duration', 'timeout'])
 
-    else:
-        result = results["result"]
-        measurement = None
-        units = ''
-        if testset:
-            logger.debug("%s/%s/%s %s", suite, testset, name, result)
         else:
-            logger.debug("%s/%s %s", suite, name, result)
-        if 'measurement' in results:
-            measurement = results['measurement']
-        if 'units' in results:
-            units = results['units']
-            logger.debug("%s/%s %s%s", suite, name, measurement, units)
-        if result not in TestCase.RESULT_MAP:
-            logger.warning("[%d] Unrecognised result: '%s' for test case '%s'", job.id, result, name)
-            return False
-        try:
-            TestCase.objects.create(
+            result = results["result"]
+            measurement = None
+            units = ''
+            if testset:
+                logger.debug("%s/%s/%s %s", suite, testset, name, result)
+            else:
+                logger.debug("%s/%s %s", suite, name, result)
+            if 'measurement' in results:
+                measurement = results['measurement']
+            if 'units' in results:
+                units = results['units']
+                logger.debug("%s/%s %s%s", suite, name, measurement, units)
+            if result not in TestCase.RESULT_MAP:
+                logger.warning("[%d] Unrecognised result: '%s' for test case '%s'", job.id, result, name)
+                return False
+            try:
+                # A single invalid measurement would break the whole
+                # bulk_create, check it before queuing the test case.
+                TestCase._meta.get_field('measurement').get_db_prep_save(
+                    measurement, connection)
+            except decimal.InvalidOperation:
+                logger.exception("[%d] Unable to create test case %s", job.id, name)
+                return True
+            self._queue(TestCase(
                 name=name,
                 suite=suite,
                 test_set=testset,
                 result=TestCase.RESULT_MAP[result],
-                metadata=yaml.dump(results),
+                metadata=metadata,
                 measurement=measurement,
                 units=units
-            ).save()
-        except decimal.InvalidOperation:
-            logger.exception("[%d] Unable to create test case %s", job.id, name)
-    return True
+            ))
+        return True
+
+
+def map_scanned_results(results, job, meta_filename):
+    """
+    Sanity checker on the logged results dictionary
+    Store a single result, see ResultsBuffer for bulk ingestion.
+    :param results: results logged via the slave
+    :param job: the current test job
+    :param meta_filename: YAML store for results metadata
+    :return: False on error, else True
+    """
+    results_buffer = ResultsBuffer(job)
+    ret = results_buffer.add(results, meta_filename)
+    results_buffer.flush()
+    return ret
 
 
 def _add_parameter_metadata(prefix, definition, dictionary, label):
@@ -309,52 +447,85 @@ def _get_device_metadata(data):
     }
 
 
-def build_action(action_data, testdata, submission):
+def action_meta_type(action_data, submission):
+    """
+    :return: the (name, metatype) key of the MetaType of the given action,
+    or None if the action is not tracked.
+    """
     # test for a known section
     logger = logging.getLogger('dispatcher-master')
     if 'section' not in action_data:
         logger.warning("Invalid action data - missing section")
-        return
+        return None
 
     metatype = MetaType.get_section(action_data['section'])
     if metatype is None:  # 0 is allowed
         logger.debug("Unrecognised metatype in action_data: %s", action_data['section'])
-        return
+        return None
     # lookup the type from the job definition.
     type_name = MetaType.get_type_name(action_data, submission)
     if not type_name:
         logger.debug(
             "type_name failed for %s metatype %s",
             action_data['section'], MetaType.TYPE_CHOICES[metatype])
-        return
-    action_meta, created = MetaType.objects.get_or_create(
-        name=type_name, metatype=metatype)
-    if created:
-        action_meta.save()
+        return None
+    return type_name, metatype
+
+
+def get_meta_types(keys):
+    """
+    Fetch the MetaType of the given keys with a single query and create the
+    missing ones.
+    :param keys: set of (name, metatype)
+    :return: dictionary of (name, metatype) => MetaType
+    """
+    meta_types = {}
+    if not keys:
+        return meta_types
+    names = set([name for (name, _) in keys])
+    for meta_type in MetaType.objects.filter(name__in=names).order_by('id'):
+        meta_types.setdefault((meta_type.name, meta_type.metatype), meta_type)
+    for key in keys:
+        if key not in meta_types:
+            meta_types[key] = MetaType.objects.create(name=key[0], metatype=key[1])
+    return meta_types
+
+
+def build_action(action_data, testdata, meta_type):
+    """
+    :return: the unsaved ActionData of the given action
+    """
     max_retry = None
     if 'max_retries' in action_data:
         max_retry = action_data['max_retries']
 
     # maps the static testdata derived from the definition to the runtime pipeline construction
-    action = ActionData.objects.create(
+    return ActionData(
         action_name=action_data['name'],
         action_level=action_data['level'],
         action_summary=action_data['summary'],
         testdata=testdata,
         action_description=action_data['description'],
-        meta_type=action_meta,
+        meta_type=meta_type,
         max_retries=max_retry,
         timeout=int(Timeout.parse(action_data['timeout']))
     )
-    with transaction.atomic():
-        action.save()
 
 
-def walk_actions(data, testdata, submission):
+def walk_actions(data, submission, actions=None):
+    """
+    List the tracked actions of the pipeline, recursively.
+    :return: list of (action_data, (name, metatype))
+    """
+    if actions is None:
+        actions = []
     for action in data:
-        build_action(action, testdata, submission)
+        key = action_meta_type(action, submission)
+        if key is not None:
+            actions.append((action, key))
         if 'pipeline' in action:
-            walk_actions(action['pipeline'], testdata, submission)
+            walk_actions(action['pipeline'], submission, actions)
+    return actions
 
 
 def map_metadata(description, job):
@@ -364,17 +535,24 @@ def map_metadata(description, job):
     into static metadata (TestData) related to this specific job
     The description itself remains outside the database - it will need
     to be made available as a download link.
+    The metadata is written in a single transaction, with one query for the
+    attributes and one for the actions whatever the size of the pipeline.
     :param description: the pipeline description output
     :param job: the TestJob to associate
     :return: True on success, False on error
     """
     logger = logging.getLogger('dispatcher-master')
     try:
-        submission_data = yaml.load(job.definition)
+        submission_data = job.load_definition()
         description_data = yaml.load(description)
     except yaml.YAMLError as exc:
         logger.exception("[%s] %s", job.id, exc)
         return False
+    with transaction.atomic():
+        return _map_metadata(logger, description, description_data, submission_data, job)
+
+
+def _map_metadata(logger, description, description_data, submission_data, job):
     try:
         testdata, created = TestData.objects.get_or_create(testjob=job)
     except MultipleObjectsReturned:
@@ -385,7 +563,6 @@ def map_metadata(description, job):
         # prevent updates of existing TestData
         logger.debug("[%s] skipping alteration of existing TestData", job.id)
         return False
-    testdata.save()
 
     # get job-action metadata
     if description is None:
@@ -397,12 +574,14 @@ def map_metadata(description, job):
     if 'job' not in description_data:
         logger.warning("[%s] skipping description without a job.", job.id)
         return
+    # (name, value) pairs: the same name can be used more than once
+    attributes = []
     action_values = _get_job_metadata(description_data['job']['actions'])
     for key, value in action_values.items():
         if not key or not value:
             logger.warning('[%s] Missing element in job. %s: %s', job.id, key, value)
             continue
-        testdata.attributes.create(name=key, value=value)
+        attributes.append((key, value))
 
     # get metadata from device
     device_values = _get_device_metadata(description_data['device'])
@@ -410,15 +589,24 @@ def map_metadata(description, job):
         if not key or not value:
             logger.warning('[%s] Missing element in device. %s: %s', job.id, key, value)
             continue
-        testdata.attributes.create(name=key, value=value)
+        attributes.append((key, value))
 
     # Add metadata from job submission data.
     if "metadata" in submission_data:
         for key in submission_data["metadata"]:
-            testdata.attributes.create(name=key,
-                                       value=submission_data["metadata"][key])
-
-    walk_actions(description_data['pipeline'], testdata, submission_data)
+            attributes.append((key, submission_data["metadata"][key]))
+
+    content_type = ContentType.objects.get_for_model(TestData)
+    NamedTestAttribute.objects.bulk_create([
+        NamedTestAttribute(content_type=content_type, object_id=testdata.id,
+                           name=key, value=value)
+        for (key, value) in attributes])
+
+    actions = walk_actions(description_data['pipeline'], submission_data)
+    meta_types = get_meta_types(set([key for (_, key) in actions]))
+    ActionData.objects.bulk_create([
+        build_action(action_data, testdata, meta_types[key])
+        for (action_data, key) in actions])
     return True
 
 
@@ -434,6 +622,10 @@ def testcase_export_fields():
     ]
 
 
+# Number of test cases loaded at once by export_testcases
+EXPORT_BATCH = 1000
+
+
 def export_testcase(testcase):
     """
     Returns string versions of selected elements of a TestCase
@@ -442,11 +634,15 @@ def export_testcase(testcase):
     :param testcase: list of TestCase objects
     :return: Dictionary containing relevant information formatted for export
     """
-    actiondata = testcase.action_data
+    return _export_testcase(testcase, testcase.action_data)
+
+
+def _export_testcase(testcase, actiondata):
     duration = float(actiondata.duration) if actiondata else ''
     timeout = actiondata.timeout if actiondata else ''
     level = actiondata.action_level if actiondata else None
-    metadata = dict(testcase.action_metadata) if testcase.action_metadata else {}
+    action_metadata = testcase.action_metadata
+    metadata = dict(action_metadata) if action_metadata else {}
     extra_source = []
     extra_data = metadata.get('extra', None)
     if extra_data and isinstance(extra_data, unicode) and os.path.exists(extra_data):
@@ -471,3 +667,159 @@ def export_testcase(testcase):
         'url': str(testcase.get_absolute_url()),
     }
     return casedict
+
+
+def export_testcases(testcases, batch=EXPORT_BATCH):
+    """
+    Generator of the export_testcase dictionaries for a TestCase queryset.
+    The test cases are loaded by batches of increasing ids, along with the
+    suite, the test set and the action data of the whole batch, so the
+    memory does not grow with the number of test cases.
+    :param testcases: QuerySet of TestCase objects
+    :param batch: number of test cases loaded at once
+    """
+    testcases = testcases.select_related('suite', 'test_set').order_by('id')
+    last_id = 0
+    while True:
+        rows = list(testcases.filter(id__gt=last_id)[:batch])
+        if not rows:
+            return
+        # keep the first action data of each test case, like
+        # TestCase.action_data
+        actions = {}
+        for actiondata in ActionData.objects.filter(
+                testcase__in=[row.id for row in rows]).only(
+                    'testcase', 'duration', 'timeout', 'action_level').order_by('id'):
+            actions.setdefault(actiondata.testcase_id, actiondata)
+        for testcase in rows:
+            yield _export_testcase(testcase, actions.get(testcase.id))
+        last_id = rows[-1].id
+
+
+def export_testcases_csv(testcases):
+    """
+    Generator of the CSV lines, header included, of a TestCase queryset.
+    To be used with a StreamingHttpResponse.
+    """
+    return export_rows_csv(export_testcases(testcases))
+
+
+def export_rows_csv(rows):
+    """
+    Generator of the CSV lines, header included, of export_testcase
+    dictionaries.
+    """
+    fields = testcase_export_fields()
+    writer = csv.DictWriter(
+        StreamEcho(),
+        quoting=csv.QUOTE_ALL,
+        extrasaction='ignore',
+        fieldnames=fields)
+    # DictWriter.writeheader does not return the line
+    yield writer.writerow(dict(zip(fields, fields)))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_testcases_yaml(testcases):
+    """
+    Generator of the YAML list of a TestCase queryset, one item at a time.
+    To be used with a StreamingHttpResponse.
+    """
+    return export_rows_yaml(export_testcases(testcases))
+
+
+def export_rows_yaml(rows):
+    """
+    Generator of the YAML list of export_testcase dictionaries, one item at
+    a time.
+    """
+    empty = True
+    for row in rows:
+        empty = False
+        yield yaml.dump([row], Dumper=yaml.CDumper)
+    if empty:
+        yield yaml.dump([], Dumper=yaml.CDumper)
+
+
+def export_jobs_testcases(job_ids):
+    """
+    Export the test cases of several jobs at once.
+    :param job_ids: list of TestJob ids
+    :return: dictionary of the list of export_testcase dictionaries of each
+    job id, in the order of export_testcases
+    """
+    jobs = {}
+    for row in export_testcases(TestCase.objects.filter(suite__job__in=job_ids)):
+        jobs.setdefault(int(row['job']), []).append(row)
+    return jobs
+
+
+# Number of views refreshed at the same time, each one using its own
+# database connection
+REFRESH_JOBS = 4
+
+
+def _refresh_query(query, marks):
+    report = {
+        'query': query.owner_name,
+        'refreshed': False,
+        'duration': 0.0,
+        'error': '',
+    }
+    start = time.time()
+    try:
+        query.refresh_view(marks)
+        report['refreshed'] = True
+    except (QueryUpdatedError, DatabaseError) as exc:
+        report['error'] = str(exc)
+    report['duration'] = time.time() - start
+    return report
+
+
+def _refresh_query_thread(args):
+    try:
+        return _refresh_query(*args)
+    finally:
+        # Each thread of the pool has its own connection
+        connection.close()
+
+
+def refresh_queries(queries, jobs=REFRESH_JOBS, force=False):
+    """
+    Refresh the views of the cached queries that could miss some results,
+    see Query.is_outdated. The views are independent: up to jobs views are
+    refreshed in parallel.
+    :param queries: the cached queries, with the owner selected
+    :param force: refresh the views even without new data
+    :return: list of reports, in the order of the queries, with the query
+    owner_name, whether the view was refreshed, the refresh duration in
+    seconds and the error message
+    """
+    queries = list(queries)
+    marks = Query.data_marks()
+    reports = {}
+    outdated = []
+    for query in queries:
+        if force or query.is_outdated(marks):
+            outdated.append(query)
+        else:
+            reports[query.id] = {
+                'query': query.owner_name,
+                'refreshed': False,
+                'duration': 0.0,
+                'error': '',
+            }
+    if jobs > 1 and len(outdated) > 1:
+        pool = ThreadPool(min(jobs, len(outdated)))
+        try:
+            results = pool.map(_refresh_query_thread,
+                               [(query, marks) for query in outdated])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_refresh_query(query, marks) for query in outdated]
+    for (query, report) in zip(outdated, results):
+        reports[query.id] = report
+    return [reports[query.id] for query in queries]
@@ -21,6 +21,7 @@
 
 import sys
 from django.core.management.base import BaseCommand
+from lava_results_app.dbutils import REFRESH_JOBS, refresh_queries
 from lava_results_app.models import Query
 
 
@@ -40,6 +41,10 @@ class Command(BaseCommand):
         parser.add_argument('--name', help="Name of the query")
         parser.add_argument('--username', help="Username for named query")
         parser.add_argument('--all', dest='all', action='store_true', help='Refresh all queries')
+        parser.add_argument('--force', action='store_true',
+                            help='Refresh the queries even if no new result could match')
+        parser.add_argument('--jobs', type=int, default=REFRESH_JOBS,
+                            help='Number of queries refreshed in parallel. Default: %d' % REFRESH_JOBS)
 
     def handle(self, *args, **options):
         if not options['name'] and not options['all']:
@@ -57,7 +62,15 @@ class Command(BaseCommand):
                     "Error: A cached query with name %s does not exist for user %s." % (
                         query_name, options['username']))
                 sys.exit(1)
-            query.refresh_view()
+            reports = refresh_queries([query], jobs=1, force=True)
         else:
-            for query in Query.objects.all().filter(is_live=False):
-                query.refresh_view()
+            reports = refresh_queries(
+                Query.objects.filter(is_live=False).select_related('owner'),
+                jobs=max(1, options['jobs']), force=options['force'])
+        for report in reports:
+            if report['error']:
+                self.stderr.write("%s: %s" % (report['query'], report['error']))
+            elif report['refreshed']:
+                self.stdout.write("%s: refreshed in %.2fs" % (report['query'], report['duration']))
+            else:
+                self.stdout.write("%s: no new results" % report['query'])
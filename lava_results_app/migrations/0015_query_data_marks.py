@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lava_results_app', '0014_xaxis_maxlength_increase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='last_job_change',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='last_job_id',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='last_testcase_id',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+COUNT_RESULT = "(SELECT COUNT(*) FROM lava_results_app_testcase " \
+               "WHERE lava_results_app_testcase.suite_id = lava_results_app_testsuite.id " \
+               "AND lava_results_app_testcase.result = %d)"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lava_results_app', '0015_query_data_marks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testsuite',
+            name='count_fail',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='testsuite',
+            name='count_pass',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='testsuite',
+            name='count_skip',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='testsuite',
+            name='count_unknown',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        # count the existing results
+        migrations.RunSQL(
+            "UPDATE lava_results_app_testsuite SET "
+            "count_pass = %s, count_fail = %s, count_skip = %s, count_unknown = %s;" % (
+                COUNT_RESULT % 0, COUNT_RESULT % 1, COUNT_RESULT % 2, COUNT_RESULT % 3),
+            reverse_sql=migrations.RunSQL.noop),
+    ]
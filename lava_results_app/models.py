@@ -28,6 +28,7 @@ TestSet can be enabled within a test definition run step
 TestCase is a single lava-test-case record or Action result.
 """
 
+import hashlib
 import logging
 import urllib
 import yaml
@@ -38,6 +39,7 @@ from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes import fields
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
 from django.core.validators import (
     MaxValueValidator,
     MinValueValidator
@@ -116,7 +118,10 @@ class QueryMaterializedView(MaterializedView):
     CREATE_VIEW = "CREATE MATERIALIZED VIEW %s%s AS %s;"
     DROP_VIEW = "DROP MATERIALIZED VIEW IF EXISTS %s%s;"
     REFRESH_VIEW = "REFRESH MATERIALIZED VIEW %s%s;"
+    REFRESH_VIEW_CONCURRENTLY = "REFRESH MATERIALIZED VIEW CONCURRENTLY %s%s;"
     VIEW_EXISTS = "SELECT EXISTS(SELECT * FROM pg_class WHERE relname='%s%s');"
+    CREATE_INDEX = "CREATE UNIQUE INDEX %s%s_id ON %s%s (id);"
+    INDEX_EXISTS = "SELECT EXISTS(SELECT * FROM pg_indexes WHERE indexname='%s%s_id');"
     QUERY_VIEW_PREFIX = "query_"
 
     @classmethod
@@ -137,10 +142,20 @@ class QueryMaterializedView(MaterializedView):
             query_str = cls.CREATE_VIEW % (cls.QUERY_VIEW_PREFIX,
                                            query.id, query_str)
             cursor.execute(query_str)
+            # The query results are distinct: the unique index allows
+            # concurrent refreshes.
+            cursor.execute(cls.CREATE_INDEX % (cls.QUERY_VIEW_PREFIX, query.id,
+                                               cls.QUERY_VIEW_PREFIX, query.id))
 
     @classmethod
     def refresh(cls, query_id):
-        refresh_sql = cls.REFRESH_VIEW % (cls.QUERY_VIEW_PREFIX, query_id)
+        # A concurrent refresh does not lock the readers of the view but
+        # needs a unique index (missing on the views created before) and
+        # can't run inside a transaction.
+        if not connection.get_autocommit() or not cls.index_exists(query_id):
+            refresh_sql = cls.REFRESH_VIEW % (cls.QUERY_VIEW_PREFIX, query_id)
+        else:
+            refresh_sql = cls.REFRESH_VIEW_CONCURRENTLY % (cls.QUERY_VIEW_PREFIX, query_id)
         cursor = connection.cursor()
         cursor.execute(refresh_sql)
 
@@ -156,6 +171,12 @@ class QueryMaterializedView(MaterializedView):
         cursor.execute(cls.VIEW_EXISTS % (cls.QUERY_VIEW_PREFIX, query_id))
         return cursor.fetchone()[0]
 
+    @classmethod
+    def index_exists(cls, query_id):
+        cursor = connection.cursor()
+        cursor.execute(cls.INDEX_EXISTS % (cls.QUERY_VIEW_PREFIX, query_id))
+        return cursor.fetchone()[0]
+
     def get_queryset(self):
         return QueryMaterializedView.objects.all()
 
@@ -180,19 +201,28 @@ class TestSuite(models.Model, Queryable):
         max_length=200
     )
 
+    # Denormalized results of the test cases, maintained by ResultsBuffer
+    # and reconciled when the job ends, see update_suite_counters.
+    count_pass = models.PositiveIntegerField(default=0, editable=False)
+
+    count_fail = models.PositiveIntegerField(default=0, editable=False)
+
+    count_skip = models.PositiveIntegerField(default=0, editable=False)
+
+    count_unknown = models.PositiveIntegerField(default=0, editable=False)
+
+    def count_all(self):
+        return (self.count_pass + self.count_fail + self.count_skip +
+                self.count_unknown)
+
+    def get_counters(self):
+        return dict((name, getattr(self, 'count_%s' % name))
+                    for name in PASSFAIL_RESULTS)
+
     def get_passfail_results(self):
         # Get pass fail results per lava_results_app.testsuite.
         results = {}
-        results[self.name] = {
-            'pass': self.testcase_set.filter(
-                result=TestCase.RESULT_MAP['pass']).count(),
-            'fail': self.testcase_set.filter(
-                result=TestCase.RESULT_MAP['fail']).count(),
-            'skip': self.testcase_set.filter(
-                result=TestCase.RESULT_MAP['skip']).count(),
-            'unknown': self.testcase_set.filter(
-                result=TestCase.RESULT_MAP['unknown']).count()
-        }
+        results[self.name] = self.get_counters()
         return results
 
     def get_measurement_results(self):
@@ -246,7 +276,7 @@ class TestSuite(models.Model, Queryable):
         """
         Web friendly name for the test suite
         """
-        return ("lava.results.suite", [self.job.id, self.name])
+        return ("lava.results.suite", [self.job_id, self.name])
 
     def __unicode__(self):
         """
@@ -277,7 +307,7 @@ class TestSet(models.Model):
 
     def get_absolute_url(self):
         return urllib.quote("/results/%s/%s/%s" % (
-            self.suite.job.id,
+            self.suite.job_id,
             self.suite.name,
             self.name
         ))
@@ -381,7 +411,7 @@ class TestCase(models.Model, Queryable):
         if not self.metadata:
             return None
         try:
-            ret = yaml.load(self.metadata)
+            ret = yaml.load(self.metadata, Loader=yaml.CLoader)
         except yaml.YAMLError:
             return None
         return ret
@@ -440,10 +470,10 @@ class TestCase(models.Model, Queryable):
     def get_absolute_url(self):
         if self.test_set:
             return urllib.quote("/results/%s/%s/%s/%s" % (
-                self.suite.job.id, self.suite.name, self.test_set.name, self.name))
+                self.suite.job_id, self.suite.name, self.test_set.name, self.name))
         else:
             return urllib.quote("/results/%s/%s/%s" % (
-                self.suite.job.id, self.suite.name, self.name))
+                self.suite.job_id, self.suite.name, self.name))
 
     def _get_value(self):
         if self.measurement:
@@ -487,6 +517,23 @@ class TestCase(models.Model, Queryable):
         return self.RESULT_REVERSE[self.result]
 
 
+PASSFAIL_RESULTS = ['pass', 'fail', 'skip', 'unknown']
+
+
+def passfail_annotations(prefix=''):
+    """
+    Conditional aggregates counting the test cases of each result, to be used
+    with annotate() or aggregate().
+    :param prefix: path to the test cases, e.g. 'testcase__' from TestSuite
+    """
+    annotations = {}
+    for name in PASSFAIL_RESULTS:
+        annotations[name] = models.Count(models.Case(
+            models.When(then=1, **{prefix + 'result': TestCase.RESULT_MAP[name]}),
+            output_field=models.IntegerField()))
+    return annotations
+
+
 class MetaType(models.Model):
     """
     name will be a label, like a deployment type (NFS) or a boot type (bootz)
@@ -813,6 +860,25 @@ class Query(models.Model):
         null=True
     )
 
+    # Newest data seen by the last refresh of the view, see data_marks
+    last_job_id = models.IntegerField(
+        blank=True,
+        null=True,
+        editable=False
+    )
+
+    last_testcase_id = models.IntegerField(
+        blank=True,
+        null=True,
+        editable=False
+    )
+
+    last_job_change = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False
+    )
+
     group_by_attribute = models.CharField(
         blank=True,
         null=True,
@@ -836,6 +902,35 @@ class Query(models.Model):
     def has_view(self):
         return QueryMaterializedView.view_exists(self.id)
 
+    @classmethod
+    def data_marks(cls):
+        """
+        Newest test job, test case and test job change (start or end). Rows
+        matching a cached query are created or updated along with one of
+        them, so a view refreshed with the current marks is up to date.
+        Edits made to the rows afterwards are not tracked.
+        """
+        jobs = TestJob.objects.aggregate(
+            last_id=models.Max('id'), started=models.Max('start_time'),
+            ended=models.Max('end_time'))
+        changes = [date for date in [jobs['started'], jobs['ended']] if date is not None]
+        return {
+            'last_job_id': jobs['last_id'],
+            'last_testcase_id': TestCase.objects.aggregate(
+                last_id=models.Max('id'))['last_id'],
+            'last_job_change': max(changes) if changes else None,
+        }
+
+    def is_outdated(self, marks):
+        """
+        Could the view miss some results, given the current data_marks?
+        """
+        if self.is_changed or self.last_updated is None:
+            return True
+        if any(getattr(self, key) != value for (key, value) in marks.items()):
+            return True
+        return not self.has_view()
+
     def get_results(self, user, limit=None, order_by=['-id']):
         """ Used to get query results for persistant queries.
 
@@ -958,7 +1053,7 @@ class Query(models.Model):
 
         return query_results
 
-    def refresh_view(self):
+    def refresh_view(self, marks=None):
 
         if self.is_live:
             raise RefreshLiveQueryError("Refreshing live query not permitted.")
@@ -977,6 +1072,10 @@ class Query(models.Model):
                 query.is_updating = True
                 query.save()
 
+        # Rows added during the refresh will be seen by the next one
+        if marks is None:
+            marks = Query.data_marks()
+
         try:
             if not self.has_view():
                 QueryMaterializedView.create(self)
@@ -988,6 +1087,8 @@ class Query(models.Model):
 
             self.last_updated = timezone.now()
             self.is_changed = False
+            for (key, value) in marks.items():
+                setattr(self, key, value)
 
         finally:
             self.is_updating = False
@@ -1426,6 +1527,18 @@ CHART_VISIBILITY = ((r'chart', 'Chart only'),
                     (r'both', 'Both'))
 
 
+def visibility_class(user):
+    """
+    Users of the same class see the same test jobs, see
+    RestrictedTestJobQuerySet.visible_by_user.
+    """
+    if not user or user.is_anonymous():
+        return "anonymous"
+    if user.is_superuser or user.has_perm('lava_scheduler_app.cancel_resubmit_testjob'):
+        return "all"
+    return "user-%d" % user.id
+
+
 class ChartQuery(models.Model):
 
     class Meta:
@@ -1518,6 +1631,47 @@ class ChartQuery(models.Model):
         chart_data["basic"] = self.get_basic_chart_data()
         chart_data["user"] = self.get_user_chart_data(user)
 
+        # The data only depends on the key: same chart options, conditions,
+        # results and visibility.
+        results_cache = caches['results']
+        key = self.get_cache_key(user, content_type, conditions)
+        data = results_cache.get(key)
+        if data is None:
+            data = self.get_chart_data(user, content_type, conditions)
+            if data is not None:
+                results_cache.set(key, data)
+        if data is not None:
+            chart_data["data"] = data
+
+        return chart_data
+
+    def get_cache_key(self, user, content_type=None, conditions=None):
+        """
+        Cached queries only change when refreshed, live queries and custom
+        charts when new test cases are created.
+        """
+        omitted = []
+        if hasattr(self, "query"):
+            content_type = self.query.content_type
+            conditions = self.query.querycondition_set.all()
+            omitted = sorted(QueryOmitResult.objects.filter(
+                query=self.query).values_list('object_id', flat=True))
+            limit = self.query.limit
+            version = self.query.last_updated if not self.query.is_live else None
+        else:
+            limit = None
+            version = None
+        if version is None:
+            version = TestCase.objects.aggregate(last_id=models.Max('id'))['last_id']
+        description = [
+            self.id, self.chart_type, self.xaxis_attribute, self.attributes,
+            content_type.id, Query.serialize_conditions(conditions), omitted,
+            limit, str(version), visibility_class(user),
+        ]
+        return "chart-%s" % hashlib.sha1(repr(description)).hexdigest()
+
+    def get_chart_data(self, user, content_type=None, conditions=None):
+
         # TODO: order by attribute if attribute is used for x-axis.
         if hasattr(self, "query"):
             results = self.query.get_results(user).order_by(
@@ -1530,17 +1684,17 @@ class ChartQuery(models.Model):
                     self.ORDER_BY_MAP[content_type.model_class()])
 
         if self.chart_type == "pass/fail":
-            chart_data["data"] = self.get_chart_passfail_data(user, results)
+            return self.get_chart_passfail_data(user, results)
 
         elif self.chart_type == "measurement":
             # TODO: In case of job or suite, do avg measurement, and later add
             # option to do min/max/other.
-            chart_data["data"] = self.get_chart_measurement_data(user, results)
+            return self.get_chart_measurement_data(user, results)
 
         elif self.chart_type == "attributes":
-            chart_data["data"] = self.get_chart_attributes_data(user, results)
+            return self.get_chart_attributes_data(user, results)
 
-        return chart_data
+        return None
 
     def get_basic_chart_data(self):
         data = {}
@@ -1585,22 +1739,106 @@ class ChartQuery(models.Model):
 
         return data
 
+    @staticmethod
+    def get_items_passfail_results(items):
+        """
+        get_passfail_results of each test job or test suite, in one query.
+        :return: dictionary of the results by item id
+        """
+        results = {}
+        if not items:
+            return results
+        if isinstance(items[0], TestJob):
+            suites = TestSuite.objects.filter(job__in=[item.id for item in items])
+            key = 'job'
+        elif isinstance(items[0], TestSuite):
+            suites = TestSuite.objects.filter(id__in=[item.id for item in items])
+            key = 'id'
+        else:
+            # Pass/fail charts for testcases do not make sense.
+            return results
+        fields = ['count_%s' % name for name in PASSFAIL_RESULTS]
+        for suite in suites.values('id', 'job', 'name', *fields).order_by('id'):
+            results.setdefault(suite[key], {})[suite['name']] = dict(
+                (name, suite['count_%s' % name]) for name in PASSFAIL_RESULTS)
+        return results
+
+    @staticmethod
+    def get_items_end_datetimes(items):
+        """
+        get_end_datetime of each query result, without loading the job of
+        each test suite.
+        :return: dictionary of the dates by item id
+        """
+        if items and isinstance(items[0], TestSuite):
+            end_times = dict(TestJob.objects.filter(
+                id__in=set([item.job_id for item in items])).values_list('id', 'end_time'))
+            return dict((item.id, end_times.get(item.job_id)) for item in items)
+        return dict((item.id, item.get_end_datetime()) for item in items)
+
+    def get_items_xaxis_attributes(self, items):
+        """
+        get_xaxis_attribute of each query result, in a constant number of
+        queries.
+        :return: dictionary of the attributes by item id
+        """
+        attributes = {}
+        if not self.xaxis_attribute or not items:
+            return attributes
+        ids = [item.id for item in items]
+        if isinstance(items[0], TestJob):
+            # Attributes of the first TestData of each job
+            testdata = {}
+            for (testdata_id, job_id) in TestData.objects.filter(
+                    testjob__in=ids).order_by('id').values_list('id', 'testjob'):
+                testdata.setdefault(job_id, testdata_id)
+            values = {}
+            for (object_id, value) in NamedTestAttribute.objects.filter(
+                    content_type=ContentType.objects.get_for_model(TestData),
+                    object_id__in=testdata.values(),
+                    name=self.xaxis_attribute).order_by('id').values_list(
+                        'object_id', 'value'):
+                values.setdefault(object_id, value)
+            for (job_id, testdata_id) in testdata.items():
+                if testdata_id in values:
+                    attributes[job_id] = values[testdata_id]
+        elif isinstance(items[0], TestSuite):
+            # Metadata of the first test case of each suite
+            first_ids = [row['first'] for row in TestCase.objects.filter(
+                suite__in=ids).values('suite').annotate(
+                    first=models.Min('id')).order_by()]
+            for testcase in TestCase.objects.filter(id__in=first_ids).only(
+                    'id', 'suite', 'metadata'):
+                try:
+                    attributes[testcase.suite_id] = testcase.action_metadata[
+                        self.xaxis_attribute]
+                except (KeyError, TypeError):  # There's no attribute, use date.
+                    pass
+        else:
+            for item in items:
+                attributes[item.id] = item.get_xaxis_attribute(self.xaxis_attribute)
+        return attributes
+
     def get_chart_passfail_data(self, user, query_results):
 
         data = []
-        for item in query_results:
+        items = list(query_results)
+        attributes = self.get_items_xaxis_attributes(items)
+        dates = self.get_items_end_datetimes(items)
+        passfail = self.get_items_passfail_results(items)
+        for item in items:
 
             # Set attribute based on xaxis_attribute.
-            attribute = item.get_xaxis_attribute(self.xaxis_attribute)
+            attribute = attributes.get(item.id)
             # If xaxis attribute is set and this query item does not have
             # this specific attribute, ignore it.
             if self.xaxis_attribute and not attribute:
                 continue
 
-            date = str(item.get_end_datetime())
+            date = str(dates[item.id])
             attribute = attribute if attribute is not None else date
 
-            passfail_results = item.get_passfail_results()
+            passfail_results = passfail.get(item.id, {})
             for result in passfail_results:
 
                 if result:
@@ -1627,16 +1865,19 @@ class ChartQuery(models.Model):
     def get_chart_measurement_data(self, user, query_results):
 
         data = []
-        for item in query_results:
+        items = list(query_results)
+        attributes = self.get_items_xaxis_attributes(items)
+        dates = self.get_items_end_datetimes(items)
+        for item in items:
 
             # Set attribute based on xaxis_attribute.
-            attribute = item.get_xaxis_attribute(self.xaxis_attribute)
+            attribute = attributes.get(item.id)
             # If xaxis attribute is set and this query item does not have
             # this specific attribute, ignore it.
             if self.xaxis_attribute and not attribute:
                 continue
 
-            date = str(item.get_end_datetime())
+            date = str(dates[item.id])
             attribute = attribute if attribute is not None else date
 
             measurement_results = item.get_measurement_results()
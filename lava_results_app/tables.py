@@ -91,28 +91,17 @@ class ResultsTable(LavaTable):
     def render_passes(self, record, table=None):
         if not self._check_job(record, table):
             return ''
-        return TestCase.objects.filter(
-            suite__job=record.job,
-            suite=record,
-            result=TestCase.RESULT_MAP['pass']
-        ).count()
+        return record.count_pass
 
     def render_fails(self, record, table=None):
         if not self._check_job(record, table):
             return ''
-        return TestCase.objects.filter(
-            suite__job=record.job,
-            suite=record,
-            result=TestCase.RESULT_MAP['fail']
-        ).count()
+        return record.count_fail
 
     def render_total(self, record, table=None):
         if not self._check_job(record, table):
             return ''
-        return TestCase.objects.filter(
-            suite__job=record.job,
-            suite=record,
-        ).count()
+        return record.count_all()
 
     def render_logged(self, record, table=None):
         if not self._check_job(record, table):
@@ -1,12 +1,18 @@
 # pylint: disable=ungrouped-imports
 import os
 import re
+import sys
+import time
 import yaml
 import shutil
 import logging
 import decimal
+import unittest
 import django
 from django.core.exceptions import MultipleObjectsReturned
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from lava_results_app.tests.test_names import TestCaseWithFactory
 from lava_scheduler_app.models import (
     TestJob,
@@ -20,8 +26,23 @@ from lava_results_app.dbutils import (
     _get_job_metadata, _get_device_metadata,  # pylint: disable=protected-access
     testcase_export_fields,
     export_testcase,
+    export_testcases,
+    export_testcases_csv,
+    export_testcases_yaml,
+    refresh_queries,
+    update_suite_counters,
+)
+from lava_results_app.models import (
+    ActionData,
+    Chart,
+    ChartQuery,
+    MetaType,
+    NamedTestAttribute,
+    Query,
+    TestData,
+    TestCase,
+    TestSuite,
 )
-from lava_results_app.models import ActionData, MetaType, TestData, TestCase, TestSuite
 from lava_dispatcher.pipeline.parser import JobParser
 from lava_dispatcher.pipeline.device import PipelineDevice
 from lava_dispatcher.pipeline.test.test_defs import allow_missing_path
@@ -100,6 +121,32 @@ class TestMetaTypes(TestCaseWithFactory):
             )
         )
 
+    def test_export_stream(self):
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), self.user)
+        test_suite = TestSuite.objects.get_or_create(name='lava', job=job)[0]
+        metatype = MetaType.objects.create(name='fake', metatype=MetaType.TEST_TYPE)
+        for index in range(5):
+            test_case = TestCase.objects.create(
+                name='case-%d' % index, suite=test_suite, result=TestCase.RESULT_PASS,
+                metadata=yaml.dump({'case': 'case-%d' % index}))
+            ActionData.objects.create(
+                meta_type=metatype, action_level='1.%d' % index, action_name='fake',
+                testcase=test_case, duration='1.5', timeout=300)
+        test_cases = TestCase.objects.filter(suite__job=job)
+        expected = [export_testcase(test_case) for test_case in test_cases.order_by('id')]
+        self.assertEqual(expected[2]['level'], '1.2')
+        self.assertEqual(expected[2]['duration'], '1.5')
+        # test cases and action data for each of the 3 batches, then the end
+        with self.assertNumQueries(7):
+            self.assertEqual(list(export_testcases(test_cases, batch=2)), expected)
+        self.assertEqual(yaml.load(''.join(export_testcases_yaml(test_cases))), expected)
+        self.assertEqual(''.join(export_testcases_yaml(test_cases.none())), '[]\n')
+        lines = list(export_testcases_csv(test_cases))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0].strip(), ','.join(
+            '"%s"' % field for field in testcase_export_fields()))
+
     def test_duration(self):
         TestJob.from_yaml_and_user(
             self.factory.make_job_yaml(), self.user)
@@ -317,3 +364,160 @@ class TestMetaTypes(TestCaseWithFactory):
                            'qemu-system-x86_64')
         pipeline = pipeline_job.describe()
         map_metadata(yaml.dump(pipeline), job)
+
+    def recorded_description(self, copies=1, metadata=None):
+        """
+        Job and description recorded from a dynamic connection, the pipeline
+        repeated to simulate larger descriptions.
+        """
+        filename = os.path.join(os.path.dirname(__file__), '..', '..', 'lava_scheduler_app',
+                                'tests', 'pipeline_refs', 'connection-description.yaml')
+        with open(filename, 'r') as f_in:
+            description = yaml.load(f_in)
+        description['pipeline'] = description['pipeline'] * copies
+        if metadata:
+            description['job']['metadata'] = metadata
+        job = TestJob.objects.create(submitter=self.user, user=self.user, is_pipeline=True,
+                                     definition=yaml.dump(description['job']))
+        return job, yaml.dump(description)
+
+    def test_map_metadata_queries(self):
+        # first mapping creates the MetaTypes
+        job, description = self.recorded_description()
+        self.assertTrue(map_metadata(description, job))
+        count = ActionData.objects.filter(testdata__testjob=job).count()
+        self.assertNotEqual(count, 0)
+        self.assertTrue(TestData.objects.get(testjob=job).attributes.exists())
+
+        job, description = self.recorded_description()
+        with CaptureQueriesContext(connection) as small:
+            self.assertTrue(map_metadata(description, job))
+        job, description = self.recorded_description(10)
+        with CaptureQueriesContext(connection) as large:
+            self.assertTrue(map_metadata(description, job))
+        self.assertEqual(ActionData.objects.filter(testdata__testjob=job).count(), 10 * count)
+        # the number of queries does not depend on the size of the pipeline
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+        # a duplicated name creates one attribute per value
+        attributes = TestData.objects.get(testjob=job).attributes
+        name = attributes.first().name
+        count = attributes.filter(name=name).count()
+        job, description = self.recorded_description(metadata={name: 'submitted'})
+        self.assertTrue(map_metadata(description, job))
+        self.assertEqual(
+            TestData.objects.get(testjob=job).attributes.filter(name=name).count(), count + 1)
+
+    # comment out the decorator to run this timing test
+    @unittest.skip('Developer only - timing test')
+    def test_map_metadata_timing(self):
+        # create the MetaTypes first
+        job, description = self.recorded_description()
+        self.assertTrue(map_metadata(description, job))
+        for copies in [1, 10, 100]:
+            job, description = self.recorded_description(copies)
+            start = time.time()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(map_metadata(description, job))
+            print >> sys.stderr, "map_metadata: %d actions, %d queries in %.3fs" % (
+                ActionData.objects.filter(testdata__testjob=job).count(),
+                len(queries.captured_queries), time.time() - start)
+
+    def make_results_job(self, build):
+        job = TestJob.objects.create(submitter=self.user, user=self.user,
+                                     definition='', is_pipeline=True)
+        testdata = TestData.objects.create(testjob=job)
+        NamedTestAttribute.objects.create(
+            content_type=ContentType.objects.get_for_model(TestData),
+            object_id=testdata.id, name='build', value=build)
+        for (name, results) in [('lava', ['pass']),
+                                ('smoke', ['pass', 'fail', 'fail', 'skip'])]:
+            suite = TestSuite.objects.create(name=name, job=job)
+            for (index, result) in enumerate(results):
+                TestCase.objects.create(name='case-%d' % index, suite=suite,
+                                        result=TestCase.RESULT_MAP[result])
+        update_suite_counters(job.id)
+        return job
+
+    def test_chart_passfail(self):
+        job = self.make_results_job('1')
+        self.assertEqual(job.get_passfail_results(), {
+            'lava': {'pass': 1, 'fail': 0, 'skip': 0, 'unknown': 0},
+            'smoke': {'pass': 1, 'fail': 2, 'skip': 1, 'unknown': 0}})
+        self.assertEqual(TestSuite.objects.get(job=job, name='smoke').get_passfail_results(),
+                         {'smoke': {'pass': 1, 'fail': 2, 'skip': 1, 'unknown': 0}})
+
+        chart_query = ChartQuery(xaxis_attribute='build')
+        with CaptureQueriesContext(connection) as small:
+            data = chart_query.get_chart_passfail_data(
+                self.user, TestJob.objects.filter(id=job.id))
+        self.assertEqual(sorted([(item['id'], item['attribute'], item['total'], item['pass'])
+                                 for item in data]),
+                         [('lava', '1', 1, True), ('smoke', '1', 4, False)])
+
+        jobs = [job.id] + [self.make_results_job(str(build)).id for build in range(2, 12)]
+        with CaptureQueriesContext(connection) as large:
+            data = chart_query.get_chart_passfail_data(
+                self.user, TestJob.objects.filter(id__in=jobs))
+        self.assertEqual(len(data), 2 * len(jobs))
+        # the number of queries does not depend on the number of results
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+        data = chart_query.get_chart_passfail_data(
+            self.user, TestSuite.objects.filter(job__id__in=jobs, name='smoke'))
+        self.assertEqual(len(data), 0)  # test cases without the attribute
+        chart_query.xaxis_attribute = None
+        data = chart_query.get_chart_passfail_data(
+            self.user, TestSuite.objects.filter(job__id__in=jobs, name='smoke'))
+        self.assertEqual(set([item['failures'] for item in data]), set([2]))
+
+    def test_refresh_queries(self):
+        query = Query.objects.create(
+            owner=self.user, name='jobs', is_live=False,
+            content_type=ContentType.objects.get_for_model(TestJob))
+        job = self.make_results_job('1')
+        reports = refresh_queries([query], jobs=1)
+        self.assertEqual([(report['query'], report['refreshed'], report['error'])
+                          for report in reports], [(query.owner_name, True, '')])
+        query = Query.objects.get(id=query.id)
+        self.assertEqual(query.last_job_id, job.id)
+        self.assertTrue(query.has_view())
+        # no new data
+        self.assertFalse(refresh_queries([query], jobs=1)[0]['refreshed'])
+        self.assertTrue(refresh_queries([query], jobs=1, force=True)[0]['refreshed'])
+        # new job
+        self.make_results_job('2')
+        self.assertTrue(refresh_queries([query], jobs=1)[0]['refreshed'])
+        self.assertFalse(refresh_queries([query], jobs=1)[0]['refreshed'])
+
+    def test_chart_cache(self):
+        self.make_results_job('1')
+        content_type = ContentType.objects.get_for_model(TestJob)
+        chart_query = ChartQuery(id=0)
+        chart_query.chart = Chart(name="Custom")
+        chart_query.chart_type = "pass/fail"
+        data = chart_query.get_data(self.user, content_type, [])['data']
+        self.assertEqual(len(data), 2)
+        with CaptureQueriesContext(connection) as cached:
+            self.assertEqual(chart_query.get_data(self.user, content_type, [])['data'], data)
+        # the newest test case and the user chart settings
+        self.assertEqual(len(cached.captured_queries), 2)
+        # new test cases change the key
+        self.make_results_job('2')
+        self.assertEqual(len(chart_query.get_data(self.user, content_type, [])['data']), 4)
+
+    def test_suite_counters(self):
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), self.user)
+        for (case, result) in [('first', 'pass'), ('second', 'fail'), ('third', 'pass')]:
+            self.assertTrue(map_scanned_results(
+                {'definition': 'smoke', 'case': case, 'result': result}, job, None))
+        suite = TestSuite.objects.get(job=job, name='smoke')
+        self.assertEqual(suite.get_counters(), {'pass': 2, 'fail': 1, 'skip': 0, 'unknown': 0})
+        self.assertEqual(job.get_passfail_results(), {'smoke': suite.get_counters()})
+        # reconciled at the end of the job
+        TestCase.objects.filter(suite=suite, name='second').delete()
+        update_suite_counters(job.id)
+        suite = TestSuite.objects.get(job=job, name='smoke')
+        self.assertEqual(suite.get_counters(), {'pass': 2, 'fail': 0, 'skip': 0, 'unknown': 0})
+        self.assertEqual(suite.count_all(), 2)
@@ -4,9 +4,9 @@ import logging
 from django.contrib.auth.models import User
 from django.core.validators import URLValidator
 from lava_results_app.models import (
-    TestCase, TestSuite
+    TestCase, TestSuite, TestSet
 )
-from lava_results_app.dbutils import map_scanned_results
+from lava_results_app.dbutils import map_scanned_results, ResultsBuffer
 from lava_scheduler_app.models import (
     TestJob, Device,
     DeviceType, DeviceDictionary,
@@ -200,3 +200,26 @@ class TestTestSuite(TestCaseWithFactory):
             self.assertTrue(testcase.name.startswith('linux-INLINE-'))
             val('http://localhost/%s' % testcase.get_absolute_url())
         self.factory.cleanup()
+
+    def test_results_buffer(self):
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), self.user)
+        results_buffer = ResultsBuffer(job)
+        for index in range(10):
+            self.assertTrue(results_buffer.add(
+                {"case": "case-%d" % index, "definition": "smoke-tests-basic",
+                 "result": "pass", "set": "listing"}, None))
+        self.assertFalse(results_buffer.add(
+            {"case": "bad case", "definition": "smoke-tests-basic", "result": "pass"}, None))
+        self.assertFalse(results_buffer.add(
+            {"case": "case-10", "definition": "smoke-tests-basic", "result": "broken"}, None))
+        # nothing is written before the flush
+        self.assertEqual(0, TestCase.objects.count())
+        self.assertEqual(1, TestSuite.objects.filter(job=job).count())
+        self.assertEqual(1, TestSet.objects.filter(suite__job=job).count())
+        results_buffer.flush()
+        self.assertEqual(10, TestCase.objects.filter(test_set__name='listing').count())
+        self.assertEqual(
+            ['case-%d' % index for index in range(10)],
+            list(TestCase.objects.order_by('id').values_list('name', flat=True)))
+        self.factory.cleanup()
@@ -22,7 +22,6 @@ Keep to just the response rendering functions
 """
 
 import os
-import csv
 import logging
 import simplejson
 import yaml
@@ -39,8 +38,7 @@ from lava_server.bread_crumbs import (
 )
 from django.shortcuts import get_object_or_404
 from lava_results_app.tables import ResultsTable, SuiteTable, ResultsIndexTable
-from lava_results_app.utils import StreamEcho
-from lava_results_app.dbutils import export_testcase, testcase_export_fields
+from lava_results_app.dbutils import export_testcases_csv, export_testcases_yaml
 from lava_scheduler_app.decorators import post_only
 from lava_scheduler_app.models import TestJob
 from lava_scheduler_app.tables import pklink
@@ -169,32 +167,22 @@ def testjob(request, job):
 def testjob_csv(request, job):
     job = get_object_or_404(TestJob, pk=job)
     check_request_auth(request, job)
-    response = HttpResponse(content_type='text/csv')
+    response = StreamingHttpResponse(
+        export_testcases_csv(TestCase.objects.filter(suite__job=job)),
+        content_type='text/csv')
     filename = "lava_%s.csv" % job.id
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    writer = csv.DictWriter(
-        response,
-        quoting=csv.QUOTE_ALL,
-        extrasaction='ignore',
-        fieldnames=testcase_export_fields())
-    writer.writeheader()
-    for test_suite in job.testsuite_set.all():
-        for row in test_suite.testcase_set.all():
-            writer.writerow(export_testcase(row))
     return response
 
 
 def testjob_yaml(request, job):
     job = get_object_or_404(TestJob, pk=job)
     check_request_auth(request, job)
-    response = HttpResponse(content_type='text/yaml')
+    response = StreamingHttpResponse(
+        export_testcases_yaml(TestCase.objects.filter(suite__job=job)),
+        content_type='text/yaml')
     filename = "lava_%s.yaml" % job.id
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    yaml_list = []
-    for test_suite in job.testsuite_set.all():
-        for test_case in test_suite.testcase_set.all():
-            yaml_list.append(export_testcase(test_case))
-    yaml.dump(yaml_list, response)
     return response
 
 
@@ -229,17 +217,11 @@ def suite_csv(request, job, pk):
     job = get_object_or_404(TestJob, pk=job)
     check_request_auth(request, job)
     test_suite = get_object_or_404(TestSuite, name=pk, job=job)
-    response = HttpResponse(content_type='text/csv')
+    response = StreamingHttpResponse(
+        export_testcases_csv(test_suite.testcase_set.all()),
+        content_type='text/csv')
     filename = "lava_%s.csv" % test_suite.name
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    writer = csv.DictWriter(
-        response,
-        quoting=csv.QUOTE_ALL,
-        extrasaction='ignore',
-        fieldnames=testcase_export_fields())
-    writer.writeheader()
-    for row in test_suite.testcase_set.all():
-        writer.writerow(export_testcase(row))
     return response
 
 
@@ -257,10 +239,8 @@ def suite_csv_stream(request, job, pk):
     test_suite = get_object_or_404(TestSuite, name=pk, job=job)
     check_request_auth(request, job)
 
-    pseudo_buffer = StreamEcho()
-    writer = csv.writer(pseudo_buffer)
     response = StreamingHttpResponse(
-        (writer.writerow(export_testcase(row)) for row in test_suite.test_cases.all()),
+        export_testcases_csv(test_suite.testcase_set.all()),
         content_type="text/csv")
     filename = "lava_stream_%s.csv" % test_suite.name
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
@@ -271,13 +251,11 @@ def suite_yaml(request, job, pk):
     job = get_object_or_404(TestJob, pk=job)
     check_request_auth(request, job)
     test_suite = get_object_or_404(TestSuite, name=pk, job=job)
-    response = HttpResponse(content_type='text/yaml')
+    response = StreamingHttpResponse(
+        export_testcases_yaml(test_suite.testcase_set.all()),
+        content_type='text/yaml')
     filename = "lava_%s.yaml" % test_suite.name
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    yaml_list = []
-    for test_case in test_suite.testcase_set.all():
-        yaml_list.append(export_testcase(test_case))
-    yaml.dump(yaml_list, response)
     return response
 
 
@@ -213,5 +213,8 @@ class QueryTestSuiteTable(ResultsTable):
 
     class Meta(ResultsTable.Meta):
         model = TestSuite
+        exclude = [
+            'count_pass', 'count_fail', 'count_skip', 'count_unknown',
+        ]
         attrs = {"class": "table table-hover", "id": "query-results-table"}
         per_page_field = "length"
@@ -21,16 +21,25 @@ import io
 import xmlrpclib
 import yaml
 
-from linaro_django_xmlrpc.models import ExposedAPI
-
-from lava_results_app.dbutils import export_testcase, testcase_export_fields
+from linaro_django_xmlrpc.models import ExposedAPI, xml_rpc_bulk
+
+from lava_results_app.dbutils import (
+    export_jobs_testcases,
+    export_rows_csv,
+    export_rows_yaml,
+    export_testcase,
+    export_testcases_csv,
+    export_testcases_yaml,
+    refresh_queries,
+    testcase_export_fields,
+)
 from lava_results_app.models import (
     Query,
-    RefreshLiveQueryError,
     TestCase,
     TestSuite,
     TestData,
 )
+from lava_scheduler_app.api import get_restricted_jobs
 from lava_scheduler_app.models import TestJob
 
 
@@ -89,6 +98,7 @@ class ResultsAPI(ExposedAPI):
         Description
         -----------
         Refreshes all queries in the system. Available only for superusers.
+        The queries that could not match any new result are skipped.
 
         Arguments
         ---------
@@ -96,7 +106,10 @@ class ResultsAPI(ExposedAPI):
 
         Return value
         ------------
-        None. The user should be authenticated with a username and token.
+        A list of structures, one per cached query, with the query name
+        (`query`), whether it was refreshed (`refreshed`), the refresh
+        duration in seconds (`duration`) and the error message (`error`).
+        The user should be authenticated with a username and token.
         """
         self._authenticate()
 
@@ -105,12 +118,24 @@ class ResultsAPI(ExposedAPI):
                 401, "Permission denied for user %s. Must be a superuser to "
                 "refresh all queries." % self.user.username)
 
-        for query in Query.objects.all():
-            try:
-                query.refresh_view()
-            except RefreshLiveQueryError:
-                pass
+        return refresh_queries(
+            Query.objects.filter(is_live=False).select_related('owner'))
+
+    def _get_testjob_results_bulk(self, calls, export):
+        self._authenticate()
+        jobs = get_restricted_jobs(self.user, [job_id for (job_id,) in calls])
+        rows = export_jobs_testcases(
+            [job.id for job in jobs if not isinstance(job, xmlrpclib.Fault)])
+        return [job if isinstance(job, xmlrpclib.Fault) else ''.join(export(rows.get(job.id, [])))
+                for job in jobs]
+
+    def _get_testjob_results_yaml_bulk(self, calls):
+        return self._get_testjob_results_bulk(calls, export_rows_yaml)
+
+    def _get_testjob_results_csv_bulk(self, calls):
+        return self._get_testjob_results_bulk(calls, export_rows_csv)
 
+    @xml_rpc_bulk('_get_testjob_results_yaml_bulk')
     def get_testjob_results_yaml(self, job_id):
         """
         Name
@@ -141,15 +166,12 @@ class ResultsAPI(ExposedAPI):
             if not job.can_view(self.user):
                 raise xmlrpclib.Fault(
                     401, "Permission denied for user to job %s" % job_id)
-            yaml_list = []
-            for test_suite in job.testsuite_set.all():
-                for test_case in test_suite.testcase_set.all():
-                    yaml_list.append(export_testcase(test_case))
+            test_cases = TestCase.objects.filter(suite__job=job)
 
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
 
-        return yaml.dump(yaml_list)
+        return ''.join(export_testcases_yaml(test_cases))
 
     def get_testjob_metadata(self, job_id):
         """
@@ -203,6 +225,7 @@ class ResultsAPI(ExposedAPI):
                 retval.append({attribute.name: attribute.value})
         return retval
 
+    @xml_rpc_bulk('_get_testjob_results_csv_bulk')
     def get_testjob_results_csv(self, job_id):
         """
         Name
@@ -233,21 +256,12 @@ class ResultsAPI(ExposedAPI):
             if not job.can_view(self.user):
                 raise xmlrpclib.Fault(
                     401, "Permission denied for user to job %s" % job_id)
-            output = io.BytesIO()
-            writer = csv.DictWriter(
-                output,
-                quoting=csv.QUOTE_ALL,
-                extrasaction='ignore',
-                fieldnames=testcase_export_fields())
-            writer.writeheader()
-            for test_suite in job.testsuite_set.all():
-                for row in test_suite.testcase_set.all():
-                    writer.writerow(export_testcase(row))
+            test_cases = TestCase.objects.filter(suite__job=job)
 
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
 
-        return output.getvalue()
+        return ''.join(export_testcases_csv(test_cases))
 
     def get_testsuite_results_yaml(self, job_id, suite_name):
         """
@@ -281,17 +295,14 @@ class ResultsAPI(ExposedAPI):
             if not job.can_view(self.user):
                 raise xmlrpclib.Fault(
                     401, "Permission denied for user to job %s" % job_id)
-            yaml_list = []
             test_suite = job.testsuite_set.get(name=suite_name)
-            for test_case in test_suite.testcase_set.all():
-                yaml_list.append(export_testcase(test_case))
 
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
         except TestSuite.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified test suite not found.")
 
-        return yaml.dump(yaml_list)
+        return ''.join(export_testcases_yaml(test_suite.testcase_set.all()))
 
     def get_testsuite_results_csv(self, job_id, suite_name):
         """
@@ -325,23 +336,14 @@ class ResultsAPI(ExposedAPI):
             if not job.can_view(self.user):
                 raise xmlrpclib.Fault(
                     401, "Permission denied for user to job %s" % job_id)
-            output = io.BytesIO()
-            writer = csv.DictWriter(
-                output,
-                quoting=csv.QUOTE_ALL,
-                extrasaction='ignore',
-                fieldnames=testcase_export_fields())
-            writer.writeheader()
             test_suite = job.testsuite_set.get(name=suite_name)
-            for row in test_suite.testcase_set.all():
-                writer.writerow(export_testcase(row))
 
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
         except TestSuite.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified test suite not found.")
 
-        return output.getvalue()
+        return ''.join(export_testcases_csv(test_suite.testcase_set.all()))
 
     def get_testcase_results_yaml(self, job_id, suite_name, case_name):
         """
@@ -5,7 +5,7 @@ from simplejson import JSONDecodeError
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.db.models import Count, Q
-from linaro_django_xmlrpc.models import ExposedAPI
+from linaro_django_xmlrpc.models import ExposedAPI, xml_rpc_bulk
 from lava_scheduler_app.models import (
     Device,
     DeviceType,
@@ -13,16 +13,20 @@ from lava_scheduler_app.models import (
     JSONDataError,
     DevicesUnavailableException,
     TestJob,
+    TestJobAccess,
     DeviceDictionary,
 )
 from lava_scheduler_app.views import (
     get_restricted_job
 )
 from lava_scheduler_app.dbutils import device_type_summary
+from lava_scheduler_app.logutils import load_job_timing, timing_summary
 from lava_scheduler_app.utils import (
     devicedictionary_to_jinja2,
+    invalidate_device_configuration,
     jinja2_to_devicedictionary,
     prepare_jinja_template,
+    render_device_configuration,
 )
 from lava_scheduler_app.schema import (
     validate_submission,
@@ -38,6 +42,43 @@ from lava_scheduler_app.dbutils import testjob_submission
 # pylint: disable=no-self-use
 
 
+def get_restricted_jobs(user, job_ids):
+    """
+    Bulk version of get_restricted_job for the XML-RPC calls: returns the
+    TestJob or the xmlrpclib.Fault of each job id, with a fixed number of
+    queries.
+    """
+    pks = []
+    sub_ids = []
+    for job_id in job_ids:
+        if '.' in str(job_id):
+            sub_ids.append(str(job_id))
+        elif str(job_id).isdigit():
+            pks.append(int(job_id))
+    access = TestJobAccess(user, TestJob.objects.filter(
+        Q(pk__in=pks) | Q(sub_id__in=sub_ids)).select_related(*TestJobAccess.RELATED))
+    by_pk = dict((str(job.id), job) for job in access.jobs)
+    by_sub_id = dict((job.sub_id, job) for job in access.jobs if job.sub_id)
+    results = []
+    for job_id in job_ids:
+        if not job_id:
+            results.append(xmlrpclib.Fault(
+                400, "Bad request: TestJob id was not specified."))
+            continue
+        if '.' in str(job_id):
+            job = by_sub_id.get(str(job_id))
+        else:
+            job = by_pk.get(str(job_id))
+        if job is None:
+            results.append(xmlrpclib.Fault(404, "Specified job not found."))
+        elif not access.can_view(job):
+            results.append(xmlrpclib.Fault(
+                401, "Permission denied for user to job %s" % job_id))
+        else:
+            results.append(job)
+    return results
+
+
 class SchedulerAPI(ExposedAPI):
 
     def submit_job(self, job_data):
@@ -265,16 +306,12 @@ class SchedulerAPI(ExposedAPI):
         [['panda01', 'panda', 'running', 164, False], ['qemu01', 'qemu', 'idle', None, True]]
         """
 
-        devices_list = []
-        for dev in Device.objects.all():
-            if not dev.is_visible_to(self.user):
-                continue
-            if dev.status == Device.RETIRED:
-                continue
-            devices_list.append(dev)
+        devices = Device.objects.visible_by_user(self.user).exclude(
+            status=Device.RETIRED).order_by('hostname').values_list(
+                'hostname', 'device_type', 'status', 'current_job', 'is_pipeline')
 
-        return [list((dev.hostname, dev.device_type.name, Device.STATUS_CHOICES[dev.status][1].lower(), dev.current_job.pk if dev.current_job else None, dev.is_pipeline))
-                for dev in devices_list]
+        return [[hostname, device_type, Device.STATUS_CHOICES[status][1].lower(), current_job, is_pipeline]
+                for (hostname, device_type, status, current_job, is_pipeline) in devices]
 
     def all_device_types(self):
         """
@@ -301,16 +338,11 @@ class SchedulerAPI(ExposedAPI):
         {'idle': 1, 'busy': 0, 'name': 'qemu', 'offline': 0}]
         """
 
-        device_type_names = []
         all_device_types = []
         keys = ['busy', 'idle', 'offline']
 
-        for dev_type in DeviceType.objects.all():
-            if not dev_type.some_devices_visible_to(self.user):
-                continue
-            device_type_names.append(dev_type.name)
-
-        device_types = device_type_summary(device_type_names)
+        device_types = device_type_summary(
+            DeviceType.objects.visible_by_user(self.user).values('name'))
 
         for dev_type in device_types:
             device_type = {'name': dev_type['device_type']}
@@ -733,6 +765,7 @@ class SchedulerAPI(ExposedAPI):
 
         return pending_jobs_by_device
 
+    @xml_rpc_bulk('_job_details_bulk')
     def job_details(self, job_id):
         """
         Name
@@ -769,17 +802,26 @@ class SchedulerAPI(ExposedAPI):
                                   "specified.")
         try:
             job = get_restricted_job(self.user, job_id)
-            job.status = job.get_status_display()
-            job.submitter_username = job.submitter.username
-            job.absolute_url = job.get_absolute_url()
         except PermissionDenied:
             raise xmlrpclib.Fault(
                 401, "Permission denied for user to job %s" % job_id)
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
 
+        return self._job_details(job)
+
+    def _job_details(self, job):
+        job.status = job.get_status_display()
+        job.submitter_username = job.submitter.username
+        job.absolute_url = job.get_absolute_url()
         return job
 
+    def _job_details_bulk(self, calls):
+        self._authenticate()
+        return [job if isinstance(job, xmlrpclib.Fault) else self._job_details(job)
+                for job in get_restricted_jobs(self.user, [job_id for (job_id,) in calls])]
+
+    @xml_rpc_bulk('_job_status_bulk')
     def job_status(self, job_id):
         """
         Name
@@ -820,6 +862,14 @@ class SchedulerAPI(ExposedAPI):
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
 
+        return self._job_status(job)
+
+    def _job_status_bulk(self, calls):
+        self._authenticate()
+        return [job if isinstance(job, xmlrpclib.Fault) else self._job_status(job)
+                for job in get_restricted_jobs(self.user, [job_id for (job_id,) in calls])]
+
+    def _job_status(self, job):
         job_status = {'job_id': job.id}
 
         if job.is_multinode:
@@ -849,6 +899,67 @@ class SchedulerAPI(ExposedAPI):
 
         return job_status
 
+    def job_timing(self, job_id):
+        """
+        Name
+        ----
+        `job_timing` (`job_id`)
+
+        Description
+        -----------
+        Get the timing of the actions of the given pipeline job.
+
+        Arguments
+        ---------
+        `job_id`: string
+            Job id for which the timing is required.
+
+        Return value
+        ------------
+        This function returns an XML-RPC structure with the following fields,
+        provided the user is authenticated with an username and token.
+
+        `pipeline`: array
+        One structure per action, sorted by level, with the `level`, `name`,
+        `duration` and `timeout` (in seconds) of the action and `critical`,
+        set when the duration is close to the timeout.
+
+        `total_duration`, `mean_duration`, `max_duration`: float
+        Statistics on the duration of the actions, in seconds.
+
+        The timing of a running job only includes the actions already
+        started.
+        """
+        self._authenticate()
+        if not job_id:
+            raise xmlrpclib.Fault(400, "Bad request: TestJob id was not "
+                                  "specified.")
+        try:
+            job = get_restricted_job(self.user, job_id)
+        except PermissionDenied:
+            raise xmlrpclib.Fault(
+                401, "Permission denied for user to job %s" % job_id)
+        except TestJob.DoesNotExist:
+            raise xmlrpclib.Fault(404, "Specified job not found.")
+
+        if not job.is_pipeline:
+            raise xmlrpclib.Fault(400, "Job %s is not a pipeline job." % job_id)
+
+        finished = job.status not in [TestJob.SUBMITTED, TestJob.RUNNING, TestJob.CANCELING]
+        try:
+            records = load_job_timing(job.output_dir, build=finished)
+        except (IOError, OSError):
+            raise xmlrpclib.Fault(404, "Job output not found.")
+        timing = timing_summary(records or [])
+        return {
+            'pipeline': [{'level': level, 'name': name, 'duration': duration,
+                          'timeout': timeout, 'critical': critical}
+                         for (level, name, duration, timeout, critical) in timing['pipeline']],
+            'total_duration': timing['total_duration'],
+            'mean_duration': timing['mean_duration'],
+            'max_duration': timing['max_duration'],
+        }
+
     def job_list_status(self, job_id_list):
         """
         Name
@@ -889,17 +1000,14 @@ class SchedulerAPI(ExposedAPI):
             raise xmlrpclib.Fault(400, "Bad request: needs to be a list")
         if not all(isinstance(chk, (float, int)) for chk in job_id_list):
             raise xmlrpclib.Fault(400, "Bad request: needs to be a list of integers or floats")
-        jobs = TestJob.objects.filter(
+        access = TestJobAccess(self.user, TestJob.objects.filter(
             Q(id__in=job_id_list) | Q(sub_id__in=job_id_list)).select_related(
-                'actual_device', 'requested_device', 'requested_device_type')
-        for job in jobs:
-            device_type = job.job_device_type()
-            if not job.can_view(self.user) or not job.is_accessible_by(self.user) and not self.user.is_superuser:
+                *TestJobAccess.RELATED))
+        for job in access.jobs:
+            if not access.can_view(job) or not access.is_accessible_by(job) and not self.user.is_superuser:
+                continue
+            if not access.device_type_visible(job.job_device_type()):
                 continue
-            if device_type.owners_only:
-                # do the more expensive check second and only for a hidden device type
-                if not device_type.some_devices_visible_to(self.user):
-                    continue
             job_status[str(job.display_id)] = job.get_status_display()
         return job_status
 
@@ -1024,8 +1132,7 @@ class SchedulerAPI(ExposedAPI):
 
         data = devicedictionary_to_jinja2(element.parameters,
                                           element.parameters['extends'])
-        template = prepare_jinja_template(device_hostname, data, system_path=True)
-        device_configuration = template.render()
+        device_configuration = render_device_configuration(device_hostname, data)
 
         # validate against the device schema
         validate_device(yaml.load(device_configuration))
@@ -1094,6 +1201,7 @@ class SchedulerAPI(ExposedAPI):
             element.hostname = hostname
         element.parameters = device_data
         element.save()
+        invalidate_device_configuration(hostname)
         msg += "Device dictionary updated for %s\n" % hostname
         device.log_admin_entry(self.user, msg)
         return msg
@@ -1213,9 +1321,8 @@ class SchedulerAPI(ExposedAPI):
                 results[key] = {'Invalid': 'Unable to convert device dictionary into jinja2'}
                 continue
             try:
-                template = prepare_jinja_template(device.hostname, data, system_path=True)
-                device_configuration = template.render()
-            except jinja2.TemplateError as exc:
+                device_configuration = render_device_configuration(device.hostname, data)
+            except (jinja2.TemplateError, yaml.YAMLError) as exc:
                 results[key] = {'Invalid': exc}
                 continue
             try:
@@ -6,13 +6,16 @@ Used to allow models.py to be shortened and easier to follow.
 # pylint: disable=wrong-import-order
 
 import os
+import copy
 import yaml
+import heapq
 import jinja2
 import datetime
 import logging
 import simplejson
-from django.db.models import Q, Case, When, IntegerField, Sum
-from django.db import IntegrityError, transaction
+from contextlib import contextmanager
+from django.db.models import Q, Case, Count, F, When, IntegerField, Sum
+from django.db import connection, IntegrityError, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from linaro_django_xmlrpc.models import AuthToken
@@ -26,6 +29,7 @@ from lava_scheduler_app.models import (
     TestJob,
     TemporaryDevice,
     validate_job,
+    Worker,
 )
 from lava_results_app.dbutils import map_metadata
 from lava_dispatcher.pipeline.device import PipelineDevice
@@ -97,6 +101,58 @@ def initiate_health_check_job(device):
     return job
 
 
+def health_check_devices():
+    """
+    Select the devices needing a health check with a handful of queries,
+    whatever the number of devices:
+     * the devices with an unknown or looping health status, without a
+       complete health check or with a time denominator, selected in SQL.
+     * the devices with a job denominator, selected with a single count
+       of the unchecked jobs grouped by device.
+    Looping is only active once a device is offline.
+    :return: the list of devices, sorted by hostname
+    """
+    logger = logging.getLogger('dispatcher-master')
+    candidates = Device.objects.filter(
+        Q(status=Device.IDLE) | Q(status=Device.OFFLINE, health_status=Device.HEALTH_LOOPING))
+    candidates = candidates.filter(device_type__disable_health_check=False)
+    candidates = candidates.select_related('device_type', 'last_health_report_job')
+
+    due = Q(health_status__in=[Device.HEALTH_UNKNOWN, Device.HEALTH_LOOPING]) | \
+        Q(last_health_report_job__isnull=True) | \
+        Q(last_health_report_job__end_time__isnull=True)
+    now = timezone.now()
+    frequencies = DeviceType.objects.filter(
+        health_denominator=DeviceType.HEALTH_PER_HOUR,
+        disable_health_check=False).values_list('health_frequency', flat=True).distinct()
+    for frequency in frequencies:
+        due |= Q(device_type__health_denominator=DeviceType.HEALTH_PER_HOUR,
+                 device_type__health_frequency=frequency,
+                 last_health_report_job__end_time__lt=now - datetime.timedelta(hours=frequency))
+    devices = list(candidates.filter(due))
+
+    per_job = list(candidates.filter(
+        device_type__health_denominator=DeviceType.HEALTH_PER_JOB,
+        last_health_report_job__end_time__isnull=False).exclude(
+            health_status__in=[Device.HEALTH_UNKNOWN, Device.HEALTH_LOOPING]))
+    if per_job:
+        counts = dict(TestJob.objects.filter(
+            actual_device__in=[device.hostname for device in per_job],
+            health_check=False,
+            id__gte=F('actual_device__last_health_report_job')).values_list(
+                'actual_device').annotate(Count('id')).order_by())
+        for device in per_job:
+            unchecked_job_count = counts.get(device.hostname, 0)
+            if unchecked_job_count > device.device_type.health_frequency:
+                logger.debug("[%s] unchecked_job_count=%s, health_frequency is every %s jobs",
+                             device.hostname, unchecked_job_count,
+                             device.device_type.health_frequency)
+                devices.append(device)
+
+    devices.sort(key=lambda device: device.hostname)
+    return devices
+
+
 def submit_health_check_jobs():
     """
     Checks which devices need a health check job and submits the needed
@@ -105,59 +161,16 @@ def submit_health_check_jobs():
     """
 
     logger = logging.getLogger('dispatcher-master')
-    for device in Device.objects.filter(
-            Q(status=Device.IDLE) | Q(status=Device.OFFLINE, health_status=Device.HEALTH_LOOPING)):
-        time_denominator = True
-        run_health_check = False
-        if device.device_type.health_denominator == DeviceType.HEALTH_PER_JOB:
-            time_denominator = False
-
-        if device.device_type.disable_health_check:
-            run_health_check = False
-        elif not device.get_health_check():
-            run_health_check = False
-        elif device.health_status == Device.HEALTH_UNKNOWN:
-            run_health_check = True
-            logger.debug("health status: %s", Device.HEALTH_CHOICES[device.health_status][1])
-        elif device.health_status == Device.HEALTH_LOOPING:
-            run_health_check = True
-            logger.debug("health status: %s", Device.HEALTH_CHOICES[device.health_status][1])
-        elif not device.last_health_report_job:
-            run_health_check = True
-            logger.debug("Empty last health report job")
-        elif not device.last_health_report_job.end_time:
-            run_health_check = True
-            logger.debug("Last health report job [%d] has no end_time", device.last_health_report_job.id)
-        else:
-            if time_denominator:
-                if not run_health_check:
-                    logger.debug("[%s] checking time since last health check", device)
-                run_health_check = device.last_health_report_job.end_time < \
-                    timezone.now() - datetime.timedelta(hours=device.device_type.health_frequency)
-                if run_health_check:
-                    logger.debug("%s needs to run_health_check", device)
-                    logger.debug("[%d] health_check_end=%s",
-                                 device.last_health_report_job.id, device.last_health_report_job.end_time)
-                    logger.debug("health_frequency is every %s hours", device.device_type.health_frequency)
-                    logger.debug("time_diff=%s", (
-                        timezone.now() - datetime.timedelta(hours=device.device_type.health_frequency)))
-            else:
-                unchecked_job_count = TestJob.objects.filter(
-                    actual_device=device, health_check=False,
-                    id__gte=device.last_health_report_job.id).count()
-                run_health_check = unchecked_job_count > device.device_type.health_frequency
-                if run_health_check:
-                    logger.debug("%s needs to run_health_check", device)
-                    logger.debug("unchecked_job_count=%s", unchecked_job_count)
-                    logger.debug("health_frequency is every %s jobs", device.device_type.health_frequency)
-
-        if run_health_check:
-            logger.debug('submit health check for %s', device.hostname)
-            try:
-                initiate_health_check_job(device)
-            except (yaml.YAMLError, JSONDataError):
-                # already logged, don't allow the daemon to fail.
-                pass
+    for device in health_check_devices():
+        if not device.get_health_check():
+            continue
+        logger.debug('submit health check for %s (health status: %s)', device.hostname,
+                     Device.HEALTH_CHOICES[device.health_status][1])
+        try:
+            initiate_health_check_job(device)
+        except (yaml.YAMLError, JSONDataError):
+            # already logged, don't allow the daemon to fail.
+            pass
 
 
 def testjob_submission(job_definition, user, check_device=None):
@@ -217,7 +230,7 @@ def testjob_submission(job_definition, user, check_device=None):
     return job
 
 
-def check_device_and_job(job, device):
+def check_device_and_job(job, device, index=None):
     """
     Once a device shows as a candidate for assignment,
     check for bad current_job/reserved states.
@@ -230,10 +243,11 @@ def check_device_and_job(job, device):
 
     :param job: The job being processed.
     :param device: the device about the be assigned to the job.
+    :param index: optional DeviceIndex caching the device checks for this tick.
     :return: the device if OK or None on error.
     """
     logger = logging.getLogger('dispatcher-master')
-    if not job.is_pipeline and device.is_exclusive:
+    if not job.is_pipeline and (index.is_exclusive(device) if index else device.is_exclusive):
         return None
     if device.current_job:
         if device.device_type != job.requested_device_type:
@@ -247,7 +261,7 @@ def check_device_and_job(job, device):
         logger.warning("Refusing to reserve %s for %s - current job is %s",
                        device, job, bad_job)
         return None
-    if job.is_pipeline and device.is_pipeline and not device.is_valid():
+    if job.is_pipeline and device.is_pipeline and not (index.is_valid(device) if index else device.is_valid()):
         # check for invalid templates from local admin changes
         logger.warning("[%d] Refusing to reserve for broken V2 device %s", job.id, device.hostname)
         return None
@@ -265,8 +279,9 @@ def find_device_for_job(job, device_list):  # pylint: disable=too-many-branches
 
     Note: with a large queue and a lot of devices, this function can be a
     source of significant delays. Uncomment the unittest.skip and run the
-    lava_scheduler_app.tests.test_submission.TestSchedulerAPI.test_queueing
+    lava_scheduler_app.tests.test_api.TestSchedulerAPI.test_queueing
     test before and after making changes here.
+    assign_jobs uses the indexed match_device_for_job instead.
     """
     if job.dynamic_connection:
         # secondary connection, the "host" has a real device
@@ -304,7 +319,7 @@ def find_device_for_job(job, device_list):  # pylint: disable=too-many-branches
                 if not device:
                     continue
                 if job.is_pipeline:
-                    job_dict = yaml.load(job.definition)
+                    job_dict = job.load_definition()
                     if 'protocols' in job_dict and 'lava-vland' in job_dict['protocols']:
                         logger.info("[%d] checking %s for vlan interface support", job.id, str(device.hostname))
                         if not match_vlan_interface(device, job_dict):
@@ -314,6 +329,187 @@ def find_device_for_job(job, device_list):  # pylint: disable=too-many-branches
     return None
 
 
+class TagBits(object):  # pylint: disable=too-few-public-methods
+    """
+    Map each Tag to a bit so that a set of tags can be stored as an integer.
+    Tags are only ever added, so the mapping is kept for the life of the
+    scheduler process.
+    """
+
+    def __init__(self):
+        self.bits = {}
+
+    def mask(self, tag_ids):
+        mask = 0
+        for tag_id in tag_ids:
+            if tag_id not in self.bits:
+                self.bits[tag_id] = 1 << len(self.bits)
+            mask |= self.bits[tag_id]
+        return mask
+
+
+class JobRequirements(object):  # pylint: disable=too-few-public-methods
+    """
+    Requirements of a queued job, computed once per job lifetime.
+    """
+
+    def __init__(self, job, tag_bits):
+        self.tag_mask = tag_bits.mask([tag.id for tag in job.tags.all()])
+        self.submitter_id = job.submitter_id
+        self.health_user = job.submitter.username == "lava-health"
+        self.group_ids = frozenset(job.submitter.groups.values_list('id', flat=True))
+        # job definition, only kept for the jobs using lava-vland
+        self.vland = None
+        if job.is_pipeline:
+            job_dict = job.load_definition()
+            if 'protocols' in job_dict and 'lava-vland' in job_dict['protocols']:
+                self.vland = job_dict
+
+    def can_submit(self, device):
+        """
+        Equivalent of Device.can_submit for an IDLE device, without any query.
+        """
+        if device.is_public or self.health_user:
+            return True
+        if device.user_id is not None:
+            return device.user_id == self.submitter_id
+        return device.group_id in self.group_ids
+
+
+class DeviceIndex(object):
+    """
+    Index of the available devices, built once per scheduler tick.
+
+    Devices are grouped by device type and, inside a device type, by the
+    bitset of their tags. The devices of each group are kept in the order
+    of get_available_devices() so that private devices are still preferred.
+    """
+
+    def __init__(self, devices, tag_bits):
+        self.order = {}
+        self.by_hostname = {}
+        self.by_type = {}
+        self.valid = {}
+        self.exclusive = {}
+        for position, device in enumerate(devices):
+            self.order[device.hostname] = position
+            self.by_hostname[device.hostname] = device
+            mask = tag_bits.mask([tag.id for tag in device.tags.all()])
+            self.by_type.setdefault(device.device_type_id, {}).setdefault(mask, []).append(device)
+
+    def __len__(self):
+        return len(self.by_hostname)
+
+    def __contains__(self, device):
+        return device.hostname in self.by_hostname
+
+    def devices(self):
+        """
+        All the devices, in the order of get_available_devices().
+        """
+        return sorted(self.by_hostname.values(),
+                      key=lambda device: self.order[device.hostname])
+
+    def remove(self, device):
+        if device not in self:
+            return
+        del self.by_hostname[device.hostname]
+        for groups in self.by_type.values():
+            for group in groups.values():
+                if device in group:
+                    group.remove(device)
+                    return
+
+    def is_valid(self, device):
+        if device.hostname not in self.valid:
+            self.valid[device.hostname] = device.is_valid()
+        return self.valid[device.hostname]
+
+    def is_exclusive(self, device):
+        if device.hostname not in self.exclusive:
+            self.exclusive[device.hostname] = device.is_exclusive
+        return self.exclusive[device.hostname]
+
+    def candidates(self, job, requirements):
+        """
+        Devices of the requested type (or the requested device) providing
+        all the tags of the job, in the order of get_available_devices().
+        """
+        groups = []
+        requested = job.requested_device
+        if requested is not None and requested.hostname in self.by_hostname:
+            groups.append([self.by_hostname[requested.hostname]])
+        if job.requested_device_type_id is not None:
+            for mask, group in self.by_type.get(job.requested_device_type_id, {}).items():
+                if requirements.tag_mask & ~mask == 0 and group:
+                    groups.append(group)
+        seen = set()
+        for device in heapq.merge(*[[(self.order[device.hostname], device) for device in group]
+                                    for group in groups]):
+            if device[1].hostname not in seen:
+                seen.add(device[1].hostname)
+                yield device[1]
+
+
+# Requirements of the queued jobs, kept between two scheduler ticks.
+_TAG_BITS = TagBits()
+_JOB_REQUIREMENTS = {}
+
+
+def get_job_requirements(job):
+    if job.id not in _JOB_REQUIREMENTS:
+        _JOB_REQUIREMENTS[job.id] = JobRequirements(job, _TAG_BITS)
+    return _JOB_REQUIREMENTS[job.id]
+
+
+def prune_job_requirements(jobs):
+    """
+    Forget about the jobs which are no longer queued.
+    """
+    queued = set(job.id for job in jobs)
+    for job_id in _JOB_REQUIREMENTS.keys():  # pylint: disable=consider-iterating-dictionary
+        if job_id not in queued:
+            del _JOB_REQUIREMENTS[job_id]
+
+
+def build_device_index(devices):
+    return DeviceIndex(devices, _TAG_BITS)
+
+
+def match_device_for_job(job, index):
+    """
+    Indexed equivalent of find_device_for_job.
+    Only the devices of the requested type with all the required tags are
+    checked, using the job requirements computed when the job was first
+    seen by the scheduler.
+    """
+    if job.dynamic_connection:
+        # secondary connection, the "host" has a real device
+        return None
+    if job.health_check is True and job.requested_device:
+        return find_device_for_job(job, [])
+    if job.is_vmgroup:
+        # deprecated and slow!
+        return find_device_for_job(job, index.devices())
+
+    logger = logging.getLogger('dispatcher-master')
+    requirements = get_job_requirements(job)
+    for device in index.candidates(job, requirements):
+        if job.is_pipeline and not device.is_pipeline:
+            continue
+        if not requirements.can_submit(device):
+            continue
+        if not check_device_and_job(job, device, index):
+            continue
+        if requirements.vland:
+            logger.info("[%d] checking %s for vlan interface support", job.id, str(device.hostname))
+            if not match_vlan_interface(device, requirements.vland):
+                logger.info("%s does not match vland tags", str(device.hostname))
+                continue
+        return device
+    return None
+
+
 def get_available_devices():
     """
     A list of idle devices, with private devices first.
@@ -334,12 +530,18 @@ def get_available_devices():
     Many-to-Many lookups, use prefetch_related for those, e.g. Tag
     as long as those are used with all() and not a filter().
 
+    The pipeline devices of the workers seen offline by the
+    dispatcher-master are skipped: jobs would wait for the worker instead of
+    using another device.
+
     :return: QuerySet of IDLE Devices with device_type, current _job
     and tags retrieved.
     """
     devices = Device.objects.filter(
         status=Device.IDLE).select_related(
             'device_type', 'current_job').order_by('is_public')
+    devices = devices.filter(Q(is_pipeline=False) | Q(worker_host=None) |
+                             Q(worker_host__state=Worker.STATE_ONLINE))
     devices = devices.prefetch_related('tags')
     return devices
 
@@ -386,7 +588,7 @@ def get_job_queue():
     jobs = TestJob.objects.filter(status=TestJob.SUBMITTED)
     jobs = jobs.filter(actual_device=None)
     jobs = jobs.select_related(
-        'requested_device', 'requested_device_type', 'actual_device')
+        'requested_device', 'requested_device_type', 'actual_device', 'submitter')
     jobs = jobs.prefetch_related('tags')
     jobs = jobs.order_by('-health_check', '-priority', 'submit_time',
                          'vm_group', 'target_group', 'id')
@@ -494,7 +696,43 @@ def _validate_non_idle_devices(reserved_devices, idle_devices):
     return errors == []
 
 
+# Key of the PostgreSQL advisory lock taken while assigning jobs
+SCHEDULER_LOCK = 0x4c415641
+
+
+@contextmanager
+def scheduler_lock():
+    """
+    Prevent concurrent calls to assign_jobs from different processes
+    (lava-scheduler and lava-master).
+    Yields False if the lock is already held by another process.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [SCHEDULER_LOCK])
+        locked = cursor.fetchone()[0]
+    try:
+        yield locked
+    finally:
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [SCHEDULER_LOCK])
+
+
 def assign_jobs():
+    """
+    Assign jobs to the available devices, unless another process is already
+    doing it.
+    :return: the list of the ids of the assigned jobs.
+    """
+    with scheduler_lock() as locked:
+        if not locked:
+            logger = logging.getLogger('dispatcher-master')
+            logger.debug("Jobs are already being assigned by another process")
+            return []
+        return _assign_jobs()
+
+
+def _assign_jobs():
     """
     Check all jobs against all available devices and assign only if all conditions are met
     This routine needs to remain fast, so has to manage local cache variables of device status but
@@ -509,6 +747,10 @@ def assign_jobs():
     Finally, the reserved device is removed from the local cache of available devices.
 
     Warnings are emitted if the device states are not as expected, before or after assignment.
+
+    The available devices are indexed once per tick (see DeviceIndex) and the requirements of each
+    queued job are only computed once (see JobRequirements), so that each job only looks at the
+    devices of the requested type providing all the required tags.
     """
     # FIXME: once scheduler daemon is disabled, implement as in share/zmq/assign.[dia|png]
     # FIXME: Make the forced health check constraint explicit
@@ -517,18 +759,21 @@ def assign_jobs():
     logger = logging.getLogger('dispatcher-master')
     _validate_queue()
     jobs = list(get_job_queue())
+    prune_job_requirements(jobs)
     if not jobs:
-        return
+        return []
     assigned_jobs = []
     reserved_devices = []
     # this takes a significant amount of time when under load, only do it once per tick
-    devices = list(get_available_devices())
+    devices = build_device_index(get_available_devices())
     logger.debug("[%d] devices available", len(devices))
     logger.debug("[%d] jobs in the queue", len(jobs))
     # a forced health check can be assigned even if the device is not in the list of idle devices.
     for job in jobs:  # pylint: disable=too-many-nested-blocks
+        if not len(devices) and not job.health_check:
+            continue
         # this needs to stay as a tight loop to cope with load
-        device = find_device_for_job(job, devices)
+        device = match_device_for_job(job, devices)
         # slower steps as assignment happens less often than the checks
         if device:
             if not _validate_idle_device(job, device) and device in devices:
@@ -569,6 +814,7 @@ def assign_jobs():
         logger.debug("All queued jobs checked, %d devices reserved and validated", len(reserved_devices))
 
     logger.info("Assigned %d jobs on %s devices", len(assigned_jobs), len(reserved_devices))
+    return assigned_jobs
 
 
 def create_job(job, device):
@@ -616,7 +862,8 @@ def fail_job(job, fail_msg=None, job_status=TestJob.INCOMPLETE):
         return
     for failed_job in job.sub_jobs_list:
         if job == failed_job:
-            end_job(failed_job, fail_msg=fail_msg, job_status=job_status)
+            # keep the attributes set by the caller
+            end_job(job, fail_msg=fail_msg, job_status=job_status)
         else:
             end_job(failed_job, fail_msg=fail_msg, job_status=TestJob.CANCELING)
 
@@ -739,7 +986,7 @@ def select_device(job, dispatchers):  # pylint: disable=too-many-return-statemen
         devices = {}
         for multinode_job in job.sub_jobs_list:
             # build a list of all devices in this group
-            definition = yaml.load(multinode_job.definition)
+            definition = multinode_job.load_definition()
             # devices are not necessarily assigned to all jobs in a group at the same time
             # check all jobs in this multinode group before allowing any to start.
             if multinode_job.dynamic_connection:
@@ -751,13 +998,13 @@ def select_device(job, dispatchers):  # pylint: disable=too-many-return-statemen
             devices[str(multinode_job.actual_device.hostname)] = definition['protocols']['lava-multinode']['role']
         for multinode_job in job.sub_jobs_list:
             # apply the complete list to all jobs in this group
-            definition = yaml.load(multinode_job.definition)
+            definition = copy.deepcopy(multinode_job.load_definition())
             definition['protocols']['lava-multinode']['roles'] = devices
             multinode_job.definition = yaml.dump(definition)
             multinode_job.save()
 
     # Load job definition to get the variables for template rendering
-    job_def = yaml.load(job.definition)
+    job_def = job.load_definition()
     job_ctx = job_def.get('context', {})
     device = None
     if not job.dynamic_connection:
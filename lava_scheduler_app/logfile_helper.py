@@ -4,58 +4,84 @@ import re
 # pylint: disable=invalid-name,old-style-class,no-init
 
 
+ERROR_TYPES = ["Infrastructure Error:",
+               "Bootloader Error:",
+               "Kernel Error:",
+               "Userspace Error:",
+               "Test Shell Error:",
+               "Master Image Error:",
+               "OperationFailed:"]
+
+
+def _lineErrors(line, errors):
+    for error in ERROR_TYPES:
+        index = line.find(error)
+        if index != -1:
+            try:
+                # decode the byte sequence to
+                # check that it's already unicode.
+                line[index:].decode('utf-8')
+                errors.append(line[index:])
+            except UnicodeError:
+                # string was not unicode, encode it.
+                errors.append(line[index:].encode('utf-8'))
+
+
+LOG_PREFIX = '<LAVA_DISPATCHER>'
+ACTION_BEGIN = '[ACTION-B]'
+LEVEL_PATTERN = re.compile('....-..-.. (..:..:.. .. ([A-Z]+): .*)')
+
+
+def _lineLogMessage(line, logs):
+    # log_prefix not always start at beginning of the line
+    pos = line.find(LOG_PREFIX)
+    if pos == -1:  # log_prefix not found
+        return
+    if pos > 0:  # remove log_prefix leading characters
+        line = line[pos:-1]
+
+    line = line[len(LOG_PREFIX):].strip()
+    match = LEVEL_PATTERN.match(line)
+    if not match:
+        return
+    line = match.group(1)
+    if len(line) > 120:
+        line = line[:120] + '...'
+    if line.find(ACTION_BEGIN) != -1:
+        logs.append((match.group(2), line, "action"))
+    else:
+        logs.append((match.group(2), line, ""))
+
+
 def getDispatcherErrors(logfile):
     errors = []
-    error_types = ["Infrastructure Error:",
-                   "Bootloader Error:",
-                   "Kernel Error:",
-                   "Userspace Error:",
-                   "Test Shell Error:",
-                   "Master Image Error:",
-                   "OperationFailed:"]
-
     for line in logfile:
-        for error in error_types:
-            index = line.find(error)
-            if index != -1:
-                try:
-                    # decode the byte sequence to
-                    # check that it's already unicode.
-                    line[index:].decode('utf-8')
-                    errors.append(line[index:])
-                except UnicodeError:
-                    # string was not unicode, encode it.
-                    errors.append(line[index:].encode('utf-8'))
+        _lineErrors(line, errors)
     return list(set(errors))
 
 
 def getDispatcherLogMessages(logfile):
     logs = []
-    log_prefix = '<LAVA_DISPATCHER>'
-    action_begin = '[ACTION-B]'
-    level_pattern = re.compile('....-..-.. (..:..:.. .. ([A-Z]+): .*)')
     for line in logfile:
-        # log_prefix not always start at beginning of the line
-        pos = line.find(log_prefix)
-        if pos == -1:  # log_prefix not found
-            continue
-        if pos > 0:  # remove log_prefix leading characters
-            line = line[pos:-1]
-
-        line = line[len(log_prefix):].strip()
-        match = level_pattern.match(line)
-        if not match:
-            continue
-        line = match.group(1)
-        if len(line) > 120:
-            line = line[:120] + '...'
-        if line.find(action_begin) != -1:
-            logs.append((match.group(2), line, "action"))
-        else:
-            logs.append((match.group(2), line, ""))
+        _lineLogMessage(line, logs)
     return logs
 
 
+def scanDispatcherLog(logfile, errors=True):
+    """
+    Equivalent of getDispatcherErrors and getDispatcherLogMessages reading
+    the log file only once.
+    :return: a tuple of the errors (None unless requested) and the messages
+    """
+    job_errors = [] if errors else None
+    logs = []
+    for line in logfile:
+        if errors:
+            _lineErrors(line, job_errors)
+        _lineLogMessage(line, logs)
+    return list(set(job_errors)) if errors else None, logs
+
+
 class Sections:
     def __init__(self):
         self.sections = []
@@ -0,0 +1,798 @@
+# Copyright (C) 2017 Linaro Limited
+#
+# Author: Remi Duraffort <remi.duraffort@linaro.org>
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Log ingestion for the dispatcher-master.
+
+The logs of every running job arrive on a single PULL socket. The socket is
+drained in batches by a dedicated thread so that the ROUTER (control) socket
+of the master is never starved by log traffic. Messages of a batch are
+grouped by job, written with one flush per job and the "results" lines are
+handed over to a pool of result workers.
+
+Next to output.yaml, the master keeps a line-offset index (output.idx): one
+unsigned 64bit integer per line, the offset of the end of that line. Readers
+can seek directly to any line without scanning the log. When events are
+enabled, a "log" event is published for every batch of lines written for a
+job so that lava-event-stream can push the new lines to the browsers.
+
+The start and end of every action are also extracted while ingesting the
+logs and appended to timing.yaml, so that the timing of a job can be
+reported without parsing output.yaml again.
+
+The pipeline description sent along with END is saved and mapped into the
+database by a background thread, so that END is acknowledged as soon as the
+status of the job is updated. The END is then forwarded by the ingestion
+thread, after the logs already received, to the result worker of the job
+which flushes its results and sends the notifications.
+"""
+
+# pylint: disable=wrong-import-order
+
+import os
+import re
+import json
+import time
+import uuid
+import struct
+import datetime
+import tempfile
+import lzma
+import yaml
+import zmq
+import Queue
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.utils import OperationalError, InterfaceError
+from lava_scheduler_app.dbutils import parse_job_description
+from lava_scheduler_app.models import TestJob, send_job_notifications
+from lava_scheduler_app.utils import mkdir
+from lava_results_app.dbutils import (
+    create_metadata_store,
+    ResultsBuffer,
+    RESULTS_FLUSH_INTERVAL,
+    update_suite_counters,
+)
+
+# pylint: disable=no-member
+
+# Maximum number of messages read from the PULL socket in one batch
+LOG_BATCH_SIZE = 1000
+# Timeout (in milliseconds) when waiting for new log messages
+LOG_POLL_TIMEOUT = 1000
+# Close the log files of a job after this number of seconds without messages
+FD_TIMEOUT = 60
+# Number of threads mapping the results into the database
+RESULT_WORKERS = 4
+# Attempts to map a job description when the database connection is lost
+DESCRIPTION_ATTEMPTS = 3
+DESCRIPTION_RETRY_DELAY = 5
+# Line-offset index of output.yaml
+LOG_INDEX = 'output.idx'
+INDEX_ENTRY = struct.Struct('<Q')
+# Maximum size of a chunk of log read with the index
+LOG_CHUNK_LINES = 10000
+LOG_CHUNK_SIZE = 1024 * 1024
+# Start and end of the actions, extracted from the logs
+LOG_TIMING = 'timing.yaml'
+TIMING_START = re.compile(r"^start: (?P<level>[\d.]+) (?P<action>[\w_-]+) \(timeout (?P<timeout>\d+:\d+:\d+)\)$")
+TIMING_END = re.compile(r"^end: (?P<level>[\d.]+) (?P<action>[\w_-]+) \(duration (?P<duration>\d+:\d+:\d+)\)$")
+# Actions running for more than this ratio of their timeout are highlighted
+TIMING_CRITICAL = 0.85
+
+
+def sub_log_filename(output_dir, level, name):
+    return os.path.join(output_dir, "pipeline", level.split('.')[0],
+                        "%s-%s.yaml" % (level, name))
+
+
+def remove_broken_string(line):
+    # Check that the string is valid unicode.
+    # This is not needed for python3.
+    try:
+        line['msg'].encode('utf-8')
+    except AttributeError:
+        pass
+    except UnicodeDecodeError:
+        line['msg'] = '<<lava: broken line>>'
+
+
+def log_index_filename(output_dir):
+    return os.path.join(output_dir, LOG_INDEX)
+
+
+def _indexed_lines(output_dir):
+    """
+    :return: the number of lines in the index and the offset of the end of
+    the last indexed line, or None if the index is missing or corrupted.
+    """
+    try:
+        with open(log_index_filename(output_dir), 'rb') as index:
+            index.seek(0, os.SEEK_END)
+            size = index.tell()
+            if size % INDEX_ENTRY.size:
+                return None
+            count = size // INDEX_ENTRY.size
+            if not count:
+                return 0, 0
+            index.seek(size - INDEX_ENTRY.size)
+            return count, INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+    except IOError:
+        return None
+
+
+def update_log_index(output_dir):
+    """
+    Build the index of output.yaml, or complete it with the lines appended
+    since the last update. Only complete lines are indexed.
+    A new index is written to a temporary file and renamed so that readers
+    never see a partial index.
+    :return: the number of lines in the index
+    raise: IOError or OSError
+    """
+    output = os.path.join(output_dir, 'output.yaml')
+    indexed = _indexed_lines(output_dir)
+    if indexed is not None and indexed[1] > os.path.getsize(output):
+        indexed = None
+    (count, offset) = indexed if indexed is not None else (0, 0)
+    entries = []
+    with open(output, 'rb') as f_in:
+        f_in.seek(offset)
+        for line in f_in:
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            entries.append(INDEX_ENTRY.pack(offset))
+    if indexed is not None:
+        if entries:
+            with open(log_index_filename(output_dir), 'ab') as index:
+                index.write(''.join(entries))
+    else:
+        (fd, tmp_name) = tempfile.mkstemp(prefix='.output.idx', dir=output_dir)
+        with os.fdopen(fd, 'wb') as index:
+            index.write(''.join(entries))
+        os.chmod(tmp_name, 0o644)
+        os.rename(tmp_name, log_index_filename(output_dir))
+    return count + len(entries)
+
+
+def read_log_chunk(output_dir, first_line, max_lines=LOG_CHUNK_LINES,
+                   max_size=LOG_CHUNK_SIZE):
+    """
+    Read a chunk of output.yaml, starting at the given line, using the index.
+    The chunk is limited to max_lines lines and, unless a single line is
+    bigger, to max_size bytes.
+    :return: None when the log is not indexed, or a tuple of the raw YAML
+    data and a boolean set when the chunk does not reach the last indexed
+    line.
+    """
+    try:
+        with open(log_index_filename(output_dir), 'rb') as index:
+            # offsets of the end of the lines first_line - 1 to
+            # first_line + max_lines, the last one telling if there is more
+            start = max(first_line - 1, 0)
+            index.seek(start * INDEX_ENTRY.size)
+            raw = index.read((max_lines + 2) * INDEX_ENTRY.size)
+    except IOError:
+        return None
+    offsets = [INDEX_ENTRY.unpack_from(raw, pos)[0]
+               for pos in range(0, len(raw) - len(raw) % INDEX_ENTRY.size,
+                                INDEX_ENTRY.size)]
+    begin = 0
+    if first_line > 0:
+        if not offsets:
+            return '', False
+        begin = offsets.pop(0)
+    if not offsets:
+        return '', False
+    lines = 1
+    while lines < min(len(offsets), max_lines) and offsets[lines] - begin <= max_size:
+        lines += 1
+    more = len(offsets) > lines
+    with open(os.path.join(output_dir, 'output.yaml'), 'rb') as f_in:
+        f_in.seek(begin)
+        return f_in.read(offsets[lines - 1] - begin), more
+
+
+def timing_filename(output_dir):
+    return os.path.join(output_dir, LOG_TIMING)
+
+
+def _seconds(value):
+    parts = value.split(":")
+    return float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
+
+
+def action_timing(line):
+    """
+    :param line: a log line, as a dictionary
+    :return: the timing record of the start or the end of an action, or
+    None for any other line.
+    """
+    # Only parse debug and info levels
+    if line.get("lvl") not in ["debug", "info"]:
+        return None
+    msg = line.get("msg")
+    # The log message could be a python object
+    if not isinstance(msg, basestring):
+        return None
+    if msg.startswith("start: "):
+        match = TIMING_START.match(msg)
+        if match is not None:
+            return {"level": match.group("level"),
+                    "action": match.group("action"),
+                    "timeout": _seconds(match.group("timeout"))}
+    elif msg.startswith("end: "):
+        match = TIMING_END.match(msg)
+        # TODO: validate does not have a proper start line
+        if match is not None and match.group("action") != "validate":
+            return {"level": match.group("level"),
+                    "action": match.group("action"),
+                    "duration": _seconds(match.group("duration"))}
+    return None
+
+
+def timing_line(record):
+    # Same format as output.yaml: one flow mapping per line
+    return "- %s\n" % json.dumps(record, sort_keys=True)
+
+
+def build_job_timing(output_dir):
+    """
+    Extract the timing records from output.yaml, for the logs written
+    before the master kept the timing.
+    The file is written to a temporary file and renamed.
+    :return: the list of timing records
+    raise: IOError or OSError
+    """
+    records = []
+    with open(os.path.join(output_dir, 'output.yaml'), 'rb') as f_in:
+        for line in f_in:
+            # Cheap filter before loading the line
+            if "start: " not in line and "end: " not in line:
+                continue
+            try:
+                data = yaml.load(line, Loader=yaml.CLoader)
+            except yaml.YAMLError:
+                continue
+            if not isinstance(data, list) or not data or not isinstance(data[0], dict):
+                continue
+            record = action_timing(data[0])
+            if record is not None:
+                records.append(record)
+    (fd, tmp_name) = tempfile.mkstemp(prefix='.timing.yaml', dir=output_dir)
+    with os.fdopen(fd, 'wb') as f_out:
+        f_out.write(''.join(timing_line(record) for record in records))
+    os.chmod(tmp_name, 0o644)
+    os.rename(tmp_name, timing_filename(output_dir))
+    return records
+
+
+def load_job_timing(output_dir, build=False):
+    """
+    Load the timing records of a job.
+    :param build: extract the records from output.yaml if the job has no
+    timing.yaml. Only set it for finished jobs, the master being the only
+    writer of the file for running jobs.
+    :return: the list of timing records or None
+    raise: IOError or OSError when build is set and the logs are missing
+    """
+    try:
+        with open(timing_filename(output_dir), 'rb') as f_in:
+            # skip a partial last line
+            data = ''.join(line for line in f_in if line.endswith('\n'))
+    except IOError:
+        if not build:
+            return None
+        return build_job_timing(output_dir)
+    return yaml.load(data, Loader=yaml.CLoader) or []
+
+
+def timing_summary(records):
+    """
+    Compute the timing report of a job from the timing records.
+    :return: a dictionary with:
+      pipeline: list of (level, name, duration, timeout, critical) for every
+      action, sorted by level
+      summary: list of [name, duration, percentage] for the top level actions
+      total_duration, mean_duration and max_duration
+    """
+    timings = {}
+    total_duration = 0
+    max_duration = 0
+    summary = []
+    for record in records:
+        level = record["level"]
+        if "timeout" in record:
+            timings[level] = {"name": record["action"],
+                              "timeout": float(record["timeout"])}
+            continue
+        if level not in timings:
+            continue
+        duration = float(record["duration"])
+        timings[level]["duration"] = duration
+        max_duration = max(max_duration, duration)
+        if '.' not in level:
+            total_duration += duration
+            summary.append([record["action"], duration, 0])
+
+    pipeline = []
+    for level in sorted(timings.keys()):
+        duration = timings[level].get("duration", 0.0)
+        timeout = timings[level]["timeout"]
+        pipeline.append((level, timings[level]["name"], duration, timeout,
+                         bool(duration >= (timeout * TIMING_CRITICAL))))
+
+    # Compute the percentage
+    for action in summary:
+        action[2] = action[1] / total_duration * 100 if total_duration else 0
+
+    return {"pipeline": pipeline,
+            "summary": summary,
+            "total_duration": total_duration,
+            "mean_duration": total_duration / len(pipeline) if pipeline else 0,
+            "max_duration": max_duration}
+
+
+class JobLogWriter(object):
+    """
+    Buffered writer for the logs of a job.
+
+    Every message is appended to output.yaml, to the line-offset index and
+    to the log file of the current action level. The start and end of the
+    actions are appended to timing.yaml. Data is only flushed when calling
+    flush(), once per batch of messages.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        mkdir(output_dir)
+        self.output = open(os.path.join(output_dir, 'output.yaml'), 'a+')
+        self.output.seek(0, os.SEEK_END)
+        self.size = self.output.tell()
+        # index the lines written before a restart of the master
+        self.lines = update_log_index(output_dir)
+        self.index = open(log_index_filename(output_dir), 'ab')
+        # extract the timing of the logs written by an older master
+        if self.lines and not os.path.exists(timing_filename(output_dir)):
+            build_job_timing(output_dir)
+        self.timing = open(timing_filename(output_dir), 'ab')
+        self.current_level = None
+        self.sub_log = None
+        self.last_usage = time.time()
+
+    def switch(self, level, name):
+        if level == self.current_level:
+            return
+        if self.sub_log is not None:
+            self.sub_log.close()
+        filename = sub_log_filename(self.output_dir, level, name)
+        mkdir(os.path.dirname(filename))
+        self.sub_log = open(filename, 'a+')
+        self.current_level = level
+
+    def write(self, level, name, message, scanned=None):
+        self.switch(level, name)
+        # The format is a list of dictionaries
+        line = "- %s\n" % message
+        self.output.write(line)
+        self.size += len(line)
+        self.lines += 1
+        self.index.write(INDEX_ENTRY.pack(self.size))
+        self.sub_log.write(line)
+        if scanned is not None:
+            record = action_timing(scanned)
+            if record is not None:
+                self.timing.write(timing_line(record))
+
+    def flush(self):
+        # the index should never reference data that is not yet written
+        self.output.flush()
+        self.index.flush()
+        self.timing.flush()
+        if self.sub_log is not None:
+            self.sub_log.flush()
+        self.last_usage = time.time()
+
+    def close(self):
+        self.output.close()
+        self.index.close()
+        self.timing.close()
+        if self.sub_log is not None:
+            self.sub_log.close()
+
+
+class ResultWorkers(object):
+    """
+    Pool of threads mapping the "results" log lines into the database.
+
+    The results of a given job are always handled by the same thread, in
+    the order they were received, so that test sets and the "lava" suite
+    are handled exactly as if the results were mapped sequentially. Each
+    thread keeps a ResultsBuffer per job, flushed on size or time
+    thresholds and when the job ends.
+    """
+
+    def __init__(self, logger, count=RESULT_WORKERS):
+        self.logger = logger
+        self.queues = [Queue.Queue() for _ in range(count)]
+        self.threads = [threading.Thread(target=self._run, args=(queue,),
+                                         name="results-%d" % index)
+                        for index, queue in enumerate(self.queues)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _queue(self, job_id):
+        return self.queues[job_id % len(self.queues)]
+
+    def put(self, job_id, level, results, message):
+        self._queue(job_id).put((job_id, level, results, message))
+
+    def end(self, job_id, old_status):
+        """
+        Flush the pending results of the given job, then send the
+        notifications deferred when the job ended.
+        :param old_status: the status of the job before END
+        """
+        self._queue(job_id).put((job_id, None, None, old_status))
+
+    def _run(self, queue):
+        buffers = {}
+        while True:
+            try:
+                item = queue.get(timeout=RESULTS_FLUSH_INTERVAL)
+            except Queue.Empty:
+                item = False
+            if item is None:
+                break
+            try:
+                if item:
+                    self.handle(buffers, *item)
+                self.flush(buffers)
+            except (OperationalError, InterfaceError):
+                self.logger.info("[RESET] database connection reset.")
+                connection.close()
+            except Exception as exc:  # pylint: disable=broad-except
+                # do not let a bad result kill the worker.
+                self.logger.exception(exc)
+        for job_id in buffers.keys():  # pylint: disable=consider-iterating-dictionary
+            self.flush(buffers, job_id)
+        connection.close()
+
+    def flush(self, buffers, job_id=None):
+        """
+        Flush the given job or the buffers that reached a threshold.
+        Buffers without new results for FD_TIMEOUT are released.
+        """
+        if job_id is not None:
+            buffers.pop(job_id).flush()
+            return
+        now = time.time()
+        for job_id in buffers.keys():  # pylint: disable=consider-iterating-dictionary
+            if buffers[job_id].needs_flush():
+                buffers[job_id].flush()
+            if now - buffers[job_id].last_usage > FD_TIMEOUT:
+                buffers.pop(job_id).flush()
+
+    def handle(self, buffers, job_id, level, results, message):
+        if level is None:
+            # END of the job, message is the status before END
+            if job_id in buffers:
+                self.flush(buffers, job_id)
+            update_suite_counters(job_id)
+            try:
+                job = TestJob.objects.get(pk=job_id)
+            except TestJob.DoesNotExist:
+                self.logger.error("[%s] Unknown job id", job_id)
+                return
+            if job.is_pipeline:
+                send_job_notifications(job, message)
+            return
+        if job_id not in buffers:
+            try:
+                job = TestJob.objects.get(pk=job_id)
+            except TestJob.DoesNotExist:
+                self.logger.error("[%s] Unknown job id", job_id)
+                return
+            buffers[job_id] = ResultsBuffer(job)
+        results_buffer = buffers[job_id]
+        meta_filename = create_metadata_store(results, results_buffer.job, level)
+        if not results_buffer.add(results, meta_filename):
+            self.logger.warning("[%s] Unable to map scanned results: %s",
+                                job_id, message)
+
+
+class DescriptionWorker(threading.Thread):
+    """
+    Save the pipeline description received with END to description.yaml and
+    map it into the database (job metadata and action data).
+
+    Each description is mapped in a single transaction, retried when the
+    database connection is lost.
+    """
+
+    retry_delay = DESCRIPTION_RETRY_DELAY
+
+    def __init__(self, logger):
+        super(DescriptionWorker, self).__init__(name="descriptions")
+        self.daemon = True
+        self.logger = logger
+        self.queue = Queue.Queue()
+
+    def put(self, job_id, description):
+        """
+        :param description: the LZMA compressed description, as sent by the
+        slave.
+        """
+        self.queue.put((job_id, description))
+
+    def stop(self):
+        """
+        Handle the pending descriptions and stop the thread.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            for attempt in range(DESCRIPTION_ATTEMPTS):
+                try:
+                    self.handle(*item)
+                    break
+                except (OperationalError, InterfaceError):
+                    self.logger.info("[RESET] database connection reset.")
+                    connection.close()
+                    if attempt + 1 < DESCRIPTION_ATTEMPTS:
+                        time.sleep(self.retry_delay)
+                except Exception as exc:  # pylint: disable=broad-except
+                    # do not let a bad description kill the worker.
+                    self.logger.exception(exc)
+                    break
+            else:
+                self.logger.error("[%d] Unable to map the description", item[0])
+        connection.close()
+
+    def handle(self, job_id, description):
+        try:
+            job = TestJob.objects.get(pk=job_id)
+        except TestJob.DoesNotExist:
+            self.logger.error("[%d] Unknown job", job_id)
+            return
+        filename = os.path.join(job.output_dir, 'description.yaml')
+        try:
+            with open(filename, 'w') as f_description:
+                f_description.write(lzma.decompress(description))
+        except (IOError, lzma.error) as exc:
+            self.logger.error("[%d] Unable to dump 'description.yaml'",
+                              job_id)
+            self.logger.exception(exc)
+        # Nothing is kept from a failed attempt
+        with transaction.atomic():
+            parse_job_description(job)
+
+
+class LogIngestion(threading.Thread):
+    """
+    Drain the PULL socket in batches and write the logs to disk.
+
+    The socket is owned by this thread once started: the main thread of the
+    dispatcher-master should only bind it.
+    """
+
+    def __init__(self, socket, results, logger, events=False):
+        super(LogIngestion, self).__init__(name="log-ingestion")
+        self.daemon = True
+        self.socket = socket
+        self.results = results
+        self.logger = logger
+        self.events = events
+        self.event_socket = None
+        self.handlers = {}
+        self.ends = Queue.Queue()
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def end(self, job_id, old_status):
+        """
+        Called by the main thread when the job ends: the results of the job
+        are flushed once the logs already received are ingested.
+        """
+        self.ends.put((job_id, old_status))
+
+    def take_ends(self):
+        ends = []
+        while True:
+            try:
+                ends.append(self.ends.get_nowait())
+            except Queue.Empty:
+                return ends
+
+    def run(self):
+        if self.events:
+            # zmq sockets can only be used by the thread that created them
+            self.event_socket = zmq.Context.instance().socket(zmq.PUSH)
+            self.event_socket.connect(settings.INTERNAL_EVENT_SOCKET)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self.stopping.is_set():
+            # Messages received before the END of a job are ingested first
+            ends = self.take_ends()
+            try:
+                if ends or poller.poll(LOG_POLL_TIMEOUT):
+                    messages = self.drain()
+                    self.ingest(messages)
+                    while ends and len(messages) == LOG_BATCH_SIZE:
+                        messages = self.drain()
+                        self.ingest(messages)
+                self.close_idle_handlers()
+            except zmq.error.ZMQError as exc:
+                self.logger.error("[LOGS] %s", exc)
+            except (OperationalError, InterfaceError):
+                self.logger.info("[RESET] database connection reset.")
+                connection.close()
+            finally:
+                for (job_id, old_status) in ends:
+                    self.results.end(job_id, old_status)
+        for (job_id, old_status) in self.take_ends():
+            self.results.end(job_id, old_status)
+        for job_id in self.handlers.keys():  # pylint: disable=consider-iterating-dictionary
+            self.close_handler(job_id)
+        if self.event_socket is not None:
+            self.event_socket.close(linger=0)
+        connection.close()
+
+    def drain(self):
+        """
+        Read at most LOG_BATCH_SIZE messages without blocking.
+        """
+        messages = []
+        while len(messages) < LOG_BATCH_SIZE:
+            try:
+                messages.append(self.socket.recv_multipart(zmq.NOBLOCK))
+            except zmq.error.Again:
+                break
+        return messages
+
+    def group(self, messages):
+        """
+        Group the valid messages by job, keeping the order of arrival.
+        :return: OrderedDict of job_id => list of (level, name, message, scanned)
+        """
+        batch = OrderedDict()
+        for msg in messages:
+            try:
+                (job_id, level, name, message) = msg  # pylint: disable=unbalanced-tuple-unpacking
+                job_id = int(job_id)
+            except ValueError:
+                # do not let a bad message stop the master.
+                self.logger.error("Failed to parse log message, skipping: %s", msg)
+                continue
+
+            try:
+                scanned = yaml.load(message, Loader=yaml.CLoader)
+            except yaml.YAMLError:
+                self.logger.error("[%s] data are not valid YAML, dropping", job_id)
+                continue
+
+            if not isinstance(scanned, dict) or 'lvl' not in scanned or 'msg' not in scanned:
+                self.logger.error(
+                    "[%s] Invalid log line, missing \"lvl\" or \"msg\" keys: %s",
+                    job_id, message)
+                continue
+
+            # Clear filename
+            if '/' in level or '/' in name:
+                self.logger.error("[%s] Wrong level or name received, dropping the message", job_id)
+                continue
+
+            batch.setdefault(job_id, []).append((level, name, message, scanned))
+        return batch
+
+    def get_handler(self, job_id):
+        if job_id in self.handlers:
+            return self.handlers[job_id]
+        # Query the database for the job
+        try:
+            job = TestJob.objects.get(id=job_id)
+        except TestJob.DoesNotExist:
+            self.logger.error("[%s] Unknown job id", job_id)
+            return None
+        self.logger.info("[%s] Receiving logs from a new job", job_id)
+        self.handlers[job_id] = JobLogWriter(job.output_dir)
+        return self.handlers[job_id]
+
+    def ingest(self, messages):
+        for job_id, lines in self.group(messages).items():
+            try:
+                handler = self.get_handler(job_id)
+                if handler is None:
+                    continue
+                for (level, name, message, scanned) in lines:
+                    if scanned["lvl"] == "results":
+                        self.results.put(job_id, level, scanned["msg"], message)
+                    # n.b. logging here would produce a log entry for every message in every job.
+                    handler.write(level, name, message, scanned)
+                handler.flush()
+            except (IOError, OSError) as exc:
+                # do not let a job stop the ingestion of the other jobs.
+                self.logger.error("[%s] Unable to write the logs: %s", job_id, exc)
+                self.drop_handler(job_id)
+                continue
+            self.send_log_event(job_id, handler.lines)
+
+    def send_log_event(self, job_id, lines):
+        """
+        Tell the subscribers that the log of this job now has this number of
+        lines, using the format of lava_scheduler_app.signals.send_event.
+        """
+        if self.event_socket is None:
+            return
+        msg = [
+            settings.EVENT_TOPIC + ".log",
+            str(uuid.uuid1()),
+            datetime.datetime.utcnow().isoformat(),
+            "lavaserver",
+            json.dumps({"job": job_id, "lines": lines})
+        ]
+        try:
+            # If lava-publisher is not running, the event is lost.
+            self.event_socket.send_multipart(msg, zmq.DONTWAIT)
+        except zmq.ZMQError:
+            pass
+
+    def close_handler(self, job_id):
+        self.handlers[job_id].close()
+        del self.handlers[job_id]
+
+    def drop_handler(self, job_id):
+        """
+        Close the writer of this job, ignoring errors. A new writer is
+        opened when the next logs of this job are received.
+        """
+        handler = self.handlers.pop(job_id, None)
+        if handler is None:
+            return
+        try:
+            handler.close()
+        except (IOError, OSError):
+            pass
+
+    def close_idle_handlers(self):
+        now = time.time()
+        for job_id in self.handlers.keys():  # pylint: disable=consider-iterating-dictionary
+            if now - self.handlers[job_id].last_usage > FD_TIMEOUT:
+                self.logger.info("[%s] Closing log file", job_id)
+                self.close_handler(job_id)
@@ -22,6 +22,48 @@ from django.db.models import Q
 from django_restricted_resource.managers import RestrictedResourceQuerySet
 
 
+def owned_by_user(user):
+    """
+    Conditions of RestrictedResource.is_owned_by for this user
+    """
+    return Q(user=user) | Q(user=None, group__in=user.groups.all())
+
+
+class RestrictedDeviceQuerySet(RestrictedResourceQuerySet):
+
+    def visible_by_user(self, user):
+        """
+        Devices visible to this user, see Device.is_visible_to. Retired
+        devices are not excluded.
+        """
+        if not user or user.is_anonymous():
+            return self.filter(device_type__owners_only=False, is_public=True)
+        # hidden device types are only visible to the owners of one device
+        # of this type
+        conditions = Q(device_type__owners_only=False) | Q(
+            device_type__in=self.model.objects.filter(
+                owned_by_user(user)).values('device_type'))
+        if user.username != "lava-health":
+            conditions &= Q(is_public=True) | owned_by_user(user)
+        return self.filter(conditions)
+
+
+class RestrictedDeviceTypeQuerySet(models.QuerySet):
+
+    def visible_by_user(self, user):
+        """
+        Device types with some devices visible to this user, see
+        DeviceType.some_devices_visible_to. The device types without
+        devices are not excluded.
+        """
+        from lava_scheduler_app.models import Device
+        if not user or user.is_anonymous():
+            return self.filter(owners_only=False)
+        return self.filter(
+            Q(owners_only=False) |
+            Q(name__in=Device.objects.filter(owned_by_user(user)).values('device_type')))
+
+
 class RestrictedTestJobQuerySet(RestrictedResourceQuerySet):
 
     def visible_by_user(self, user):
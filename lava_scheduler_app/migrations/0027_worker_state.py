@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lava_scheduler_app', '0026_devicetype_disable_health_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='worker',
+            name='last_ping',
+            field=models.DateTimeField(default=None, verbose_name='Last ping', null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='worker',
+            name='state',
+            field=models.IntegerField(default=0, help_text=b'Is the lava-slave of this worker connected to the dispatcher-master? Pipeline jobs are not scheduled on the devices of offline workers.', editable=False, choices=[(0, b'Online'), (1, b'Offline')]),
+        ),
+    ]
@@ -41,7 +41,11 @@ from django_restricted_resource.models import (
     RestrictedResource,
     RestrictedResourceManager
 )
-from lava_scheduler_app.managers import RestrictedTestJobQuerySet
+from lava_scheduler_app.managers import (
+    RestrictedDeviceQuerySet,
+    RestrictedDeviceTypeQuerySet,
+    RestrictedTestJobQuerySet,
+)
 from lava_scheduler_app.schema import (
     validate_submission,
     handle_include_option,
@@ -268,6 +272,8 @@ class DeviceType(models.Model):
     A class of device, for example a pandaboard or a snowball.
     """
 
+    objects = RestrictedDeviceTypeQuerySet.as_manager()
+
     name = models.SlugField(primary_key=True)
 
     architecture = models.ForeignKey(
@@ -475,6 +481,30 @@ class Worker(models.Model):
         editable=True
     )
 
+    STATE_ONLINE, STATE_OFFLINE = range(2)
+    STATE_CHOICES = (
+        (STATE_ONLINE, 'Online'),
+        (STATE_OFFLINE, 'Offline'),
+    )
+
+    # Written by the dispatcher-master, see Command.write_worker_states
+    state = models.IntegerField(
+        choices=STATE_CHOICES,
+        default=STATE_ONLINE,
+        editable=False,
+        help_text=("Is the lava-slave of this worker connected to the "
+                   "dispatcher-master? Pipeline jobs are not scheduled on "
+                   "the devices of offline workers.")
+    )
+
+    last_ping = models.DateTimeField(
+        verbose_name=_(u"Last ping"),
+        null=True,
+        blank=True,
+        default=None,
+        editable=False
+    )
+
     def __unicode__(self):
         return self.hostname
 
@@ -598,6 +628,9 @@ class Device(RestrictedResource):
     A device that we can run tests on.
     """
 
+    objects = RestrictedResourceManager.from_queryset(
+        RestrictedDeviceQuerySet)()
+
     OFFLINE = 0
     IDLE = 1
     RUNNING = 2
@@ -937,8 +970,8 @@ class Device(RestrictedResource):
             element.parameters,
             element.parameters['extends']
         )
-        template = utils.prepare_jinja_template(self.hostname, data, system_path=system)
-        return yaml.load(template.render(**job_ctx))
+        return utils.load_device_configuration(self.hostname, data, job_ctx,
+                                               system_path=system)
 
     @property
     def is_exclusive(self):
@@ -993,9 +1026,8 @@ class Device(RestrictedResource):
         filename = os.path.join("/etc/lava-server/dispatcher-config/health-checks",
                                 "%s.yaml" % extends)
         try:
-            with open(filename, "r") as f_in:
-                return f_in.read()
-        except IOError:
+            return utils.load_health_check(filename)
+        except (IOError, OSError):
             # TODO: will be removed in the next release
             return self.device_type.health_check_job
 
@@ -1578,6 +1610,14 @@ class TestJob(RestrictedResource):
     requested_device_type = models.ForeignKey(
         DeviceType, null=True, default=None, related_name='+', blank=True)
 
+    def load_definition(self):
+        """
+        Parsed YAML definition of a pipeline job, cached by job id and
+        definition checksum. The result is shared with the other users of
+        the cache: use copy.deepcopy before modifying it.
+        """
+        return utils.load_job_definition(self.id, self.definition)
+
     @property
     def dynamic_connection(self):
         """
@@ -1587,8 +1627,7 @@ class TestJob(RestrictedResource):
         """
         if not self.is_pipeline or not self.is_multinode or not self.definition:
             return False
-        job_data = yaml.load(self.definition)
-        return 'connection' in job_data
+        return 'connection' in self.load_definition()
 
     tags = models.ManyToManyField(Tag, blank=True)
 
@@ -1759,7 +1798,7 @@ class TestJob(RestrictedResource):
     def essential_role(self):  # pylint: disable=too-many-return-statements
         if not (self.is_multinode or self.is_vmgroup or self.is_pipeline):
             return False
-        data = yaml.load(self.definition)
+        data = self.load_definition()
         # would be nice to use reduce here but raising and catching TypeError is slower
         # than checking 'if .. in ' - most jobs will return False.
         if 'protocols' not in data:
@@ -1777,7 +1816,7 @@ class TestJob(RestrictedResource):
         if not (self.is_multinode or self.is_vmgroup):
             return "Error"
         if self.is_pipeline:
-            data = yaml.load(self.definition)
+            data = self.load_definition()
             if 'protocols' not in data:
                 return 'Error'
             if 'lava-multinode' not in data['protocols']:
@@ -2552,7 +2591,7 @@ class TestJob(RestrictedResource):
         if not self.is_multinode:
             return None
         try:
-            data = yaml.load(self.definition)
+            data = self.load_definition()
         except yaml.YAMLError:
             return None
         if 'host_role' not in data:
@@ -2650,34 +2689,23 @@ class TestJob(RestrictedResource):
     def get_passfail_results(self):
         # Get pass fail results per lava_results_app.testsuite.
         results = {}
-        from lava_results_app.models import TestCase
-        for suite in self.testsuite_set.all():
-            results[suite.name] = {
-                'pass': suite.testcase_set.filter(
-                    result=TestCase.RESULT_MAP['pass']).count(),
-                'fail': suite.testcase_set.filter(
-                    result=TestCase.RESULT_MAP['fail']).count(),
-                'skip': suite.testcase_set.filter(
-                    result=TestCase.RESULT_MAP['skip']).count(),
-                'unknown': suite.testcase_set.filter(
-                    result=TestCase.RESULT_MAP['unknown']).count()
-            }
+        from lava_results_app.models import TestSuite
+        for suite in TestSuite.objects.filter(job=self).order_by('id'):
+            results[suite.name] = suite.get_counters()
         return results
 
     def get_measurement_results(self):
         # Get measurement values per lava_results_app.testcase.
         # TODO: add min, max
-        from lava_results_app.models import TestSuite, TestCase
+        from lava_results_app.models import TestSuite
 
         results = {}
-        for suite in TestSuite.objects.filter(job=self).prefetch_related(
-                'testcase_set').annotate(
-                    test_case_avg=models.Avg('testcase__measurement')):
+        for suite in TestSuite.objects.filter(job=self).annotate(
+                test_case_avg=models.Avg('testcase__measurement')):
             if suite.name not in results:
                 results[suite.name] = {}
             results[suite.name]['measurement'] = suite.test_case_avg
-            results[suite.name]['fail'] = suite.testcase_set.filter(
-                result=TestCase.RESULT_MAP['fail']).count()
+            results[suite.name]['fail'] = suite.count_fail
 
         return results
 
@@ -2910,12 +2938,9 @@ class TestJob(RestrictedResource):
                 left_suites_count = {}
                 for suite in left_suites_intersection:
                     left_suites_count[suite.name] = (
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_PASS).count(),
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_FAIL).count(),
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_SKIP).count()
+                        suite.count_pass,
+                        suite.count_fail,
+                        suite.count_skip
                     )
 
                 right_suites_intersection = old_suites.filter(
@@ -2926,12 +2951,9 @@ class TestJob(RestrictedResource):
                 right_suites_count = {}
                 for suite in right_suites_intersection:
                     right_suites_count[suite.name] = (
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_PASS).count(),
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_FAIL).count(),
-                        suite.testcase_set.filter(
-                            result=TestCase.RESULT_SKIP).count()
+                        suite.count_pass,
+                        suite.count_fail,
+                        suite.count_skip
                     )
 
                 kwargs["query"]["left_suites_count"] = left_suites_count
@@ -2994,6 +3016,82 @@ class TestJob(RestrictedResource):
         return False
 
 
+class TestJobAccess(object):
+    """
+    TestJob.can_view and is_accessible_by for a batch of jobs, resolved with
+    a fixed number of queries instead of a few queries per job.
+    The jobs should be loaded with select_related(*TestJobAccess.RELATED).
+    """
+
+    RELATED = ('actual_device__device_type', 'requested_device__device_type',
+               'requested_device_type', 'submitter')
+
+    def __init__(self, user, jobs):
+        self.jobs = list(jobs)
+        self.superuser = user.is_superuser
+        self.user_id = None
+        self.group_ids = set()
+        if user.is_authenticated():
+            self.user_id = user.id
+            self.group_ids = set(user.groups.values_list('id', flat=True))
+        self.device_admin = self.superuser or user.has_perm('lava_scheduler_app.change_device')
+
+        # hidden device types with some devices owned by this user
+        hidden = set()
+        for job in self.jobs:
+            device_type = job.job_device_type()
+            if device_type and device_type.owners_only:
+                hidden.add(device_type.pk)
+        self.visible_types = set()
+        if hidden and self.user_id is not None:
+            self.visible_types = set(Device.objects.filter(device_type__in=hidden).filter(
+                Q(user=self.user_id) | Q(user=None, group__in=self.group_ids)).values_list(
+                    'device_type', flat=True).distinct())
+
+        # only the first viewing group matters, see TestJob.can_view
+        self.viewing_groups = {}
+        group_jobs = [job.id for job in self.jobs
+                      if job.is_pipeline and job.visibility == TestJob.VISIBLE_GROUP]
+        if group_jobs:
+            through = TestJob.viewing_groups.through
+            for (job_id, group_id) in through.objects.filter(
+                    testjob__in=group_jobs).order_by('id').values_list('testjob', 'group'):
+                self.viewing_groups.setdefault(job_id, group_id)
+
+    def is_owned_by(self, resource):
+        """
+        RestrictedResource.is_owned_by, for a job or a device
+        """
+        if resource.user_id is not None:
+            return resource.user_id == self.user_id
+        return resource.group_id in self.group_ids
+
+    def device_type_visible(self, device_type):
+        if device_type is None or not device_type.owners_only:
+            return True
+        return device_type.pk in self.visible_types
+
+    def is_accessible_by(self, job):
+        return job.is_public or self.is_owned_by(job)
+
+    def can_view(self, job):
+        # TestJob._can_admin(user, resubmit=False)
+        if self.superuser or (self.user_id is not None and job.submitter_id == self.user_id):
+            return True
+        if job.actual_device is not None:
+            if self.device_admin or self.is_owned_by(job.actual_device):
+                return True
+        if not self.device_type_visible(job.job_device_type()):
+            return False
+        if job.is_public:
+            return True
+        if not job.is_pipeline:
+            return self.is_owned_by(job)
+        if job.visibility == TestJob.VISIBLE_GROUP:
+            return self.viewing_groups.get(job.id) in self.group_ids
+        return False
+
+
 class Notification(models.Model):
 
     TEMPLATES_DIR = os.path.join(
@@ -3248,27 +3346,36 @@ class NotificationRecipient(models.Model):
                 return None
 
 
+def send_job_notifications(job, old_status):
+    """
+    Send the notifications of a pipeline job which status changed from
+    old_status to job.status.
+    """
+    notification_status = [TestJob.RUNNING, TestJob.COMPLETE,
+                           TestJob.INCOMPLETE, TestJob.CANCELED]
+    if job.status in notification_status and old_status != job.status:
+        job_def = yaml.load(job.definition)
+        if "notify" in job_def:
+            old_job = TestJob(id=job.id, status=old_status)
+            if job.notification_criteria(job_def["notify"]["criteria"],
+                                         old_job):
+                if not Notification.objects.filter(test_job_id=job.id).exists():
+                    job.create_notification(job_def["notify"])
+
+                job.send_notifications()
+
+
 @receiver(pre_save, sender=TestJob, dispatch_uid="process_notifications")
 def process_notifications(sender, **kwargs):
     new_job = kwargs["instance"]
-    notification_status = [TestJob.RUNNING, TestJob.COMPLETE,
-                           TestJob.INCOMPLETE, TestJob.CANCELED]
     # Send only for pipeline jobs.
     # If it's a new TestJob, no need to send notifications.
-    if new_job.is_pipeline and new_job.id:
+    # The dispatcher-master sends the notifications of the ended jobs once
+    # their results are mapped, see send_job_notifications.
+    if new_job.is_pipeline and new_job.id and \
+       not getattr(new_job, 'defer_notifications', False):
         old_job = TestJob.objects.get(pk=new_job.id)
-        if new_job.status in notification_status and \
-           old_job.status != new_job.status:
-            job_def = yaml.load(new_job.definition)
-            if "notify" in job_def:
-                if new_job.notification_criteria(job_def["notify"]["criteria"],
-                                                 old_job):
-                    try:
-                        old_job.notification
-                    except ObjectDoesNotExist:
-                        new_job.create_notification(job_def["notify"])
-
-                    new_job.send_notifications()
+        send_job_notifications(new_job, old_job.status)
 
 
 class TestJobUser(models.Model):
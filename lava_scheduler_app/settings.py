@@ -14,3 +14,5 @@ INTERNAL_EVENT_SOCKET = "ipc:///tmp/lava.events"
 EVENT_SOCKET = "tcp://*:5500"
 EVENT_ADDITIONAL_SOCKETS = []
 EVENT_TOPIC = "org.linaro.validation"
+# URL of lava-event-stream, as seen by the browsers, e.g. "/event-stream/"
+EVENT_STREAM_URL = None
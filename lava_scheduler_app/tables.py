@@ -546,6 +546,9 @@ class DeviceTable(LavaTable):
     {% else %}
     <a href="{{ record.worker_host.get_absolute_url }}">{{ record.worker_host }}</a>
     {% endif %}
+    {% if record.is_pipeline and record.worker_host.state == record.worker_host.STATE_OFFLINE %}
+    <span class="label label-danger">offline</span>
+    {% endif %}
     ''')
     device_type = tables.Column()
     status = ExpandedStatusColumn("status")
@@ -625,6 +628,8 @@ class WorkerTable(tables.Table):  # pylint: disable=too-few-public-methods,no-in
     ''')
 
     is_master = tables.Column()
+    state = tables.Column()
+    last_ping = tables.DateTimeColumn()
 
     class Meta(LavaTable.Meta):  # pylint: disable=too-few-public-methods,no-init,no-self-use
         model = Worker
@@ -632,7 +637,7 @@ class WorkerTable(tables.Table):  # pylint: disable=too-few-public-methods,no-in
             'rpc2_url', 'display'
         ]
         sequence = [
-            'hostname', 'description', 'is_master'
+            'hostname', 'description', 'is_master', 'state', 'last_ping'
         ]
 
 
@@ -6,8 +6,10 @@ import logging
 import cStringIO
 import xmlrpclib
 import unittest
+from django.db import connection
 from django.test import TransactionTestCase
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import Permission, User
 from django.utils import timezone
 from lava_scheduler_app.models import (
@@ -19,12 +21,16 @@ from lava_scheduler_app.models import (
     validate_yaml,
     Alias,
 )
+from lava_scheduler_app.api import SchedulerAPI
 from lava_scheduler_daemon.dbjobsource import DatabaseJobSource
+from linaro_django_xmlrpc.models import CallContext
 from lava_scheduler_app.schema import validate_submission, validate_device, SubmissionException
 from lava_scheduler_app.dbutils import (
     testjob_submission, get_job_queue,
     find_device_for_job,
     get_available_devices,
+    build_device_index,
+    match_device_for_job,
 )
 from lava_scheduler_app.tests.test_submission import ModelFactory, TestCaseWithFactory
 # pylint: disable=invalid-name
@@ -230,6 +236,96 @@ actions:
         job = TestJob.objects.get(id=job_id)
         self.assertTrue(job.is_pipeline)
 
+    def test_job_status_multicall(self):
+        user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
+        jobs = [self.factory.make_testjob(submitter=user) for _ in range(10)]
+        private = self.factory.make_testjob(submitter=self.factory.make_user())
+        private.is_public = False
+        private.save()
+        server = self.server_proxy('test', 'test')
+
+        def multicall(job_ids):
+            calls = xmlrpclib.MultiCall(server)
+            for job_id in job_ids:
+                calls.scheduler.job_status(job_id)
+            return calls().results
+
+        with CaptureQueriesContext(connection) as few:
+            multicall([job.id for job in jobs[:2]])
+        with CaptureQueriesContext(connection) as many:
+            results = multicall([job.id for job in jobs] + [private.id, 999999])
+        # the permissions are checked for all the jobs at once
+        self.assertEqual(len(few), len(many))
+        for (job, result) in zip(jobs, results):
+            self.assertEqual(result, [server.scheduler.job_status(job.id)])
+        self.assertEqual(results[-2]['faultCode'], 401)
+        self.assertEqual(results[-1]['faultCode'], 404)
+
+        with CaptureQueriesContext(connection) as few:
+            server.scheduler.job_list_status([job.id for job in jobs[:2]])
+        with CaptureQueriesContext(connection) as many:
+            status = server.scheduler.job_list_status([job.id for job in jobs] + [private.id])
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(sorted(status.keys()), sorted(str(job.id) for job in jobs))
+
+    def test_all_devices(self):
+        user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
+        other = self.factory.make_user()
+        device_type = self.factory.make_device_type('beaglebone-black')
+        hidden_type = self.factory.make_hidden_device_type('hidden')
+        other_type = self.factory.make_hidden_device_type('other-hidden')
+        self.factory.make_device(device_type=device_type, hostname='public01')
+        self.factory.make_device(device_type=device_type, hostname='private01', is_public=False, user=other)
+        self.factory.make_device(device_type=device_type, hostname='private02', is_public=False, user=user)
+        self.factory.make_device(device_type=device_type, hostname='retired01', status=Device.RETIRED)
+        self.factory.make_device(device_type=hidden_type, hostname='hidden01', user=user)
+        self.factory.make_device(device_type=hidden_type, hostname='hidden02', is_public=False, user=other)
+        self.factory.make_device(device_type=other_type, hostname='hidden03', user=other)
+
+        for (account, devices, device_types) in [
+                (None, ['public01'], ['beaglebone-black']),
+                (user, ['hidden01', 'private02', 'public01'], ['beaglebone-black', 'hidden'])]:
+            api = SchedulerAPI(CallContext(account, mapper=None, dispatcher=None))
+            with self.assertNumQueries(1):
+                all_devices = api.all_devices()
+            self.assertEqual([device[0] for device in all_devices], devices)
+            if account:
+                self.assertEqual(devices, sorted(
+                    device.hostname for device in Device.objects.exclude(status=Device.RETIRED)
+                    if device.is_visible_to(account)))
+            with self.assertNumQueries(1):
+                all_device_types = api.all_device_types()
+            self.assertEqual([device_type['name'] for device_type in all_device_types], device_types)
+
+    @unittest.skip('Developer only - timing test')
+    def test_all_devices_scale(self):
+        """
+        all_devices and all_device_types on a lab of 600 devices of 20
+        device types, a quarter of them restricted to a group of the user.
+        uses stderr to avoid buffered prints
+        """
+        device_count = 600
+        type_count = 20
+        user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
+        group = self.factory.make_group('lab')
+        user.groups.add(group)
+        device_types = [self.factory.make_device_type('type-%02d' % count) for count in range(type_count)]
+        for count in range(device_count):
+            if count % 4:
+                self.factory.make_device(device_type=device_types[count % type_count],
+                                         hostname="device-%04d" % count)
+            else:
+                self.factory.make_device(device_type=device_types[count % type_count],
+                                         hostname="device-%04d" % count, is_public=False, group=group)
+        print >> sys.stderr, timezone.now(), "%d devices created" % device_count
+        api = SchedulerAPI(CallContext(user, mapper=None, dispatcher=None))
+        for method in [api.all_devices, api.all_device_types]:
+            start = timezone.now()
+            with CaptureQueriesContext(connection) as queries:
+                method()
+            print >> sys.stderr, timezone.now(), "%s: %s, %d queries" % (
+                method.__name__, timezone.now() - start, len(queries))
+
     def test_health_determination(self):  # pylint: disable=too-many-statements
         user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
         user.user_permissions.add(
@@ -396,6 +492,102 @@ actions:
                 device_list.remove(device)
         print >> sys.stderr, timezone.now(), "end"
 
+    def test_match_device_for_job(self):
+        user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
+        other = self.factory.ensure_user('other', 'o@mail.invalid', 'other')
+        for submitter in [user, other]:
+            submitter.user_permissions.add(
+                Permission.objects.get(codename='add_testjob'))
+            submitter.save()
+        device_type = self.factory.make_device_type('beaglebone-black')
+        usb = self.factory.ensure_tag('usb')
+        sata = self.factory.ensure_tag('sata')
+        self.factory.make_device(device_type=device_type, hostname="black01")
+        self.factory.make_device(device_type=device_type, hostname="black02", tags=[usb])
+        self.factory.make_device(device_type=device_type, hostname="black03", tags=[usb, sata])
+        self.factory.make_device(device_type=device_type, hostname="black04", is_public=False, user=other)
+        self.factory.make_device(device_type=self.factory.make_device_type('wandboard'), hostname="imx6q-01")
+        definition = self.factory.make_job_json(device_type='beaglebone-black')
+        jobs = []
+        for tags in [[], [usb], [sata], [usb, sata], [usb]]:
+            job = testjob_submission(definition, user)
+            for tag in tags:
+                job.tags.add(tag)
+            jobs.append(job)
+        jobs.append(testjob_submission(definition, other))
+        device_list = list(get_available_devices())
+        index = build_device_index(device_list)
+        self.assertEqual(5, len(index))
+        for job in TestJob.objects.filter(id__in=[job.id for job in jobs]).order_by('id'):
+            device = find_device_for_job(job, device_list)
+            self.assertEqual(device, match_device_for_job(job, index))
+            if job.submitter == other:
+                self.assertEqual('black04', device.hostname)
+            if device:
+                device_list.remove(device)
+                index.remove(device)
+                self.assertNotIn(device, index)
+        self.assertEqual(device_list, index.devices())
+
+    # comment out the decorator to run this matching benchmark
+    @unittest.skip('Developer only - timing test')
+    def test_matching_scale(self):
+        """
+        Compare find_device_for_job and the indexed match_device_for_job
+        on a large queue. Adjust the sizes below, the default is a queue of
+        10,000 jobs for 1,000 devices of 10 device types, half of the jobs
+        requesting a tag.
+        uses stderr to avoid buffered prints
+        """
+        device_count = 1000
+        job_count = 10000
+        type_count = 10
+        user = self.factory.ensure_user('test', 'e@mail.invalid', 'test')
+        user.user_permissions.add(
+            Permission.objects.get(codename='add_testjob'))
+        user.save()
+        tag = self.factory.ensure_tag('usb')
+        device_types = [self.factory.make_device_type('type-%02d' % count) for count in range(type_count)]
+        for count in range(device_count):
+            self.factory.make_device(device_type=device_types[count % type_count],
+                                     hostname="device-%04d" % count,
+                                     tags=[tag] if count % 3 else [])
+        print >> sys.stderr, timezone.now(), "%d devices created" % device_count
+        template = testjob_submission(self.factory.make_job_json(device_type='type-00'), user)
+        clones = []
+        for count in range(job_count):
+            clones.append(TestJob(
+                submitter=user, user=user, definition=template.definition,
+                requested_device_type=device_types[count % type_count],
+                description=template.description, health_check=False))
+        TestJob.objects.bulk_create(clones)
+        for job in TestJob.objects.filter(id__gt=template.id)[:job_count / 2]:
+            job.tags.add(tag)
+        print >> sys.stderr, timezone.now(), "%d jobs submitted" % job_count
+        jobs = list(get_job_queue())
+        device_list = list(get_available_devices())
+        start = timezone.now()
+        for job in jobs:
+            device = find_device_for_job(job, device_list)
+            if device:
+                device_list.remove(device)
+        print >> sys.stderr, timezone.now(), "find_device_for_job: %s" % (timezone.now() - start)
+        jobs = list(get_job_queue())
+        start = timezone.now()
+        index = build_device_index(get_available_devices())
+        for job in jobs:
+            device = match_device_for_job(job, index)
+            if device:
+                index.remove(device)
+        print >> sys.stderr, timezone.now(), "match_device_for_job (first tick): %s" % (timezone.now() - start)
+        start = timezone.now()
+        index = build_device_index(get_available_devices())
+        for job in jobs:
+            device = match_device_for_job(job, index)
+            if device:
+                index.remove(device)
+        print >> sys.stderr, timezone.now(), "match_device_for_job (next ticks): %s" % (timezone.now() - start)
+
 
 class TransactionTestCaseWithFactory(TransactionTestCase):
 
@@ -4,20 +4,28 @@ import os
 import yaml
 import jinja2
 import logging
+import datetime
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.admin.models import LogEntry
+from django.utils import timezone
 from lava_scheduler_app.models import (
     Device,
     DeviceType,
     DeviceDictionary,
     JobPipeline,
+    TestJob,
+    Worker,
 )
+from lava_scheduler_app.dbutils import get_available_devices, health_check_devices
 from lava_scheduler_app.utils import (
     devicedictionary_to_jinja2,
     jinja2_to_devicedictionary,
     prepare_jinja_template,
     jinja_template_path,
     load_devicetype_template,
+    load_device_configuration,
+    render_device_configuration,
+    invalidate_device_configuration,
 )
 from lava_scheduler_app.schema import validate_device
 from django_testscenarios.ubertest import TestCase
@@ -135,6 +143,65 @@ class DeviceTest(TestCaseWithFactory):
         device.put_into_online_mode(None, None)
         self.assertEqual(device.status, Device.RETIRED, "should be retired")
 
+    def test_health_check_devices(self):
+        user = self.factory.make_user()
+        hourly = DeviceType.objects.create(name='hourly', health_frequency=24)
+        per_job = DeviceType.objects.create(name='per-job', health_frequency=2,
+                                            health_denominator=DeviceType.HEALTH_PER_JOB)
+        disabled = DeviceType.objects.create(name='disabled', disable_health_check=True)
+        now = timezone.now()
+
+        def make_device(hostname, device_type, end_time=None,
+                        health_status=Device.HEALTH_PASS, status=Device.IDLE):
+            device = Device.objects.create(hostname=hostname, device_type=device_type,
+                                           status=status, health_status=health_status)
+            if end_time is not None:
+                device.last_health_report_job = TestJob.objects.create(
+                    submitter=user, user=user, definition='', health_check=True,
+                    actual_device=device, end_time=end_time)
+                device.save()
+            return device
+
+        make_device('unknown', hourly, health_status=Device.HEALTH_UNKNOWN)
+        make_device('never', hourly)
+        make_device('recent', hourly, now - datetime.timedelta(hours=1))
+        make_device('old', hourly, now - datetime.timedelta(hours=25))
+        make_device('offline', hourly, now - datetime.timedelta(hours=25), status=Device.OFFLINE)
+        make_device('looping', hourly, now, Device.HEALTH_LOOPING, Device.OFFLINE)
+        make_device('disabled', disabled, health_status=Device.HEALTH_UNKNOWN)
+        checked = make_device('checked', per_job, now)
+        unchecked = make_device('unchecked', per_job, now)
+        TestJob.objects.create(submitter=user, user=user, definition='', actual_device=checked)
+        for _ in range(3):
+            TestJob.objects.create(submitter=user, user=user, definition='', actual_device=unchecked)
+
+        # whatever the number of devices
+        with self.assertNumQueries(4):
+            devices = health_check_devices()
+        self.assertEqual([device.hostname for device in devices],
+                         ['looping', 'never', 'old', 'unchecked', 'unknown'])
+
+    def test_offline_worker(self):
+        device_type = DeviceType.objects.create(name='offline-worker')
+        online = Worker.objects.create(hostname='online-worker')
+        offline = Worker.objects.create(hostname='offline-worker',
+                                        state=Worker.STATE_OFFLINE)
+        Device.objects.create(hostname='online-pipeline', device_type=device_type,
+                              worker_host=online, is_pipeline=True)
+        Device.objects.create(hostname='offline-pipeline', device_type=device_type,
+                              worker_host=offline, is_pipeline=True)
+        Device.objects.create(hostname='offline-v1', device_type=device_type,
+                              worker_host=offline, is_pipeline=False)
+        Device.objects.create(hostname='no-worker', device_type=device_type,
+                              is_pipeline=True)
+        self.assertEqual(
+            sorted(get_available_devices().filter(
+                device_type=device_type).values_list('hostname', flat=True)),
+            ['no-worker', 'offline-v1', 'online-pipeline'])
+        # the worker comes back
+        Worker.objects.filter(hostname='offline-worker').update(state=Worker.STATE_ONLINE)
+        self.assertIn('offline-pipeline', get_available_devices().values_list('hostname', flat=True))
+
 
 class DeviceDictionaryTest(TestCaseWithFactory):
     """
@@ -278,6 +345,47 @@ class DeviceDictionaryTest(TestCaseWithFactory):
         self.assertFalse(hasattr(device, 'hostname'))
         self.assertIn('hostname', device)
 
+    def test_device_configuration_cache(self):
+        jinja2_path = jinja_template_path(system=False)
+        device_dictionary = {
+            'connection_command': 'telnet localhost 6002',
+            'console_device': 'ttyfake1',
+            'baud_rate': 56
+        }
+        data = devicedictionary_to_jinja2(device_dictionary, 'cubietruck.jinja2')
+        template = prepare_jinja_template('cubie', data, system_path=False, path=jinja2_path)
+        rendered = render_device_configuration('cubie', data, path=jinja2_path)
+        self.assertEqual(template.render(), rendered)
+        self.assertIs(rendered, render_device_configuration('cubie', data, path=jinja2_path))
+        config = load_device_configuration('cubie', data, path=jinja2_path)
+        self.assertEqual(config, yaml.load(rendered))
+        # callers get their own copy
+        config['commands']['connect'] = 'modified'
+        self.assertEqual(
+            load_device_configuration('cubie', data, path=jinja2_path)['commands']['connect'],
+            device_dictionary['connection_command'])
+        # the job context is part of the key
+        self.assertEqual(
+            template.render(console_device='ttyS1'),
+            render_device_configuration('cubie', data, {'console_device': 'ttyS1'}, path=jinja2_path))
+        invalidate_device_configuration('cubie')
+        self.assertIsNot(rendered, render_device_configuration('cubie', data, path=jinja2_path))
+        # a new device dictionary is rendered again
+        device_dictionary['connection_command'] = 'telnet localhost 6003'
+        data = devicedictionary_to_jinja2(device_dictionary, 'cubietruck.jinja2')
+        config = load_device_configuration('cubie', data, path=jinja2_path)
+        self.assertEqual(config['commands']['connect'], 'telnet localhost 6003')
+        # rendering another device type does not invalidate this entry
+        rendered = render_device_configuration('cubie', data, path=jinja2_path)
+        panda = devicedictionary_to_jinja2(device_dictionary, 'panda.jinja2')
+        render_device_configuration('panda01', panda, path=jinja2_path)
+        self.assertIs(rendered, render_device_configuration('cubie', data, path=jinja2_path))
+        # the errors name the device
+        broken = "{% extends 'cubietruck.jinja2' %}{% if %}"
+        with self.assertRaises(jinja2.TemplateSyntaxError) as context:
+            render_device_configuration('broken', broken, path=jinja2_path)
+        self.assertEqual(context.exception.name, 'broken.jinja2')
+
     def test_jinja_postgres_loader(self):
         # path used for the device_type template
         jinja2_path = jinja_template_path(system=False)
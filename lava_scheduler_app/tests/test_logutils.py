@@ -0,0 +1,286 @@
+import os
+import yaml
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+import zmq
+from django.core import signing
+from django.db.utils import OperationalError
+from lava_scheduler_app.logutils import (
+    DescriptionWorker,
+    JobLogWriter,
+    LogIngestion,
+    ResultWorkers,
+    build_job_timing,
+    load_job_timing,
+    log_index_filename,
+    read_log_chunk,
+    sub_log_filename,
+    timing_filename,
+    timing_summary,
+    update_log_index,
+)
+from lava_scheduler_app.models import TestJob
+from lava_scheduler_app.utils import job_stream_job_id, job_stream_token
+
+# pylint: disable=invalid-name
+
+
+class FakeResults(object):  # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.items = []
+
+    def put(self, job_id, level, results, message):
+        self.items.append((job_id, level, results, message))
+
+    def end(self, job_id, old_status):
+        self.items.append((job_id, None, None, old_status))
+
+
+class LogIngestionTest(unittest.TestCase):
+
+    def setUp(self):
+        super(LogIngestionTest, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.logger = logging.getLogger('unittests')
+        self.logger.disabled = True
+
+    def tearDown(self):
+        super(LogIngestionTest, self).tearDown()
+        shutil.rmtree(self.output_dir)
+
+    def test_writer(self):
+        writer = JobLogWriter(self.output_dir)
+        writer.write('1.1', 'deploy', '{"lvl": "info", "msg": "first"}')
+        writer.write('1.1', 'deploy', '{"lvl": "info", "msg": "second"}')
+        writer.write('1.2', 'boot', '{"lvl": "info", "msg": "third"}')
+        writer.flush()
+        writer.close()
+        with open(os.path.join(self.output_dir, 'output.yaml'), 'r') as output:
+            lines = output.readlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(all(line.startswith('- {"lvl"') for line in lines))
+        with open(sub_log_filename(self.output_dir, '1.1', 'deploy'), 'r') as sub_log:
+            self.assertEqual(len(sub_log.readlines()), 2)
+        with open(sub_log_filename(self.output_dir, '1.2', 'boot'), 'r') as sub_log:
+            self.assertEqual(len(sub_log.readlines()), 1)
+
+    def test_group(self):
+        ingestion = LogIngestion(None, FakeResults(), self.logger)
+        batch = ingestion.group([
+            ['1', '1.1', 'deploy', '{"lvl": "info", "msg": "first"}'],
+            ['2', '1.1', 'deploy', '{"lvl": "info", "msg": "other job"}'],
+            ['1', '1.1', 'deploy'],
+            ['abc', '1.1', 'deploy', '{"lvl": "info", "msg": "bad id"}'],
+            ['1', '1.1', 'deploy', '{"lvl": "info"}'],
+            ['1', '1.1', 'deploy', '{"lvl": "info", "msg": [}'],
+            ['1', '../1.1', 'deploy', '{"lvl": "info", "msg": "bad level"}'],
+            ['1', '1.2', 'boot', '{"lvl": "results", "msg": {"case": "boot"}}'],
+        ])
+        self.assertEqual(batch.keys(), [1, 2])
+        self.assertEqual(len(batch[1]), 2)
+        self.assertEqual(len(batch[2]), 1)
+        self.assertEqual(batch[1][1][3]['lvl'], 'results')
+
+    def test_ingest(self):
+        results = FakeResults()
+        ingestion = LogIngestion(None, results, self.logger)
+        ingestion.handlers[1] = JobLogWriter(self.output_dir)
+        ingestion.ingest([
+            ['1', '1.1', 'deploy', '{"lvl": "info", "msg": "first"}'],
+            ['1', '1.2', 'boot', '{"lvl": "results", "msg": {"case": "boot"}}'],
+        ])
+        self.assertEqual(len(results.items), 1)
+        self.assertEqual(results.items[0][:3], (1, '1.2', {'case': 'boot'}))
+        ingestion.close_handler(1)
+        with open(os.path.join(self.output_dir, 'output.yaml'), 'r') as output:
+            self.assertEqual(len(output.readlines()), 2)
+
+    def test_ingest_write_error(self):
+        class BrokenWriter(JobLogWriter):
+            def write(self, level, name, message, scanned=None):
+                raise IOError(28, "No space left on device")
+
+        ingestion = LogIngestion(None, FakeResults(), self.logger)
+        ingestion.handlers[1] = BrokenWriter(self.output_dir)
+        ingestion.handlers[2] = JobLogWriter(os.path.join(self.output_dir, '2'))
+        ingestion.ingest([
+            ['1', '1.1', 'deploy', '{"lvl": "info", "msg": "lost"}'],
+            ['2', '1.1', 'deploy', '{"lvl": "info", "msg": "kept"}'],
+        ])
+        # the broken writer is dropped, the other jobs are not affected
+        self.assertEqual(ingestion.handlers.keys(), [2])
+        ingestion.close_handler(2)
+        with open(os.path.join(self.output_dir, '2', 'output.yaml'), 'r') as output:
+            self.assertEqual(len(output.readlines()), 1)
+
+    def test_log_index(self):
+        writer = JobLogWriter(self.output_dir)
+        for index in range(10):
+            writer.write('1.1', 'deploy', '{"lvl": "info", "msg": "line %d"}' % index)
+        writer.flush()
+        writer.close()
+        self.assertEqual(os.path.getsize(log_index_filename(self.output_dir)), 10 * 8)
+        (data, more) = read_log_chunk(self.output_dir, 0)
+        self.assertFalse(more)
+        self.assertEqual(len(yaml.load(data)), 10)
+        (data, more) = read_log_chunk(self.output_dir, 7)
+        self.assertFalse(more)
+        self.assertEqual([line['msg'] for line in yaml.load(data)],
+                         ['line 7', 'line 8', 'line 9'])
+        (data, more) = read_log_chunk(self.output_dir, 2, max_lines=3)
+        self.assertTrue(more)
+        self.assertEqual([line['msg'] for line in yaml.load(data)],
+                         ['line 2', 'line 3', 'line 4'])
+        self.assertEqual(read_log_chunk(self.output_dir, 10), ('', False))
+        self.assertEqual(read_log_chunk(self.output_dir, 20), ('', False))
+
+        # The index is completed when the writer is opened again
+        writer = JobLogWriter(self.output_dir)
+        writer.write('1.1', 'deploy', '{"lvl": "info", "msg": "line 10"}')
+        writer.close()
+        with open(os.path.join(self.output_dir, 'output.yaml'), 'a') as output:
+            output.write('- {"lvl": "info", "msg": "line 11"}\n')
+        self.assertEqual(update_log_index(self.output_dir), 12)
+        (data, _) = read_log_chunk(self.output_dir, 10)
+        self.assertEqual([line['msg'] for line in yaml.load(data)],
+                         ['line 10', 'line 11'])
+
+        # Logs without index are indexed lazily
+        os.unlink(log_index_filename(self.output_dir))
+        self.assertIsNone(read_log_chunk(self.output_dir, 0))
+        self.assertEqual(update_log_index(self.output_dir), 12)
+        (data, _) = read_log_chunk(self.output_dir, 11)
+        self.assertEqual(yaml.load(data)[0]['msg'], 'line 11')
+
+    def test_timing(self):
+        messages = [
+            ('1', 'deploy', '{"lvl": "info", "msg": "start: 1 deploy (timeout 00:01:40)"}'),
+            ('1.1', 'download', '{"lvl": "debug", "msg": "start: 1.1 download (timeout 00:00:10)"}'),
+            ('1.1', 'download', '{"lvl": "debug", "msg": {"sending": "start: 1.2"}}'),
+            ('1.1', 'download', '{"lvl": "target", "msg": "end: 1.2 fake (duration 00:00:01)"}'),
+            ('1.1', 'download', '{"lvl": "debug", "msg": "end: 1.1 download (duration 00:00:09)"}'),
+            ('1', 'deploy', '{"lvl": "info", "msg": "end: 1 deploy (duration 00:00:20)"}'),
+            ('1', 'deploy', '{"lvl": "info", "msg": "end: 1 validate (duration 00:00:01)"}'),
+            ('2', 'boot', '{"lvl": "info", "msg": "start: 2 boot (timeout 00:01:00)"}'),
+        ]
+        writer = JobLogWriter(self.output_dir)
+        for (level, name, message) in messages:
+            writer.write(level, name, message, yaml.load(message))
+        writer.flush()
+        writer.close()
+        records = load_job_timing(self.output_dir)
+        self.assertEqual(records, [
+            {'level': '1', 'action': 'deploy', 'timeout': 100.0},
+            {'level': '1.1', 'action': 'download', 'timeout': 10.0},
+            {'level': '1.1', 'action': 'download', 'duration': 9.0},
+            {'level': '1', 'action': 'deploy', 'duration': 20.0},
+            {'level': '2', 'action': 'boot', 'timeout': 60.0},
+        ])
+        timing = timing_summary(records)
+        self.assertEqual(timing['pipeline'], [
+            ('1', 'deploy', 20.0, 100.0, False),
+            ('1.1', 'download', 9.0, 10.0, True),
+            ('2', 'boot', 0.0, 60.0, False),
+        ])
+        self.assertEqual(timing['summary'], [['deploy', 20.0, 100.0]])
+        self.assertEqual(timing['total_duration'], 20.0)
+        self.assertEqual(timing['max_duration'], 20.0)
+
+        # Logs written without the timing
+        os.unlink(timing_filename(self.output_dir))
+        self.assertIsNone(load_job_timing(self.output_dir))
+        self.assertEqual(load_job_timing(self.output_dir, build=True), records)
+        self.assertEqual(load_job_timing(self.output_dir), records)
+        self.assertEqual(build_job_timing(self.output_dir), records)
+
+    def test_description_retry(self):
+        class FlakyWorker(DescriptionWorker):
+            retry_delay = 0
+
+            def __init__(self, logger, failures):
+                super(FlakyWorker, self).__init__(logger)
+                self.failures = failures
+                self.handled = []
+
+            def handle(self, job_id, description):
+                if self.failures:
+                    self.failures -= 1
+                    raise OperationalError("connection lost")
+                self.handled.append(job_id)
+
+        worker = FlakyWorker(self.logger, 2)
+        worker.start()
+        worker.put(1, '')
+        worker.put(2, '')
+        worker.stop()
+        self.assertEqual(worker.handled, [1, 2])
+
+        # Give up after DESCRIPTION_ATTEMPTS
+        worker = FlakyWorker(self.logger, 3)
+        worker.start()
+        worker.put(1, '')
+        worker.put(2, '')
+        worker.stop()
+        self.assertEqual(worker.handled, [2])
+
+    def test_results_end(self):
+        class SlowWorkers(ResultWorkers):
+            def __init__(self, logger):
+                super(SlowWorkers, self).__init__(logger, count=2)
+                self.handled = []
+
+            def handle(self, buffers, job_id, level, results, message):
+                time.sleep(0.1)
+                self.handled.append((job_id, level))
+
+            def flush(self, buffers, job_id=None):
+                pass
+
+        workers = SlowWorkers(self.logger)
+        workers.start()
+        workers.put(1, '1.1', {'case': 'first'}, '')
+        workers.put(1, '1.2', {'case': 'second'}, '')
+        # end() does not wait for the worker
+        start = time.time()
+        workers.end(1, TestJob.RUNNING)
+        self.assertLess(time.time() - start, 0.1)
+        workers.stop()
+        self.assertEqual(workers.handled, [(1, '1.1'), (1, '1.2'), (1, None)])
+
+    def test_ingestion_end(self):
+        context = zmq.Context.instance()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://test-ingestion-end')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://test-ingestion-end')
+        push.send_multipart(['1', '1.2', 'boot', '{"lvl": "results", "msg": {"case": "boot"}}'])
+        results = FakeResults()
+        ingestion = LogIngestion(pull, results, self.logger)
+        ingestion.handlers[1] = JobLogWriter(self.output_dir)
+        # the END is forwarded after the logs already received
+        ingestion.end(1, TestJob.RUNNING)
+        ingestion.start()
+        for _ in range(50):
+            if len(results.items) == 2:
+                break
+            time.sleep(0.1)
+        ingestion.stop()
+        push.close(linger=0)
+        pull.close(linger=0)
+        self.assertEqual(results.items, [
+            (1, '1.2', {'case': 'boot'}, '{"lvl": "results", "msg": {"case": "boot"}}'),
+            (1, None, None, TestJob.RUNNING),
+        ])
+
+    def test_job_stream_token(self):
+        class FakeJob(object):  # pylint: disable=too-few-public-methods
+            id = 42
+        token = job_stream_token(FakeJob())
+        self.assertEqual(job_stream_job_id(token), 42)
+        self.assertRaises(signing.BadSignature, job_stream_job_id, token[:-1])
+        self.assertRaises(signing.BadSignature, job_stream_job_id,
+                          signing.dumps(42))
@@ -8,6 +8,8 @@ from lava_scheduler_app.dbutils import (
 from lava_scheduler_app.tests.test_pipeline import YamlFactory, TestCaseWithFactory
 from lava_scheduler_app.utils import (
     jinja_template_path,
+    shard_ports,
+    worker_shard,
 )
 from lava_scheduler_app.models import (
     Device,
@@ -128,3 +130,25 @@ class MasterTest(TestCaseWithFactory):  # pylint: disable=too-many-ancestors
         selected = select_device(job, self.dispatchers)
         self.assertIsNone(selected)
         self.assertEqual(job.status, TestJob.SUBMITTED)
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_worker_shard(self):
+        hostnames = ["worker-%03d" % index for index in range(200)]
+        self.assertEqual(set([worker_shard(hostname, 1) for hostname in hostnames]), set([0]))
+        shards = dict([(hostname, worker_shard(hostname, 4)) for hostname in hostnames])
+        self.assertEqual(set(shards.values()), set(range(4)))
+        # stable
+        self.assertEqual(shards, dict([(hostname, worker_shard(hostname, 4)) for hostname in hostnames]))
+        self.assertEqual(worker_shard(u"worker-000", 4), shards["worker-000"])
+        # adding a shard only moves workers to the new shard
+        for hostname in hostnames:
+            self.assertIn(worker_shard(hostname, 5), [shards[hostname], 4])
+
+    def test_shard_ports(self):
+        self.assertEqual(shard_ports(0), (5556, 5555))
+        ports = set()
+        for shard in range(4):
+            ports.update(shard_ports(shard))
+        self.assertEqual(len(ports), 8)
@@ -23,6 +23,7 @@ from lava_scheduler_app.utils import (
     map_context_overrides,
     allowed_overrides,
     split_multinode_yaml,
+    job_definition_counters,
 )
 from lava_scheduler_app.tests.test_submission import ModelFactory, TestCaseWithFactory
 from lava_scheduler_app.dbutils import (
@@ -265,6 +266,22 @@ class TestPipelineSubmit(TestCaseWithFactory):
         job = TestJob.from_yaml_and_user(definition, self.factory.make_user())
         self.assertEqual(definition, job.definition)
 
+    def test_load_definition(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        job_definition_counters(reset=True)
+        definition = job.load_definition()
+        self.assertEqual(definition, yaml.load(job.definition))
+        self.assertIs(definition, job.load_definition())
+        self.assertEqual(job_definition_counters(), (1, 1))
+        # reading the counters does not reset them
+        self.assertEqual(job_definition_counters(reset=True), (1, 1))
+        # a modified definition is parsed again
+        job.definition = yaml.dump({'job_name': 'modified'})
+        self.assertEqual(job.load_definition(), {'job_name': 'modified'})
+        self.assertEqual(job_definition_counters(), (1, 0))
+
     def test_from_yaml_and_user_sets_submitter(self):
         user = self.factory.make_user()
         job = TestJob.from_yaml_and_user(
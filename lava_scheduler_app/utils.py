@@ -21,6 +21,7 @@ import os
 import re
 import copy
 import errno
+import hashlib
 import yaml
 import pprint
 import jinja2
@@ -30,10 +31,12 @@ import urlparse
 import subprocess
 import datetime
 import netifaces
+import threading
 
 from collections import OrderedDict
 
 from django.contrib.sites.models import Site
+from django.core import signing
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
 from lava_scheduler_app.schema import SubmissionException
@@ -493,6 +496,292 @@ def load_devicetype_template(device_type_name, system_path=True, path=None):
     return yaml.load(template.render())
 
 
+class TrackingEnvironment(jinja2.Environment):
+    """
+    Environment recording the files of the templates loaded while rendering
+    (extends, include and import), so that a rendered configuration only
+    depends on the device-type templates it actually uses.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TrackingEnvironment, self).__init__(*args, **kwargs)
+        self.used = None
+
+    def get_template(self, name, parent=None, globals=None):  # pylint: disable=redefined-builtin
+        template = super(TrackingEnvironment, self).get_template(name, parent, globals)
+        if self.used is not None and template.filename:
+            self.used.add(template.filename)
+        return template
+
+
+def _templates_mtime(filenames):
+    """
+    :return: the sorted (filename, mtime) pairs or None if a file is missing.
+    """
+    try:
+        return tuple(sorted((filename, os.path.getmtime(filename))
+                            for filename in filenames))
+    except OSError:
+        return None
+
+
+class DeviceConfigurationCache(object):  # pylint: disable=too-few-public-methods
+    """
+    Render-once cache of the device configurations.
+
+    One long-lived jinja2 environment is kept per template path, with
+    auto_reload and a bytecode cache, instead of building a new environment
+    and reparsing the device-type templates for every rendering.
+    Rendered configurations are keyed by the device dictionary version (the
+    checksum of the jinja2 string, so other processes see a new dictionary
+    without any invalidation) and the checksum of the job context. Each
+    entry is only valid while the templates used by that rendering keep
+    the same mtime.
+    """
+
+    # Maximum number of rendered configurations
+    SIZE = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.environments = {}
+        self.templates = {}
+        self.rendered = OrderedDict()
+
+    def environment(self, path):
+        if path not in self.environments:
+            try:
+                bytecode_cache = jinja2.FileSystemBytecodeCache()
+            except (RuntimeError, OSError):
+                # no usable temporary directory, templates are still cached
+                # in memory by the environment.
+                bytecode_cache = None
+            loader = jinja2.FileSystemLoader([os.path.join(path, 'device-types')])
+            self.environments[path] = TrackingEnvironment(
+                loader=loader, trim_blocks=True, auto_reload=True,
+                bytecode_cache=bytecode_cache)
+        return self.environments[path]
+
+    def template(self, path, hostname, version, jinja_data):
+        key = (path, hostname)
+        if key not in self.templates or self.templates[key][0] != version:
+            env = self.environment(path)
+            # named as the templates of the database loader, for the errors
+            name = "%s.jinja2" % hostname
+            template = env.template_class.from_code(
+                env, env.compile(jinja_data, name, name), env.make_globals(None), None)
+            self.templates[key] = (version, template)
+        return self.templates[key][1]
+
+    def render(self, hostname, jinja_data, job_ctx=None, system_path=True, path=None):
+        """
+        :return: a tuple of the rendered string and the parsed configuration.
+        The parsed configuration is shared: callers must not modify it.
+        raise: IOError, jinja2.TemplateError or yaml.YAMLError
+        """
+        if not path:
+            path = jinja_template_path(system=system_path)
+        if job_ctx is None:
+            job_ctx = {}
+        checksum = hashlib.sha1(
+            jinja_data.encode('utf-8') if isinstance(jinja_data, unicode) else jinja_data)
+        version = checksum.hexdigest()
+        context = hashlib.sha1(yaml.dump(job_ctx)).hexdigest()
+        key = (path, hostname, version, context)
+        with self.lock:
+            if key in self.rendered:
+                (mtime, value) = self.rendered.pop(key)
+                if mtime is not None and mtime == _templates_mtime(
+                        [filename for (filename, _) in mtime]):
+                    self.rendered[key] = (mtime, value)
+                    return value
+            env = self.environment(path)
+            env.used = set()
+            try:
+                rendered = self.template(path, hostname, version, jinja_data).render(**job_ctx)
+                used = env.used
+            finally:
+                env.used = None
+            value = (rendered, yaml.load(rendered))
+            self.rendered[key] = (_templates_mtime(used), value)
+            while len(self.rendered) > self.SIZE:
+                self.rendered.popitem(last=False)
+            return value
+
+    def invalidate(self, hostname=None):
+        with self.lock:
+            if hostname is None:
+                self.templates.clear()
+                self.rendered.clear()
+                return
+            for key in [key for key in self.templates if key[1] == hostname]:
+                del self.templates[key]
+            for key in [key for key in self.rendered if key[1] == hostname]:
+                del self.rendered[key]
+
+
+_DEVICE_CONFIGURATIONS = DeviceConfigurationCache()
+
+
+def render_device_configuration(hostname, jinja_data, job_ctx=None, system_path=True, path=None):
+    """
+    Render the device dictionary (as a jinja2 string) of the given device.
+    :return: the device configuration as a YAML string.
+    """
+    return _DEVICE_CONFIGURATIONS.render(hostname, jinja_data, job_ctx,
+                                         system_path, path)[0]
+
+
+def load_device_configuration(hostname, jinja_data, job_ctx=None, system_path=True, path=None):
+    """
+    Render and parse the device dictionary (as a jinja2 string) of the given
+    device. The result is a copy which can be modified by the caller.
+    """
+    return copy.deepcopy(_DEVICE_CONFIGURATIONS.render(
+        hostname, jinja_data, job_ctx, system_path, path)[1])
+
+
+def invalidate_device_configuration(hostname=None):
+    """
+    Drop the cached configurations of the given device, or of all devices.
+    """
+    _DEVICE_CONFIGURATIONS.invalidate(hostname)
+
+
+class JobDefinitionCache(object):
+    """
+    Bounded LRU cache of the parsed job definitions.
+
+    Definitions are keyed by job id and by the checksum of the definition so
+    that a modified definition (e.g. the multinode roles) is parsed again.
+    The counters record how many YAML parses were done or avoided.
+    """
+
+    # Maximum number of parsed definitions
+    SIZE = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = OrderedDict()
+        self.parsed = 0
+        self.avoided = 0
+
+    def get(self, job_id, definition):
+        """
+        :return: the parsed definition, shared: callers must not modify it.
+        raise: yaml.YAMLError
+        """
+        key = (job_id, hashlib.sha1(
+            definition.encode('utf-8') if isinstance(definition, unicode) else definition).digest())
+        with self.lock:
+            if key in self.definitions:
+                self.avoided += 1
+                value = self.definitions.pop(key)
+                self.definitions[key] = value
+                return value
+        value = yaml.load(definition)
+        with self.lock:
+            self.parsed += 1
+            self.definitions[key] = value
+            while len(self.definitions) > self.SIZE:
+                self.definitions.popitem(last=False)
+        return value
+
+    def counters(self, reset=False):
+        with self.lock:
+            counters = (self.parsed, self.avoided)
+            if reset:
+                self.parsed = 0
+                self.avoided = 0
+        return counters
+
+
+_JOB_DEFINITIONS = JobDefinitionCache()
+
+
+def load_job_definition(job_id, definition):
+    """
+    Parse the YAML definition of the given job, only once per definition.
+    The result is shared: use copy.deepcopy before modifying it.
+    """
+    return _JOB_DEFINITIONS.get(job_id, definition)
+
+
+def job_definition_counters(reset=False):
+    """
+    :return: a tuple with the number of definitions parsed and the number of
+    parses avoided since the last reset.
+    """
+    return _JOB_DEFINITIONS.counters(reset)
+
+
+class HealthCheckCache(object):
+    """
+    Content of the health-check definitions, keyed by filename. A file is
+    only read again when its modification time or its size changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = {}
+
+    def get(self, filename):
+        """
+        raise: IOError or OSError
+        """
+        stat = os.stat(filename)
+        version = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            cached = self.definitions.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(filename, "r") as f_in:
+            data = f_in.read()
+        with self.lock:
+            self.definitions[filename] = (version, data)
+        return data
+
+
+_HEALTH_CHECKS = HealthCheckCache()
+
+
+def load_health_check(filename):
+    """
+    :return: the content of the given health-check definition
+    raise: IOError or OSError
+    """
+    return _HEALTH_CHECKS.get(filename)
+
+
+# Default ports of the dispatcher-master sockets, shifted for each shard
+MASTER_PORT = 5556
+LOG_PORT = 5555
+
+
+def shard_ports(shard):
+    """
+    :return: the default ports of the master and log sockets of the given
+    dispatcher-master shard.
+    """
+    return MASTER_PORT + 2 * shard, LOG_PORT + 2 * shard
+
+
+def worker_shard(hostname, shards):
+    """
+    Shard of the dispatcher-master handling the given worker.
+
+    Uses rendezvous hashing: every worker always maps to the same shard and
+    adding a shard only moves the workers that now map to the new shard.
+    :param shards: number of dispatcher-master processes
+    :return: the shard number, from 0 to shards - 1
+    """
+    if shards <= 1:
+        return 0
+    return max(range(shards),
+               key=lambda shard: hashlib.sha1(
+                   ("%s:%d" % (hostname, shard)).encode('utf-8')).hexdigest())
+
+
 def _read_log(log_path):
     logger = logging.getLogger('lava_scheduler_app')
     if not os.path.exists(log_path):
@@ -848,3 +1137,24 @@ def device_dictionary_vlan():
         'mac_addr',
         'sysfs',
     ]
+
+
+# Browsers have this time to subscribe to the event stream of a job
+JOB_STREAM_TOKEN_AGE = 24 * 60 * 60
+JOB_STREAM_SALT = 'lava-event-stream'
+
+
+def job_stream_token(job):
+    """
+    Signed token allowing the owner of the job page to subscribe to the
+    events of this job without querying the database for permissions.
+    """
+    return signing.dumps(job.id, salt=JOB_STREAM_SALT)
+
+
+def job_stream_job_id(token):
+    """
+    :return: the job id of a token from job_stream_token
+    raise: signing.BadSignature (including signing.SignatureExpired)
+    """
+    return int(signing.loads(token, salt=JOB_STREAM_SALT, max_age=JOB_STREAM_TOKEN_AGE))
@@ -9,7 +9,6 @@ import simplejson
 import StringIO
 import datetime
 import urllib2
-import re
 import sys
 
 from django import forms
@@ -48,8 +47,15 @@ from lava_server.bread_crumbs import (
 from lava_scheduler_app.decorators import post_only
 from lava_scheduler_app.logfile_helper import (
     formatLogFile,
-    getDispatcherErrors,
-    getDispatcherLogMessages
+    getDispatcherLogMessages,
+    scanDispatcherLog,
+)
+from lava_scheduler_app.logutils import (
+    load_job_timing,
+    read_log_chunk,
+    remove_broken_string,
+    timing_summary,
+    update_log_index,
 )
 from lava_scheduler_app.models import (
     Device,
@@ -1300,17 +1306,6 @@ def _prepare_template(request):
     return job_template
 
 
-def remove_broken_string(line):
-    # Check that the string is valid unicode.
-    # This is not needed for python3.
-    try:
-        line['msg'].encode('utf-8')
-    except AttributeError:
-        pass
-    except UnicodeDecodeError:
-        line['msg'] = '<<lava: broken line>>'
-
-
 @BreadCrumb("Job", parent=index, needs=['pk'])
 def job_detail(request, pk):
     job = get_restricted_job(request.user, pk)
@@ -1367,19 +1362,18 @@ def job_detail(request, pk):
                     default_section = 'deploy'
                     log_data = utils.folded_logs(job, default_section, sections, summary=True)
         else:
+            # The log itself is loaded by the browser, chunk by chunk, from
+            # job_log_pipeline_incremental.
             template = "lava_scheduler_app/job_pipeline.html"
-            try:
-                with open(os.path.join(job.output_dir, "output.yaml"), "r") as f_in:
-                    log_data = yaml.load(f_in, Loader=yaml.CLoader)
-
-                    if sys.version_info < (3, 0):
-                        for line in log_data:
-                            remove_broken_string(line)
-
-            except IOError:
-                log_data = []
-            except yaml.YAMLError:
-                log_data = None
+            log_data = []
+            # Push the new lines and the status of running jobs, polling is
+            # the fallback.
+            if settings.EVENT_NOTIFICATION and settings.EVENT_STREAM_URL and \
+                    job.status <= TestJob.RUNNING:
+                data.update({
+                    'event_stream_url': settings.EVENT_STREAM_URL,
+                    'event_stream_token': utils.job_stream_token(job),
+                })
 
         data.update({
             'device_data': description.get('device', {}),
@@ -1389,7 +1383,6 @@ def job_detail(request, pk):
             'boot_list': boot_list,
             'test_list': test_list,
             'log_data': log_data if log_data else [],
-            'invalid_log_data': log_data is None,
             'job_tags': job.tags.all(),
             'default_section': default_section,
         })
@@ -1415,27 +1408,35 @@ def job_detail(request, pk):
                 template = loader.get_template("lava_scheduler_app/job_pipeline.html")
             return HttpResponse(template.render(data, request=request))
 
-        if not job.failure_comment:
-            job_errors = getDispatcherErrors(job.output_file())
-            if len(job_errors) > 0:
+        if job.is_pipeline:
+            # The V1 errors and messages are not used for pipeline jobs
+            data.update({
+                'job_file_present': True,
+                'job_file_size': job_file_size,
+            })
+        else:
+            # Read the log file only once
+            with job.output_file() as log_file:
+                job_errors, job_log_messages = scanDispatcherLog(
+                    log_file, errors=not job.failure_comment)
+            if job_errors:
                 msg = job_errors[-1]
                 if msg != "ErrorMessage: None":
                     job.failure_comment = msg
                     job.save()
 
-        job_log_messages = getDispatcherLogMessages(job.output_file())
-        levels = defaultdict(int)
-        for kl in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
-            levels[kl] = 0
-        for level, msg, _ in job_log_messages:
-            levels[level] += 1
-        levels = sorted(levels.items(), key=lambda (k, v): logging._levelNames.get(k))
-        data.update({
-            'job_file_present': True,
-            'job_log_messages': job_log_messages,
-            'levels': levels,
-            'job_file_size': job_file_size,
-        })
+            levels = defaultdict(int)
+            for kl in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+                levels[kl] = 0
+            for level, msg, _ in job_log_messages:
+                levels[level] += 1
+            levels = sorted(levels.items(), key=lambda (k, v): logging._levelNames.get(k))
+            data.update({
+                'job_file_present': True,
+                'job_log_messages': job_log_messages,
+                'levels': levels,
+                'job_file_size': job_file_size,
+            })
     else:
         data.update({
             'job_file_present': False,
@@ -1753,81 +1754,23 @@ def job_pipeline_sections(request, pk):
 
 def job_pipeline_timing(request, pk):
     job = get_restricted_job(request.user, pk)
+    # The timing is extracted by the master while ingesting the logs. The
+    # timing of older logs is extracted once the job is finished.
+    finished = job.status not in [TestJob.SUBMITTED, TestJob.RUNNING, TestJob.CANCELING]
     try:
-        logs = yaml.load(open(os.path.join(job.output_dir, "output.yaml")))
-    except IOError:
+        records = load_job_timing(job.output_dir, build=finished)
+    except (IOError, OSError):
         raise Http404
-
-    # start and end patterns
-    pattern_start = re.compile("^start: (?P<level>[\\d.]+) (?P<action>[\\w_-]+) \\(timeout (?P<timeout>\\d+:\\d+:\\d+)\\)$")
-    pattern_end = re.compile('^end: (?P<level>[\\d.]+) (?P<action>[\\w_-]+) \\(duration (?P<duration>\\d+:\\d+:\\d+)\\)$')
-
-    timings = {}
-    total_duration = 0
-    max_duration = 0
-    summary = []
-    for line in logs:
-        # Only parse debug and info levels
-        if line["lvl"] not in ["debug", "info"]:
-            continue
-
-        # Will raise if the log message is a python object
-        try:
-            match = pattern_start.match(line["msg"])
-        except TypeError:
-            continue
-
-        if match is not None:
-            d = match.groupdict()
-            parts = d["timeout"].split(":")
-            timeout = float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
-            timings[d["level"]] = {"name": d["action"],
-                                   "timeout": float(timeout)}
-            continue
-
-        # No need to catch TypeError here as we know it's a string
-        match = pattern_end.match(line["msg"])
-        if match is not None:
-            d = match.groupdict()
-            # TODO: validate does not have a proper start line
-            if d["action"] == "validate":
-                continue
-            level = d["level"]
-            parts = d["duration"].split(":")
-            duration = float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
-            timings[level]["duration"] = duration
-
-            max_duration = max(max_duration, duration)
-            if '.' not in level:
-                total_duration += duration
-                summary.append([d["action"], duration, 0])
-
-    levels = timings.keys()
-    levels.sort()
-
-    # Construct the report
-    pipeline = []
-    for lvl in levels:
-        duration = timings[lvl].get("duration", 0.0)
-        timeout = timings[lvl]["timeout"]
-        pipeline.append((lvl, timings[lvl]["name"], duration, timeout,
-                         bool(duration >= (timeout * 0.85))))
-
-    # Compute the percentage
-    for index, action in enumerate(summary):
-        summary[index][2] = action[1] / total_duration * 100
+    timing = timing_summary(records or [])
+    pipeline = timing['pipeline']
 
     if len(pipeline) == 0:
         response_dict = {'timing': '',
                          'graph': []}
     else:
-        timing = render_to_string('lava_scheduler_app/job_pipeline_timing.html',
-                                  {'job': job, 'pipeline': pipeline, 'summary': summary,
-                                   'total_duration': total_duration,
-                                   'mean_duration': total_duration / len(pipeline),
-                                   'max_duration': max_duration})
-
-        response_dict = {'timing': timing,
+        timing['job'] = job
+        response_dict = {'timing': render_to_string('lava_scheduler_app/job_pipeline_timing.html',
+                                                    timing),
                          'graph': pipeline}
 
     return HttpResponse(json.dumps(response_dict), content_type='text/json')
@@ -1944,33 +1887,56 @@ def job_log_pipeline_incremental(request, pk):
     except ValueError:
         first_line = 0
 
+    finished = job.status not in [TestJob.SUBMITTED, TestJob.RUNNING, TestJob.CANCELING]
+    more = False
     try:
-        with open(os.path.join(job.output_dir, "output.yaml"), "r") as f_in:
-            # Manually skip the first lines
-            # This is working because:
-            # 1/ output.yaml is a list of dictionnaries
-            # 2/ each item in this list is represented as one line in output.yaml
-            count = 0
-            for _ in range(first_line):
-                count += len(f_in.next())
-            # Seeking is needed to switch from reading lines to reading bytes.
-            f_in.seek(count)
-            # Load the remaining as yaml
-            data = yaml.load(f_in, Loader=yaml.CLoader)
-            # When reaching EOF, yaml.load does return None instead of []
-            if not data:
-                data = []
-            if sys.version_info < (3, 0):
-                for line in data:
-                    remove_broken_string(line)
-
-    except (IOError, StopIteration):
+        # Seek directly to the requested line using the line-offset index
+        # written by the master. The index of older logs is built the first
+        # time they are read, once the job is finished.
+        chunk = read_log_chunk(job.output_dir, first_line)
+        if chunk is None and finished:
+            update_log_index(job.output_dir)
+            chunk = read_log_chunk(job.output_dir, first_line)
+        if chunk is not None:
+            (raw_data, more) = chunk
+            data = yaml.load(raw_data, Loader=yaml.CLoader)
+        else:
+            with open(os.path.join(job.output_dir, "output.yaml"), "r") as f_in:
+                # Manually skip the first lines
+                # This is working because:
+                # 1/ output.yaml is a list of dictionnaries
+                # 2/ each item in this list is represented as one line in output.yaml
+                count = 0
+                for _ in range(first_line):
+                    count += len(f_in.next())
+                # Seeking is needed to switch from reading lines to reading bytes.
+                f_in.seek(count)
+                # Load the remaining as yaml
+                data = yaml.load(f_in, Loader=yaml.CLoader)
+        # When reaching EOF, yaml.load does return None instead of []
+        if not data:
+            data = []
+        if sys.version_info < (3, 0):
+            for line in data:
+                remove_broken_string(line)
+
+    except (IOError, OSError, StopIteration):
         data = []
+    except yaml.YAMLError:
+        data = None
 
     response = HttpResponse(
-        simplejson.dumps(data), content_type='application/json')
+        simplejson.dumps(data if data is not None else []),
+        content_type='application/json')
 
-    if job.status not in [TestJob.SUBMITTED, TestJob.RUNNING, TestJob.CANCELING]:
+    # Let the client poll for the remaining chunks
+    if data is None:
+        # the client would keep on requesting the same invalid chunk
+        response['X-Invalid-Log'] = '1'
+        response['X-Is-Finished'] = '1'
+    elif more:
+        response['X-More-Data'] = '1'
+    elif finished:
         response['X-Is-Finished'] = '1'
 
     return response
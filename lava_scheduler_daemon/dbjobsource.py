@@ -170,6 +170,10 @@ class DatabaseJobSource(object):
         if utils.is_master():
             submit_health_check_jobs()
             assign_jobs()
+            parsed, avoided = utils.job_definition_counters(reset=True)
+            if parsed or avoided:
+                self.logger.debug("Job definitions: %d parsed, %d parses avoided",
+                                  parsed, avoided)
 
         # from here on, ignore pipeline jobs.
         my_devices = get_temporary_devices(self.my_devices())
@@ -0,0 +1,123 @@
+# Copyright (C) 2017 Linaro Limited
+#
+# This file is part of LAVA Server.
+#
+# LAVA Server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Import the V1 bundles uploaded while BUNDLE_IMPORT_ASYNC is set.
+
+The pending bundles are the bundles neither deserialized nor failed. They
+are imported in upload order, by a pool of threads each using its own
+database connection. Only one instance of this command should run.
+"""
+
+import logging
+import logging.handlers
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from dashboard_app.models import Bundle
+
+# pylint: disable=no-member
+
+FORMAT = "%(asctime)-15s %(levelname)7s %(name)s %(message)s"
+
+
+def import_bundle(pk):
+    # Run in a thread of the pool, always return the bundle id to release it
+    logger = logging.getLogger('bundle-import')
+    start = time.time()
+    try:
+        bundle = Bundle.objects.get(pk=pk)
+        bundle.deserialize()
+        if bundle.is_deserialized:
+            logger.info("[%s] imported in %.1fs", bundle.content_sha1, time.time() - start)
+        else:
+            logger.error("[%s] import failed: %s", bundle.content_sha1,
+                         bundle.deserialization_error.error_message)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.exception("[%d] unable to import the bundle: %s", pk, exc)
+    finally:
+        connection.close()
+    return pk
+
+
+class Command(BaseCommand):
+    help = "Import the V1 bundles uploaded asynchronously"
+
+    def __init__(self, *args, **options):
+        super(Command, self).__init__(*args, **options)
+        self.logger = logging.getLogger('bundle-import')
+        self.lock = threading.Lock()
+        self.running = set()
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--level',
+                            default='INFO',
+                            help="Logging level (ERROR, WARN, INFO, DEBUG) "
+                                 "Default: INFO")
+
+        parser.add_argument('-f', '--log-file',
+                            default='/var/log/lava-server/bundle-import.log',
+                            help="Logging file path")
+
+        parser.add_argument('-j', '--jobs', type=int,
+                            default=2,
+                            help="Number of bundles imported at the same time. Default: 2")
+
+        parser.add_argument('-i', '--interval', type=int,
+                            default=5,
+                            help="Seconds between two checks for new bundles. Default: 5")
+
+    def release(self, pk):
+        with self.lock:
+            self.running.discard(pk)
+
+    def handle(self, *args, **options):
+        handler = logging.handlers.WatchedFileHandler(options['log_file'])
+        handler.setFormatter(logging.Formatter(FORMAT))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(getattr(logging, options['level'], logging.INFO))
+
+        if not settings.BUNDLE_IMPORT_ASYNC:
+            self.logger.warning("'BUNDLE_IMPORT_ASYNC' is not set, the bundles "
+                                "are imported during the upload")
+
+        jobs = max(1, options['jobs'])
+        pool = ThreadPool(jobs)
+        self.logger.info("Importing the pending bundles, %d at a time", jobs)
+        while True:
+            with self.lock:
+                running = set(self.running)
+            if len(running) < jobs:
+                try:
+                    pending = list(Bundle.objects.filter(
+                        is_deserialized=False, deserialization_error__isnull=True).exclude(
+                            pk__in=running).order_by('uploaded_on').values_list(
+                                'pk', flat=True)[:jobs - len(running)])
+                except DatabaseError as exc:
+                    self.logger.error("Unable to list the pending bundles: %s", exc)
+                    connection.close()
+                    pending = []
+                for pk in pending:
+                    with self.lock:
+                        self.running.add(pk)
+                    pool.apply_async(import_bundle, (pk,), callback=self.release)
+            time.sleep(options['interval'])
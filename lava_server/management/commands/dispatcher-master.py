@@ -20,12 +20,14 @@
 
 # pylint: disable=wrong-import-order
 
+import re
+import copy
 import errno
 import sys
+import json
 import fcntl
 import jinja2
 import logging
-import lzma
 import os
 import signal
 import time
@@ -34,19 +36,29 @@ import zmq
 import zmq.auth
 from zmq.auth.thread import ThreadAuthenticator
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.db.models import Q
 from django.db.utils import OperationalError, InterfaceError
-from lava_scheduler_app.models import TestJob
-from lava_scheduler_app.utils import mkdir
+from django.utils import timezone
+from lava_scheduler_app.models import Device, TestJob, Worker
+from lava_scheduler_app.logutils import (
+    DescriptionWorker,
+    LogIngestion,
+    ResultWorkers,
+)
 from lava_scheduler_app.dbutils import (
+    assign_jobs,
     create_job, start_job,
     fail_job, cancel_job,
-    parse_job_description,
     select_device,
 )
-from lava_results_app.dbutils import map_scanned_results, create_metadata_store
+from lava_scheduler_app.utils import (
+    job_definition_counters,
+    shard_ports,
+    worker_shard,
+)
 
 
 # pylint: disable=no-member,too-many-branches,too-many-statements,too-many-locals
@@ -57,13 +69,20 @@ from lava_results_app.dbutils import map_scanned_results, create_metadata_store
 # master.
 PROTOCOL_VERSION = 1
 # TODO constants to move into external files
-FD_TIMEOUT = 60
 TIMEOUT = 10
 DB_LIMIT = 10
+# When the master receives the scheduling events from lava-publisher, the
+# full scan of the database is only a safety net against lost events.
+SCAN_INTERVAL = 60
+# Job number (id or sub_id) in the events
+JOB_NUMBER = re.compile(r'^[0-9]+(\.[0-9]+)?$')
 
 # TODO: share this value with dispatcher-slave
 # This should be 3 times the slave ping timeout
 DISPATCHER_TIMEOUT = 3 * 10
+# The states of the dispatchers are kept in memory and written to the
+# database at most every WORKER_STATE_INTERVAL seconds.
+WORKER_STATE_INTERVAL = 20
 
 
 class SlaveDispatcher(object):  # pylint: disable=too-few-public-methods
@@ -72,30 +91,16 @@ class SlaveDispatcher(object):  # pylint: disable=too-few-public-methods
         self.hostname = hostname
         self.last_msg = time.time() if online else 0
         self.online = online
+        # The state (or the last ping) is not yet in the database
+        self.dirty = online
 
     def alive(self):
         self.last_msg = time.time()
-
-
-class JobHandler(object):  # pylint: disable=too-few-public-methods
-    def __init__(self, job, level, filename):
-        self.output_dir = job.output_dir
-        self.output = open(os.path.join(self.output_dir, 'output.yaml'), 'a+')
-        self.current_level = level
-        self.sub_log = open(filename, 'a+')
-        self.last_usage = time.time()
-
-    def write(self, message):
-        self.output.write(message)
-        self.output.write('\n')
-        self.output.flush()
-        self.sub_log.write(message)
-        self.sub_log.write('\n')
-        self.sub_log.flush()
-
-    def close(self):
-        self.output.close()
-        self.sub_log.close()
+        self.dirty = True
+        if not self.online:
+            self.online = True
+            return True
+        return False
 
 
 def load_optional_yaml_file(filename):
@@ -119,6 +124,18 @@ def load_optional_yaml_file(filename):
         raise IOError("", "Not a valid YAML file", filename)
 
 
+def job_numbers_query(job_numbers):
+    """
+    Query for the given jobs, by id or sub_id, and their multinode groups.
+    """
+    ids = [int(number) for number in job_numbers if '.' not in number]
+    sub_ids = [number for number in job_numbers if '.' in number]
+    query = Q(id__in=ids) | Q(sub_id__in=sub_ids)
+    groups = TestJob.objects.filter(query).exclude(target_group=None)\
+                            .values_list('target_group', flat=True)
+    return query | Q(target_group__in=list(groups))
+
+
 class Command(BaseCommand):
     """
     worker_host is the hostname of the worker this field is set by the admin
@@ -131,20 +148,32 @@ class Command(BaseCommand):
         super(Command, self).__init__(*args, **options)
         self.pull_socket = None
         self.controler = None
-        # List of logs
-        self.jobs = {}
+        # Log ingestion thread, result workers and description worker
+        self.ingestion = None
+        self.results = None
+        self.descriptions = None
         # List of known dispatchers. At startup do not load this from the
         # database. This will help to know if the slave as restarted or not.
         self.dispatchers = {}
+        # Scheduling events
+        self.event_socket = None
+        self.pending_assign = False
+        self.pending_start = set()
+        self.pending_cancel = set()
+        # Shard of the workers handled by this process
+        self.shard = 0
+        self.shards = 1
         self.logging_support()
 
     def add_arguments(self, parser):
         parser.add_argument('--master-socket',
-                            default='tcp://*:5556',
-                            help="Socket for master-slave communication. Default: tcp://*:5556")
+                            default=None,
+                            help="Socket for master-slave communication. "
+                                 "Default: tcp://*:5556, plus 2 for each shard")
         parser.add_argument('--log-socket',
-                            default='tcp://*:5555',
-                            help="Socket waiting for logs. Default: tcp://*:5555")
+                            default=None,
+                            help="Socket waiting for logs. "
+                                 "Default: tcp://*:5555, plus 2 for each shard")
         parser.add_argument('--encrypt', default=False, action='store_true',
                             help="Encrypt messages")
         parser.add_argument('--master-cert',
@@ -172,6 +201,42 @@ class Command(BaseCommand):
         parser.add_argument('--dispatchers-config',
                             default="/etc/lava-server/dispatcher.d",
                             help="Directory that might contain dispatcher specific configuration")
+        parser.add_argument('--event-url',
+                            default=settings.EVENT_SOCKET.replace('*', 'localhost'),
+                            help="Socket of lava-publisher, used to react to the scheduling "
+                                 "events when EVENT_NOTIFICATION is set. "
+                                 "Default: %s" % settings.EVENT_SOCKET.replace('*', 'localhost'))
+        parser.add_argument('--no-events', default=False, action='store_true',
+                            help="Do not listen to the scheduling events, only poll the database")
+        parser.add_argument('--shards', type=int, default=1,
+                            help="Number of dispatcher-master processes sharing the workers. "
+                                 "Default: 1")
+        parser.add_argument('--shard', type=int, default=0,
+                            help="Shard handled by this process, from 0 to SHARDS - 1. "
+                                 "Use 'lava-server manage workers list --shards SHARDS' "
+                                 "to list the shard of each worker. Default: 0")
+
+    def in_shard(self, hostname):
+        """
+        Is the given worker handled by this process?
+        """
+        return worker_shard(hostname, self.shards) == self.shard
+
+    def job_in_shard(self, job):
+        """
+        Is the worker running the given job handled by this process?
+        Jobs without worker are handled by the first shard.
+        """
+        if self.shards <= 1:
+            return True
+        if job.dynamic_connection:
+            worker_host = job.lookup_worker
+        else:
+            device = job.actual_device or job.requested_device
+            worker_host = device.worker_host if device is not None else None
+        if worker_host is None:
+            return self.shard == 0
+        return self.in_shard(worker_host.hostname)
 
     def send_status(self, hostname):
         """
@@ -193,87 +258,44 @@ class Command(BaseCommand):
             self.send_status(hostname)
 
         # Mark the dispatcher as alive
-        self.dispatchers[hostname].alive()
-
-    def logging_socket(self, options):
-        msg = self.pull_socket.recv_multipart()
-        try:
-            (job_id, level, name, message) = msg  # pylint: disable=unbalanced-tuple-unpacking
-        except ValueError:
-            # do not let a bad message stop the master.
-            self.logger.error("Failed to parse log message, skipping: %s", msg)
-            return
-
-        try:
-            scanned = yaml.load(message, Loader=yaml.CLoader)
-        except yaml.YAMLError:
-            self.logger.error("[%s] data are not valid YAML, dropping", job_id)
-            return
-
-        # Look for "results" level
-        try:
-            message_lvl = scanned["lvl"]
-            message_msg = scanned["msg"]
-        except KeyError:
-            self.logger.error(
-                "[%s] Invalid log line, missing \"lvl\" or \"msg\" keys: %s",
-                job_id, message)
-            return
-
-        # Clear filename
-        if '/' in level or '/' in name:
-            self.logger.error("[%s] Wrong level or name received, dropping the message", job_id)
-            return
-
-        # Find the handler (if available)
-        if job_id in self.jobs:
-            if level != self.jobs[job_id].current_level:
-                # Close the old file handler
-                self.jobs[job_id].sub_log.close()
-                filename = os.path.join(self.jobs[job_id].output_dir,
-                                        "pipeline", level.split('.')[0],
-                                        "%s-%s.yaml" % (level, name))
-                mkdir(os.path.dirname(filename))
-                self.current_level = level
-                self.jobs[job_id].sub_log = open(filename, 'a+')
-        else:
-            # Query the database for the job
-            try:
-                job = TestJob.objects.get(id=job_id)
-            except TestJob.DoesNotExist:
-                self.logger.error("[%s] Unknown job id", job_id)
-                return
-
-            self.logger.info("[%s] Receiving logs from a new job", job_id)
-            filename = os.path.join(job.output_dir,
-                                    "pipeline", level.split('.')[0],
-                                    "%s-%s.yaml" % (level, name))
-            # Create the sub directories (if needed)
-            mkdir(os.path.dirname(filename))
-            self.jobs[job_id] = JobHandler(job, level, filename)
-
-        if message_lvl == "results":
-            try:
-                job = TestJob.objects.get(pk=job_id)
-            except TestJob.DoesNotExist:
-                self.logger.error("[%s] Unknown job id", job_id)
-                return
-            meta_filename = create_metadata_store(message_msg, job, level)
-            ret = map_scanned_results(results=message_msg, job=job, meta_filename=meta_filename)
-            if not ret:
-                self.logger.warning(
-                    "[%s] Unable to map scanned results: %s",
-                    job_id, message)
-
-        # Mark the file handler as used
-        self.jobs[job_id].last_usage = time.time()
+        if self.dispatchers[hostname].alive():
+            self.logger.info("[STATE] Dispatcher <%s> goes ONLINE", hostname)
 
-        # n.b. logging here would produce a log entry for every message in every job.
-        # The format is a list of dictionaries
-        message = "- %s" % message
-
-        # Write data
-        self.jobs[job_id].write(message)
+    def write_worker_states(self):
+        """
+        Write the states of the dispatchers that changed since the last call,
+        with one query for the online ones and one for the offline ones.
+        """
+        online = [hostname for (hostname, dispatcher) in self.dispatchers.items()
+                  if dispatcher.dirty and dispatcher.online]
+        offline = [hostname for (hostname, dispatcher) in self.dispatchers.items()
+                   if dispatcher.dirty and not dispatcher.online]
+        if online:
+            Worker.objects.filter(hostname__in=online).update(
+                state=Worker.STATE_ONLINE, last_ping=timezone.now())
+        if offline:
+            Worker.objects.filter(hostname__in=offline).update(
+                state=Worker.STATE_OFFLINE)
+        # Only forget the changes once written: the database connection
+        # could have been reset.
+        for hostname in online + offline:
+            self.dispatchers[hostname].dirty = False
+
+    def offline_unknown_workers(self):
+        """
+        Workers of this shard that did not connect since the master started
+        are offline. They are not added to the known dispatchers, in order to
+        send a STATUS message when they show up.
+        """
+        hostnames = Worker.objects.filter(
+            state=Worker.STATE_ONLINE).values_list('hostname', flat=True)
+        unknown = [hostname for hostname in hostnames
+                   if hostname not in self.dispatchers and self.in_shard(hostname)]
+        if unknown:
+            for hostname in unknown:
+                self.logger.error("[STATE] Dispatcher <%s> goes OFFLINE (never seen)", hostname)
+            Worker.objects.filter(hostname__in=unknown).update(
+                state=Worker.STATE_OFFLINE)
 
     def controler_socket(self):
         msg = self.controler.recv_multipart()
@@ -300,6 +322,13 @@ class Command(BaseCommand):
                                   hostname, slave_version, PROTOCOL_VERSION)
                 return False
 
+            # Do not answer: the slave is configured with the sockets of
+            # another shard and the other master would start the same jobs.
+            if not self.in_shard(hostname):
+                self.logger.error("<%s> belongs to the shard %d, not to the shard %d",
+                                  hostname, worker_shard(hostname, self.shards), self.shard)
+                return False
+
             self.controler.send_multipart([hostname, 'HELLO_OK'])
             # If the dispatcher is known and sent an HELLO, means that
             # the slave has restarted
@@ -324,7 +353,8 @@ class Command(BaseCommand):
                 self._cancel_slave_dispatcher_jobs(hostname)
 
             # Mark the dispatcher as alive
-            self.dispatchers[hostname].alive()
+            if self.dispatchers[hostname].alive():
+                self.logger.info("[STATE] Dispatcher <%s> goes ONLINE", hostname)
 
         elif action == 'PING':
             self.logger.debug("%s => PING", hostname)
@@ -353,27 +383,25 @@ class Command(BaseCommand):
             try:
                 with transaction.atomic():
                     job = TestJob.objects.select_for_update().get(id=job_id)
+                    old_status = job.status
+                    # The notifications include the results: they are sent
+                    # by the result workers once the results are mapped.
+                    job.defer_notifications = True
                     if job.status == TestJob.CANCELING:
                         cancel_job(job)
                     fail_job(job, fail_msg=error_msg, job_status=status)
-
-                # Save the description
-                filename = os.path.join(job.output_dir, 'description.yaml')
-                try:
-                    with open(filename, 'w') as f_description:
-                        f_description.write(lzma.decompress(description))
-                except (IOError, lzma.error) as exc:
-                    self.logger.error("[%d] Unable to dump 'description.yaml'",
-                                      job_id)
-                    self.logger.exception(exc)
-                parse_job_description(job)
-
             except TestJob.DoesNotExist:
                 self.logger.error("[%d] Unknown job", job_id)
+            else:
+                # Flush the results and map the description out of the main loop
+                self.ingestion.end(job_id, old_status)
+                self.descriptions.put(job_id, description)
             # ACK even if the job is unknown to let the dispatcher
             # forget about it
             self.controler.send_multipart([hostname, 'END_OK', str(job_id)])
             self.dispatcher_alive(hostname)
+            # The device might now be available for another job
+            self.pending_assign = True
 
         elif action == 'START_OK':
             try:
@@ -403,10 +431,6 @@ class Command(BaseCommand):
         :param hostname: The name of the dispatcher host.
         :type hostname: string
         """
-        # TODO: DB: mark the dispatcher as online in the database.
-        # For the moment this should not be done by this process as
-        # some dispatchers are using old and new dispatcher.
-
         # Mark all jobs on this dispatcher as canceled.
         # The dispatcher had (re)started, so all jobs have to be
         # finished.
@@ -421,16 +445,90 @@ class Command(BaseCommand):
                 cancel_job(job)
 
     def export_definition(self, job):  # pylint: disable=no-self-use
-        job_def = yaml.load(job.definition)
+        job_def = copy.deepcopy(job.load_definition())
         job_def['compatibility'] = job.pipeline_compatibility
 
         # no need for the dispatcher to retain comments
         return yaml.dump(job_def)
 
-    def process_jobs(self, options):
-        for job in TestJob.objects.filter(
-                Q(status=TestJob.SUBMITTED) & Q(is_pipeline=True) & ~Q(actual_device=None))\
-                .order_by('-health_check', '-priority', 'submit_time', 'target_group', 'id'):
+    def events_socket(self):
+        """
+        Drain the event socket and record the scheduling work to do.
+        The events are sent by lava_scheduler_app.signals through
+        lava-publisher.
+        """
+        submitted = dict(TestJob.STATUS_CHOICES)[TestJob.SUBMITTED]
+        canceling = dict(TestJob.STATUS_CHOICES)[TestJob.CANCELING]
+        idle = dict(Device.STATUS_CHOICES)[Device.IDLE]
+        reserved = dict(Device.STATUS_CHOICES)[Device.RESERVED]
+        while True:
+            try:
+                msg = self.event_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            try:
+                (topic, _, _, _, data) = msg  # pylint: disable=unbalanced-tuple-unpacking
+                data = json.loads(data)
+                status = data.get("status")
+                job_number = str(data.get("job", ""))
+            except (ValueError, AttributeError):
+                self.logger.error("[EVENT] Invalid event: %s", msg)
+                continue
+
+            if topic.endswith(".testjob"):
+                if status == submitted:
+                    self.pending_assign = True
+                elif status == canceling and JOB_NUMBER.match(job_number):
+                    self.pending_cancel.add(job_number)
+            elif topic.endswith(".device"):
+                if status == idle:
+                    self.pending_assign = True
+                elif status == reserved and JOB_NUMBER.match(job_number):
+                    self.pending_start.add(job_number)
+
+    def has_pending_events(self):
+        return self.pending_assign or self.pending_start or self.pending_cancel
+
+    def clear_pending_events(self):
+        """
+        Called before a full scan: the jobs to start or cancel are handled
+        by the scan, the jobs are still assigned if requested.
+        """
+        if self.pending_assign:
+            self.pending_assign = False
+            assign_jobs()
+        self.pending_start = set()
+        self.pending_cancel = set()
+
+    def process_events(self, options):
+        """
+        Only handle the jobs concerned by the events received since the
+        last call.
+        """
+        if self.pending_assign:
+            self.pending_assign = False
+            for job_id in assign_jobs():
+                self.pending_start.add(str(job_id))
+        if self.pending_start:
+            job_numbers, self.pending_start = self.pending_start, set()
+            self.process_jobs(options, job_numbers)
+        if self.pending_cancel:
+            job_numbers, self.pending_cancel = self.pending_cancel, set()
+            self.handle_canceling(job_numbers)
+
+    def process_jobs(self, options, job_numbers=None):
+        """
+        Start the pipeline jobs with a reserved device.
+        :param job_numbers: only look at these jobs (and their multinode
+        groups), as ids or sub_ids. All jobs by default.
+        """
+        jobs = TestJob.objects.filter(
+            Q(status=TestJob.SUBMITTED) & Q(is_pipeline=True) & ~Q(actual_device=None))
+        if job_numbers is not None:
+            jobs = jobs.filter(job_numbers_query(job_numbers))
+        for job in jobs.order_by('-health_check', '-priority', 'submit_time', 'target_group', 'id'):
+            if not self.job_in_shard(job):
+                continue
             if job.dynamic_connection:
                 # A secondary connection must be made from a dispatcher local to the host device
                 # to allow for local firewalls etc. So the secondary connection is started on the
@@ -473,7 +571,7 @@ class Command(BaseCommand):
             try:
                 # Load job definition to get the variables for template
                 # rendering
-                job_def = yaml.load(job.definition)
+                job_def = job.load_definition()
                 job_ctx = job_def.get('context', {})
 
                 # Load device configuration
@@ -535,8 +633,13 @@ class Command(BaseCommand):
             self.logger.error("[%d] INCOMPLETE job", job.id)
             fail_job(job=job, fail_msg=msg, job_status=TestJob.INCOMPLETE)
 
-    def handle_canceling(self):
-        for job in TestJob.objects.filter(status=TestJob.CANCELING, is_pipeline=True):
+    def handle_canceling(self, job_numbers=None):
+        jobs = TestJob.objects.filter(status=TestJob.CANCELING, is_pipeline=True)
+        if job_numbers is not None:
+            jobs = jobs.filter(job_numbers_query(job_numbers))
+        for job in jobs:
+            if not self.job_in_shard(job):
+                continue
             worker_host = job.lookup_worker if job.dynamic_connection else job.actual_device.worker_host
             if not worker_host:
                 self.logger.warning("[%d] Invalid worker information", job.id)
@@ -553,6 +656,8 @@ class Command(BaseCommand):
         del logging.root.filters[:]
         # Create the logger
         log_format = '%(asctime)-15s %(levelname)s %(message)s'
+        if self.shards > 1:
+            log_format = '%(asctime)-15s %(levelname)s [shard ' + str(self.shard) + '] %(message)s'
         logging.basicConfig(format=log_format, filename='/var/log/lava-server/lava-master.log')
         self.logger = logging.getLogger('dispatcher-master')
 
@@ -560,6 +665,19 @@ class Command(BaseCommand):
         # Set a proper umask value
         os.umask(0o022)
 
+        if options['shards'] < 1 or not 0 <= options['shard'] < options['shards']:
+            self.logger.error("[FAIL] Invalid shard %d of %d", options['shard'], options['shards'])
+            sys.exit(2)
+        if options['shards'] > 1:
+            self.shard = options['shard']
+            self.shards = options['shards']
+            self.logging_support()
+        (master_port, log_port) = shard_ports(self.shard)
+        if options['master_socket'] is None:
+            options['master_socket'] = "tcp://*:%d" % master_port
+        if options['log_socket'] is None:
+            options['log_socket'] = "tcp://*:%d" % log_port
+
         # Set the logging level
         if options['level'] == 'ERROR':
             self.logger.setLevel(logging.ERROR)
@@ -599,14 +717,33 @@ class Command(BaseCommand):
         self.pull_socket.bind(options['log_socket'])
         self.controler.bind(options['master_socket'])
 
+        # Scheduling events (job submitted, canceled, device idle or reserved)
+        if settings.EVENT_NOTIFICATION and not options['no_events']:
+            self.logger.info("[INIT] Listening to events on %s", options['event_url'])
+            self.event_socket = context.socket(zmq.SUB)
+            # Only the events useful for scheduling, not the log events
+            self.event_socket.setsockopt(zmq.SUBSCRIBE, settings.EVENT_TOPIC + ".testjob")
+            self.event_socket.setsockopt(zmq.SUBSCRIBE, settings.EVENT_TOPIC + ".device")
+            self.event_socket.connect(options['event_url'])
+            scan_interval = SCAN_INTERVAL
+        else:
+            scan_interval = DB_LIMIT
+
         # Last access to the database for new jobs and cancelations
         last_db_access = 0
-
-        # Poll on the sockets (only one for the moment). This allow to have a
-        # nice timeout along with polling.
+        # Last write of the dispatchers states. The workers not seen after
+        # DISPATCHER_TIMEOUT are marked offline once.
+        last_state_write = 0
+        started = time.time()
+        unknown_checked = False
+
+        # Poll on the control socket. This allow to have a nice timeout
+        # along with polling. The logging socket is handled by a dedicated
+        # thread, see lava_scheduler_app.logutils
         poller = zmq.Poller()
-        poller.register(self.pull_socket, zmq.POLLIN)
         poller.register(self.controler, zmq.POLLIN)
+        if self.event_socket is not None:
+            poller.register(self.event_socket, zmq.POLLIN)
 
         # Mask signals and create a pipe that will receive a bit for each
         # signal received. Poll the pipe along with the zmq socket so that we
@@ -634,13 +771,28 @@ class Command(BaseCommand):
 
         self.logger.info("[INIT] LAVA dispatcher-master has started.")
         self.logger.info("[INIT] Using protocol version %d", PROTOCOL_VERSION)
+        if self.shards > 1:
+            self.logger.info("[INIT] Handling the shard %d of %d", self.shard, self.shards)
+
+        # Start the log ingestion pipeline
+        self.results = ResultWorkers(self.logger)
+        self.results.start()
+        self.descriptions = DescriptionWorker(self.logger)
+        self.descriptions.start()
+        self.ingestion = LogIngestion(self.pull_socket, self.results, self.logger,
+                                      events=settings.EVENT_NOTIFICATION)
+        self.ingestion.start()
 
         while True:
             try:
                 try:
-                    # TODO: Fix the timeout computation
-                    # Wait for data or a timeout
-                    sockets = dict(poller.poll(TIMEOUT * 1000))
+                    # Wait for data or a timeout: do not wait when some
+                    # events are pending nor after the next database scan.
+                    if self.has_pending_events():
+                        timeout = 0
+                    else:
+                        timeout = min(TIMEOUT, max(0, last_db_access + scan_interval - time.time()))
+                    sockets = dict(poller.poll(timeout * 1000))
                 except zmq.error.ZMQError:
                     continue
 
@@ -653,36 +805,40 @@ class Command(BaseCommand):
                         self.logger.info("[POLL] Received a signal, leaving")
                         break
 
-                # Logging socket
-                if sockets.get(self.pull_socket) == zmq.POLLIN:
-                    self.logging_socket(options)
-
-                # Garbage collect file handlers
-                now = time.time()
-                for job_id in self.jobs.keys():  # pylint: disable=consider-iterating-dictionary
-                    if now - self.jobs[job_id].last_usage > FD_TIMEOUT:
-                        self.logger.info("[%s] Closing log file", job_id)
-                        self.jobs[job_id].close()
-                        del self.jobs[job_id]
-
                 # Command socket
                 if sockets.get(self.controler) == zmq.POLLIN:
                     if not self.controler_socket():
                         continue
 
+                # Events socket
+                if self.event_socket is not None and sockets.get(self.event_socket) == zmq.POLLIN:
+                    self.events_socket()
+
                 # Check dispatchers status
                 now = time.time()
                 for hostname, dispatcher in self.dispatchers.iteritems():
                     if dispatcher.online and now - dispatcher.last_msg > DISPATCHER_TIMEOUT:
                         self.logger.error("[STATE] Dispatcher <%s> goes OFFLINE", hostname)
                         self.dispatchers[hostname].online = False
-                        # TODO: DB: mark the dispatcher as offline and attached
-                        # devices
+                        # The devices of this worker are not scheduled
+                        # anymore once the state is written.
+                        self.dispatchers[hostname].dirty = True
+
+                # Write the states of the dispatchers
+                if now - last_state_write > WORKER_STATE_INTERVAL:
+                    last_state_write = now
+                    self.write_worker_states()
+                    if not unknown_checked and now - started > DISPATCHER_TIMEOUT:
+                        unknown_checked = True
+                        self.offline_unknown_workers()
 
                 # Limit accesses to the database. This will also limit the rate of
                 # CANCEL and START messages
-                if now - last_db_access > DB_LIMIT:
+                if now - last_db_access > scan_interval:
                     last_db_access = now
+                    # The full scan handles all the pending events and
+                    # starts the jobs assigned here
+                    self.clear_pending_events()
 
                     # TODO: make this atomic
                     # Dispatch pipeline jobs with devices in Reserved state
@@ -690,14 +846,30 @@ class Command(BaseCommand):
 
                     # Handle canceling jobs
                     self.handle_canceling()
+
+                    parsed, avoided = job_definition_counters(reset=True)
+                    if parsed or avoided:
+                        self.logger.debug("[CACHE] job definitions: %d parsed, %d parses avoided",
+                                          parsed, avoided)
+                elif self.has_pending_events():
+                    self.process_events(options)
             except (OperationalError, InterfaceError):
                 self.logger.info("[RESET] database connection reset.")
                 continue
 
+        # Stop the log ingestion and wait for the pending results
+        self.logger.info("[CLOSE] Stopping the log ingestion")
+        self.ingestion.stop()
+        self.results.stop()
+        self.logger.info("[CLOSE] Mapping the pending job descriptions")
+        self.descriptions.stop()
+
         # Closing sockets and droping messages.
         self.logger.info("[CLOSE] Closing the sockets and dropping messages")
         self.controler.close(linger=0)
         self.pull_socket.close(linger=0)
+        if self.event_socket is not None:
+            self.event_socket.close(linger=0)
         if options['encrypt']:
             auth.stop()
         context.term()
@@ -0,0 +1,294 @@
+# Copyright (C) 2017 Linaro Limited
+#
+# Author: Remi Duraffort <remi.duraffort@linaro.org>
+#
+# This file is part of LAVA Server.
+#
+# LAVA Server is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Server is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Push the logs and the status of the running jobs to the browsers, using
+Server-Sent Events.
+
+The job pages subscribe to a job with the signed token generated by
+job_detail. The new lines are read from output.yaml, using the line-offset
+index, when the dispatcher-master publishes a "log" event for the job. The
+status transitions are the "testjob" events of lava-publisher.
+"""
+
+# pylint: disable=wrong-import-order
+
+import json
+import logging
+import logging.handlers
+import threading
+import yaml
+import zmq
+
+from django.conf import settings
+from django.core import signing
+from django.core.management.base import BaseCommand
+from django.db import connection
+from twisted.internet import reactor, task
+from twisted.internet.threads import deferToThread
+from twisted.web import resource, server
+
+from lava_scheduler_app.logutils import read_log_chunk, remove_broken_string
+from lava_scheduler_app.models import TestJob
+from lava_scheduler_app.utils import job_stream_job_id
+
+# pylint: disable=no-member
+
+FORMAT = "%(asctime)-15s %(levelname)7s %(name)s %(message)s"
+# Keep the connections alive through the proxies
+HEARTBEAT = 30
+# Status of the finished jobs
+FINISHED = [dict(TestJob.STATUS_CHOICES)[status]
+            for status in [TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED]]
+
+
+def sse_message(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+
+class JobStream(object):  # pylint: disable=too-few-public-methods
+    """
+    Subscribers of a given job. Each subscriber has its own position in the
+    log, subscribers at the same position share the same read.
+    """
+
+    def __init__(self):
+        self.output_dir = None
+        self.group = None
+        self.lines = 0
+        self.subscribers = {}
+
+
+class JobStreams(object):
+    """
+    Job streams, only used from the reactor thread.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.jobs = {}
+
+    def subscribe(self, job_id, request, line):
+        if job_id not in self.jobs:
+            self.jobs[job_id] = JobStream()
+            deferToThread(self.lookup, job_id).addCallbacks(
+                self.found, self.not_found, callbackArgs=(job_id,),
+                errbackArgs=(job_id,))
+        self.jobs[job_id].subscribers[request] = line
+        request.notifyFinish().addBoth(self.unsubscribe, job_id, request)
+        if self.jobs[job_id].output_dir is not None:
+            self.send_logs(job_id)
+
+    def unsubscribe(self, _, job_id, request):
+        stream = self.jobs.get(job_id)
+        if stream is None:
+            return
+        stream.subscribers.pop(request, None)
+        if not stream.subscribers:
+            del self.jobs[job_id]
+
+    def lookup(self, job_id):  # pylint: disable=no-self-use
+        # Run in a thread of the reactor pool
+        try:
+            job = TestJob.objects.get(pk=job_id)
+            return (job.output_dir, job.sub_id.split('.')[0] if job.is_multinode else None,
+                    job.status in [TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED])
+        finally:
+            connection.close()
+
+    def found(self, result, job_id):
+        stream = self.jobs.get(job_id)
+        if stream is None:
+            return
+        (stream.output_dir, stream.group, finished) = result
+        self.send_logs(job_id)
+        if finished:
+            self.finish(job_id)
+
+    def not_found(self, failure, job_id):
+        self.logger.error("[%d] Unable to subscribe: %s", job_id, failure.getErrorMessage())
+        stream = self.jobs.pop(job_id, None)
+        if stream is not None:
+            for request in stream.subscribers.keys():
+                request.finish()
+
+    def send_logs(self, job_id):
+        stream = self.jobs.get(job_id)
+        if stream is None or stream.output_dir is None:
+            return
+        positions = {}
+        for (request, line) in stream.subscribers.items():
+            positions.setdefault(line, []).append(request)
+        more = False
+        for (line, requests) in positions.items():
+            try:
+                chunk = read_log_chunk(stream.output_dir, line)
+                if chunk is None:
+                    continue
+                lines = yaml.load(chunk[0], Loader=yaml.CLoader) or []
+            except (IOError, OSError, yaml.YAMLError) as exc:
+                self.logger.error("[%d] Unable to read the logs: %s", job_id, exc)
+                continue
+            more = more or chunk[1]
+            if not lines:
+                continue
+            for log_line in lines:
+                remove_broken_string(log_line)
+            message = sse_message("log", lines)
+            for request in requests:
+                request.write(message)
+                stream.subscribers[request] = line + len(lines)
+        # Do not block the reactor while a subscriber catches up
+        if more:
+            reactor.callLater(0, self.send_logs, job_id)
+
+    def log_event(self, data):
+        job_id = data.get("job")
+        stream = self.jobs.get(job_id)
+        if stream is None:
+            return
+        stream.lines = data.get("lines", 0)
+        if any(line < stream.lines for line in stream.subscribers.values()):
+            self.send_logs(job_id)
+
+    def testjob_event(self, data):
+        job_id = data.get("job")
+        group = str(data.get("sub_id", "")).split('.')[0]
+        for (stream_id, stream) in self.jobs.items():
+            if stream_id == job_id or (stream.group and stream.group == group):
+                message = sse_message("status", data)
+                for request in stream.subscribers.keys():
+                    request.write(message)
+        if job_id in self.jobs and data.get("status") in FINISHED:
+            self.send_logs(job_id)
+            self.finish(job_id)
+
+    def finish(self, job_id):
+        stream = self.jobs.pop(job_id, None)
+        if stream is None:
+            return
+        for request in stream.subscribers.keys():
+            request.write(sse_message("finished", {"job": job_id}))
+            request.finish()
+
+    def heartbeat(self):
+        for stream in self.jobs.values():
+            for request in stream.subscribers.keys():
+                request.write(":\n\n")
+
+
+class JobStreamResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, streams):
+        resource.Resource.__init__(self)
+        self.streams = streams
+
+    def render_GET(self, request):  # pylint: disable=invalid-name
+        try:
+            job_id = job_stream_job_id(request.args.get('token', [''])[0])
+        except signing.BadSignature:
+            request.setResponseCode(403)
+            return ''
+        try:
+            line = max(0, int(request.args.get('line', ['0'])[0]))
+        except ValueError:
+            line = 0
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        # Do not let the reverse proxy buffer the events
+        request.setHeader('X-Accel-Buffering', 'no')
+        request.write(": job %d\n\n" % job_id)
+        self.streams.subscribe(job_id, request, line)
+        return server.NOT_DONE_YET
+
+
+class Command(BaseCommand):
+    help = "LAVA event stream, push the job logs and status to the browsers"
+
+    def __init__(self, *args, **options):
+        super(Command, self).__init__(*args, **options)
+        self.logger = logging.getLogger('lava-event-stream')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--level',
+                            default='INFO',
+                            help="Logging level (ERROR, WARN, INFO, DEBUG) "
+                                 "Default: INFO")
+
+        parser.add_argument('-f', '--log-file',
+                            default='/var/log/lava-server/lava-event-stream.log',
+                            help="Logging file path")
+
+        parser.add_argument('--bind',
+                            default='127.0.0.1',
+                            help="Address to listen on. Default: 127.0.0.1")
+
+        parser.add_argument('--port', type=int,
+                            default=8001,
+                            help="Port to listen on. Default: 8001")
+
+        parser.add_argument('--event-url',
+                            default=settings.EVENT_SOCKET.replace('*', 'localhost'),
+                            help="URL of the lava-publisher socket. "
+                                 "Default: the EVENT_SOCKET setting")
+
+    def receive_events(self, url, streams):
+        # Run in a dedicated thread: zmq sockets can't be used by the reactor
+        context = zmq.Context.instance()
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, settings.EVENT_TOPIC + ".log")
+        sub.setsockopt(zmq.SUBSCRIBE, settings.EVENT_TOPIC + ".testjob")
+        sub.connect(url)
+        while True:
+            try:
+                (topic, _, _, _, data) = sub.recv_multipart()  # pylint: disable=unbalanced-tuple-unpacking
+                data = json.loads(data)
+            except ValueError:
+                self.logger.error("Invalid event")
+                continue
+            except zmq.error.ZMQError as exc:
+                self.logger.error("Received a ZMQ error: %s", exc)
+                continue
+            if topic.endswith(".log"):
+                reactor.callFromThread(streams.log_event, data)
+            elif topic.endswith(".testjob"):
+                reactor.callFromThread(streams.testjob_event, data)
+
+    def handle(self, *args, **options):
+        handler = logging.handlers.WatchedFileHandler(options['log_file'])
+        handler.setFormatter(logging.Formatter(FORMAT))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(getattr(logging, options['level'], logging.INFO))
+
+        if not settings.EVENT_NOTIFICATION:
+            self.logger.error("'EVENT_NOTIFICATION' is set to False, "
+                              "no event will be pushed to the browsers")
+
+        streams = JobStreams(self.logger)
+        self.logger.info("Listening to events on %s", options['event_url'])
+        thread = threading.Thread(target=self.receive_events,
+                                  args=(options['event_url'], streams))
+        thread.daemon = True
+        thread.start()
+
+        task.LoopingCall(streams.heartbeat).start(HEARTBEAT, now=False)
+        self.logger.info("Listening on %s:%d", options['bind'], options['port'])
+        reactor.listenTCP(options['port'], server.Site(JobStreamResource(streams)),
+                          interface=options['bind'])
+        reactor.run()
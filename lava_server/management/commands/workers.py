@@ -23,6 +23,7 @@ import csv
 from django.core.management.base import BaseCommand, CommandError, CommandParser
 
 from lava_scheduler_app.models import Worker
+from lava_scheduler_app.utils import shard_ports, worker_shard
 
 
 class Command(BaseCommand):
@@ -61,6 +62,9 @@ class Command(BaseCommand):
                                  help="Show all workers (including hidden ones)")
         list_parser.add_argument("--csv", dest="csv", default=False,
                                  action="store_true", help="Print as csv")
+        list_parser.add_argument("--shards", type=int, default=1,
+                                 help="Print the dispatcher-master shard of each "
+                                      "worker, for this number of shards")
 
         set_parser = sub.add_parser("set", help="Set worker properties")
         set_parser.add_argument("--hostname", type=str, required=True,
@@ -83,7 +87,7 @@ class Command(BaseCommand):
         elif options["sub_command"] == "details":
             self.handle_details(options["hostname"], options["devices"])
         elif options["sub_command"] == "list":
-            self.handle_list(options["all"], options["csv"])
+            self.handle_list(options["all"], options["csv"], options["shards"])
         elif options["sub_command"] == "set":
             self.handle_set(options["hostname"], options["description"],
                             options["display"])
@@ -116,7 +120,7 @@ class Command(BaseCommand):
             for device in worker.device_set.order_by("hostname"):
                 self.stdout.write("- %s" % device.hostname)
 
-    def handle_list(self, show_all, format_as_csv):
+    def handle_list(self, show_all, format_as_csv, shards=1):
         """ List the workers """
         workers = Worker.objects.all().order_by("hostname")
         # By default, do not show hidden workers
@@ -125,22 +129,32 @@ class Command(BaseCommand):
 
         if format_as_csv:
             fields = ["hostname", "description", "master", "hidden", "devices"]
+            if shards > 1:
+                fields.append("shard")
             writer = csv.DictWriter(self.stdout, fieldnames=fields)
             writer.writeheader()
             for worker in workers:
-                writer.writerow({
+                row = {
                     "hostname": worker.hostname,
                     "description": worker.description,
                     "master": worker.is_master,
                     "hidden": not worker.display,
-                    "devices": worker.device_set.count()})
+                    "devices": worker.device_set.count()}
+                if shards > 1:
+                    row["shard"] = worker_shard(worker.hostname, shards)
+                writer.writerow(row)
         else:
             self.stdout.write("Workers:")
             for worker in workers:
                 string = "* %s (%d devices)"
                 if worker.is_master:
                     string += " (master)"
-                self.stdout.write(string % (worker.hostname, worker.device_set.count()))
+                string = string % (worker.hostname, worker.device_set.count())
+                if shards > 1:
+                    shard = worker_shard(worker.hostname, shards)
+                    string += " (shard %d: master port %d, log port %d)" % (
+                        (shard, ) + shard_ports(shard))
+                self.stdout.write(string)
 
     def handle_set(self, hostname, description, display):
         """ Set worker properties """
@@ -156,3 +156,22 @@ ALLOWED_HOSTS = ['*']
 
 # this is a tad ugly but the upstream package still needs something here.
 KEY_VALUE_STORE_BACKEND = 'db://lava_scheduler_app_devicedictionarytable'
+
+# The chart data is kept in the "results" cache, see
+# lava_results_app.models.ChartQuery.get_data. The keys change with the
+# results, each web server process can use its own local memory cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'lava-results',
+        'TIMEOUT': 600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
+# When set, the V1 bundles uploaded with dashboard.put, put_ex and put_group
+# are stored compressed and imported later by the bundle-import command.
+BUNDLE_IMPORT_ASYNC = False
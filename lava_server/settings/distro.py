@@ -253,6 +253,13 @@ INTERNAL_EVENT_SOCKET = distro_settings.get_setting("INTERNAL_EVENT_SOCKET", INT
 EVENT_SOCKET = distro_settings.get_setting("EVENT_SOCKET", EVENT_SOCKET)
 EVENT_ADDITIONAL_SOCKETS = distro_settings.get_setting("EVENT_ADDITIONAL_SOCKETS", EVENT_ADDITIONAL_SOCKETS)
 EVENT_TOPIC = distro_settings.get_setting("EVENT_TOPIC", EVENT_TOPIC)
+EVENT_STREAM_URL = distro_settings.get_setting("EVENT_STREAM_URL", EVENT_STREAM_URL)
+
+# Override the caches, e.g. to share the results cache between the processes
+CACHES.update(distro_settings.get_setting("CACHES", {}))
+
+# Import the V1 bundles with the bundle-import command instead of during the upload
+BUNDLE_IMPORT_ASYNC = distro_settings.get_setting("BUNDLE_IMPORT_ASYNC", BUNDLE_IMPORT_ASYNC)
 
 
 def set_timeout(connection, **kw):
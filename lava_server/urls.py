@@ -23,6 +23,7 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from linaro_django_xmlrpc import urls as api_urls
 from linaro_django_xmlrpc.views import handler as linaro_django_xmlrpc_views_handler
+from linaro_django_xmlrpc.views import rpc_handler as linaro_django_xmlrpc_views_rpc_handler
 from linaro_django_xmlrpc.views import help as linaro_django_xmlrpc_views_help
 from django.views.i18n import javascript_catalog
 
@@ -67,6 +68,12 @@ urlpatterns = [
     url(r'^admin/jsi18n', javascript_catalog),
     url(r'^{mount_point}admin/'.format(mount_point=settings.MOUNT_POINT),
         include(admin.site.urls)),
+    url(r'^{mount_point}RPC2/json/?$'.format(mount_point=settings.MOUNT_POINT),
+        linaro_django_xmlrpc_views_rpc_handler,
+        name='lava.api_rpc_handler',
+        kwargs={
+            'mapper': mapper,
+            'help_view': 'lava.api_help'}),
     url(r'^{mount_point}RPC2/?'.format(mount_point=settings.MOUNT_POINT),
         linaro_django_xmlrpc_views_handler,
         name='lava.api_handler',
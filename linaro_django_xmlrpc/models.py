@@ -20,14 +20,34 @@
 Empty module for Django to pick up this package as Django application
 """
 
+import base64
+import datetime
+import hashlib
 import inspect
+import json
 import logging
 import random
+import threading
+import time
 import xmlrpclib
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import DatabaseError, connection, models
+from django.db.models import Case, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The secrets are kept in memory for TOKEN_CACHE_TTL seconds, so a token
+# deleted by another process is refused after at most this delay.
+TOKEN_CACHE_TTL = 30
+# last_used_on is written in batches, at most once per interval and token.
+TOKEN_LAST_USED_INTERVAL = 60
+
 
 def _make_secret():
     """
@@ -82,18 +102,115 @@ class AuthToken(models.Model):
         """
         Lookup an user for this secret, returns None on failure.
 
-        This also bumps last_used_on if successful
+        This also bumps last_used_on if successful, see AuthTokenCache.
         """
-        try:
-            token = cls.objects.get(secret=secret)
-        except cls.DoesNotExist:
+        user = None
+        cached = TOKEN_CACHE.get(secret)
+        if cached is None:
+            try:
+                token = cls.objects.select_related('user').get(secret=secret)
+            except cls.DoesNotExist:
+                return None
+            user = token.user
+            cached = TOKEN_CACHE.set(secret, token)
+        (token_id, user_id, token_username) = cached
+        if token_username != username:
+            return None  # bad username for this secret
+        if user is None:
+            try:
+                user = User.objects.get(pk=user_id)
+            except User.DoesNotExist:
+                TOKEN_CACHE.invalidate(secret)
+                return None
+        TOKEN_CACHE.used(token_id)
+        return user
+
+
+class AuthTokenCache(object):
+    """
+    Tokens recently used by this process.
+
+    The secrets are indexed by their hash and expire after TOKEN_CACHE_TTL
+    seconds. The last uses are only recorded in memory and written by a
+    background thread every TOKEN_LAST_USED_INTERVAL seconds, with a single
+    query, so that authenticating a call does not write to the database.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.last_used = {}
+        self.thread = None
+
+    @staticmethod
+    def key(secret):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        return hashlib.sha256(secret).hexdigest()
+
+    def get(self, secret):
+        """
+        Return (token_id, user_id, username) or None if unknown or expired
+        """
+        with self.lock:
+            entry = self.tokens.get(self.key(secret))
+        if entry is None or entry[3] < time.time():
             return None
-        else:
-            if token.user.username != username:
-                return None  # bad username for this secret
-            token.last_used_on = timezone.now()
-            token.save()
-            return token.user
+        return entry[:3]
+
+    def set(self, secret, token):
+        entry = (token.id, token.user_id, token.user.username,
+                 time.time() + TOKEN_CACHE_TTL)
+        with self.lock:
+            self.tokens[self.key(secret)] = entry
+        return entry[:3]
+
+    def invalidate(self, secret):
+        with self.lock:
+            self.tokens.pop(self.key(secret), None)
+
+    def used(self, token_id):
+        with self.lock:
+            self.last_used[token_id] = timezone.now()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="auth-token-last-used")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def flush(self):
+        """
+        Write the pending last uses in one query
+        """
+        with self.lock:
+            (last_used, self.last_used) = (self.last_used, {})
+        if not last_used:
+            return
+        # Bypass save(): created_on is an auto_now field
+        AuthToken.objects.filter(id__in=last_used.keys()).update(
+            last_used_on=Case(*[When(id=token_id, then=Value(used_on))
+                                for (token_id, used_on) in last_used.items()],
+                              output_field=models.DateTimeField()))
+
+    def run(self):
+        logger = logging.getLogger('linaro-django-xmlrpc')
+        while True:
+            time.sleep(TOKEN_LAST_USED_INTERVAL)
+            try:
+                self.flush()
+            except DatabaseError as exc:
+                logger.error("Unable to update the tokens last use: %s", exc)
+            finally:
+                connection.close()
+
+
+TOKEN_CACHE = AuthTokenCache()
+
+
+@receiver(post_save, sender=AuthToken, dispatch_uid="invalidate_auth_token")
+@receiver(post_delete, sender=AuthToken, dispatch_uid="invalidate_auth_token")
+def invalidate_auth_token(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    TOKEN_CACHE.invalidate(instance.secret)
 
 
 def xml_rpc_signature(*sig):
@@ -117,6 +234,23 @@ def xml_rpc_signature(*sig):
     return decorator
 
 
+def xml_rpc_bulk(bulk_name):
+    """
+    Small helper that attaches "xml_rpc_bulk" attribute to the function.
+    The attribute is the name of a method of the same API that
+    system.multicall calls, once, for a run of calls to the decorated
+    function.
+
+    The bulk method takes the list of the arguments of each call and
+    returns a list with the return value or the xmlrpclib.Fault of each
+    call, in the same order.
+    """
+    def decorator(func):
+        func.xml_rpc_bulk = bulk_name
+        return func
+    return decorator
+
+
 class FaultCodes(object):
     """
     Common fault codes.
@@ -448,17 +582,63 @@ class Dispatcher(object):
             # Forward XML-RPC Faults to the client
             raise
         except Exception as exc:
-            # Call a helper than can do more
-            if self.handle_internal_error(method_name, params) is None:
-                # If there is no better handler we should log the problem
-                self.logger.error(
-                    "Internal error in the XML-RPC dispatcher while calling method %r with %r",
-                    method_name, params, exc_info=True,
-                    extra={'request': context.request})
-            # TODO: figure out a way to get the error id from Raven if that is around
-            raise xmlrpclib.Fault(
-                FaultCodes.ServerError.INTERNAL_XML_RPC_ERROR,
-                "Internal Server Error (contact server administrator for details): %s" % exc)
+            raise self._internal_error(method_name, params, context, exc)
+
+    def dispatch_bulk(self, method_name, params_list, context):
+        """
+        Dispatch a run of calls to the same method, with the specified list
+        of parameters and context.
+
+        The calls with the expected number of arguments are handled by one
+        call to the bulk implementation of the method, if any (see
+        xml_rpc_bulk). Returns the list of the return value or the
+        xmlrpclib.Fault of each call.
+        """
+        results = [None] * len(params_list)
+        batch = []
+        impl = self.mapper.lookup(method_name, context)
+        bulk = getattr(impl, 'xml_rpc_bulk', None)
+        if bulk is not None:
+            arity = len(inspect.getargspec(impl).args) - 1
+            batch = [index for (index, params) in enumerate(params_list)
+                     if len(params) == arity]
+        if len(batch) > 1:
+            bulk_params = [params_list[index] for index in batch]
+            try:
+                bulk_results = getattr(impl.__self__, bulk)(bulk_params)
+            except xmlrpclib.Fault as fault:
+                bulk_results = [fault] * len(batch)
+            except Exception as exc:
+                bulk_results = [self._internal_error(method_name, bulk_params, context, exc)] * len(batch)
+            for (index, result) in zip(batch, bulk_results):
+                results[index] = result
+        else:
+            batch = []
+        batch = set(batch)
+        for (index, params) in enumerate(params_list):
+            if index in batch:
+                continue
+            try:
+                results[index] = self.dispatch(method_name, params, context)
+            except xmlrpclib.Fault as fault:
+                results[index] = fault
+        return results
+
+    def _internal_error(self, method_name, params, context, exc):
+        """
+        Log an unexpected exception and return the Fault for the client
+        """
+        # Call a helper than can do more
+        if self.handle_internal_error(method_name, params) is None:
+            # If there is no better handler we should log the problem
+            self.logger.error(
+                "Internal error in the XML-RPC dispatcher while calling method %r with %r",
+                method_name, params, exc_info=True,
+                extra={'request': context.request})
+        # TODO: figure out a way to get the error id from Raven if that is around
+        return xmlrpclib.Fault(
+            FaultCodes.ServerError.INTERNAL_XML_RPC_ERROR,
+            "Internal Server Error (contact server administrator for details): %s" % exc)
 
     def handle_internal_error(self, method_name, params):
         """
@@ -471,6 +651,160 @@ class Dispatcher(object):
         return None
 
 
+def _rpc_default(obj, binary):
+    """
+    Convert the values that xmlrpclib knows how to marshal but json and
+    msgpack do not.
+    """
+    if isinstance(obj, xmlrpclib.Binary):
+        return binary(obj.data)
+    if isinstance(obj, xmlrpclib.DateTime):
+        return obj.value
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if hasattr(obj, '__dict__'):
+        # Like xmlrpclib, marshal the instances as structs
+        return vars(obj)
+    raise TypeError("cannot marshal %s objects" % type(obj))
+
+
+class JSONRPCDispatcher(Dispatcher):
+    """
+    JSON-RPC 2.0 dispatcher, using the same Mapper as the XML-RPC one.
+
+    The requests and the responses are encoded in JSON or, when
+    python-msgpack is installed, in msgpack. Binary values are sent as
+    base64 strings in JSON and as raw strings in msgpack, the dates as ISO
+    8601 strings.
+
+    Only positional parameters are supported. The consecutive calls to the
+    same method in a batch are dispatched like in system.multicall.
+    """
+
+    JSON = 'application/json'
+    MSGPACK = 'application/msgpack'
+
+    def content_types(self):
+        if msgpack is None:
+            return [self.JSON]
+        return [self.JSON, self.MSGPACK]
+
+    def decode_request(self, data, content_type=JSON):
+        try:
+            if content_type == self.MSGPACK:
+                return msgpack.unpackb(data)
+            return json.loads(data)
+        except Exception:
+            raise xmlrpclib.Fault(
+                FaultCodes.ParseError.NOT_WELL_FORMED,
+                "Unable to decode request")
+
+    def encode_response(self, response, content_type=JSON):
+        if content_type == self.MSGPACK:
+            return msgpack.packb(response, default=lambda obj: _rpc_default(obj, str))
+        return json.dumps(response, default=lambda obj: _rpc_default(obj, base64.b64encode))
+
+    def marshalled_dispatch(self, data, user=None, request=None, content_type=JSON):
+        """
+        Dispatch a request or a batch of requests, encoded in content_type.
+
+        Returns the text of the response, empty if the requests were only
+        notifications.
+        """
+        response = self.dispatch_request(data, user, request, content_type)
+        if response is None:
+            return ''
+        try:
+            return self.encode_response(response, content_type)
+        except (TypeError, ValueError) as exc:
+            self.logger.error("Unable to encode the JSON-RPC response: %s", exc,
+                              extra={'request': request})
+            return self.encode_response(self._error_response(
+                None, xmlrpclib.Fault(
+                    FaultCodes.ServerError.INTERNAL_XML_RPC_ERROR,
+                    "Internal Server Error (contact server administrator for details): %s" % exc)),
+                content_type)
+
+    def dispatch_request(self, data, user=None, request=None, content_type=JSON):
+        """
+        Dispatch a request or a batch of requests, encoded in content_type.
+
+        Returns the response object or the list of response objects, None if
+        the requests were only notifications.
+        """
+        context = CallContext(
+            user, mapper=self.mapper, dispatcher=self, request=request)
+        try:
+            payload = self.decode_request(data, content_type)
+        except xmlrpclib.Fault as fault:
+            return self._error_response(None, fault)
+        batch = isinstance(payload, list)
+        if not batch:
+            payload = [payload]
+        elif not payload:
+            return self._error_response(None, xmlrpclib.Fault(
+                FaultCodes.ServerError.INVALID_XML_RPC, "Empty batch"))
+        calls = [self._parse_one(call) for call in payload]
+
+        responses = []
+        index = 0
+        while index < len(calls):
+            (call_id, method_name, params) = calls[index]
+            if isinstance(params, xmlrpclib.Fault):
+                results = [params]
+                end = index + 1
+            else:
+                # dispatch the run of calls to the same method at once
+                end = index + 1
+                while end < len(calls) and calls[end][1] == method_name \
+                        and not isinstance(calls[end][2], xmlrpclib.Fault):
+                    end += 1
+                results = self.dispatch_bulk(
+                    method_name, [call[2] for call in calls[index:end]], context)
+            for (call, result) in zip(calls[index:end], results):
+                if call[0] is _NOTIFICATION:
+                    continue
+                if isinstance(result, xmlrpclib.Fault):
+                    responses.append(self._error_response(call[0], result))
+                else:
+                    responses.append({'jsonrpc': '2.0', 'id': call[0], 'result': result})
+            index = end
+
+        if not responses:
+            return None
+        return responses if batch else responses[0]
+
+    def _parse_one(self, call):  # pylint: disable=no-self-use
+        """
+        Check one JSON-RPC request, returns (id, method, params) where params
+        is a Fault for invalid requests
+        """
+        if not isinstance(call, dict) or call.get('jsonrpc') != '2.0':
+            return (None, None, xmlrpclib.Fault(
+                FaultCodes.ServerError.INVALID_XML_RPC,
+                "Invalid JSON-RPC 2.0 request"))
+        call_id = call.get('id', _NOTIFICATION)
+        method_name = call.get('method')
+        if not isinstance(method_name, basestring):
+            return (call_id, None, xmlrpclib.Fault(
+                FaultCodes.ServerError.INVALID_XML_RPC,
+                "method must be a string"))
+        params = call.get('params', [])
+        if not isinstance(params, list):
+            return (call_id, method_name, xmlrpclib.Fault(
+                FaultCodes.ServerError.INVALID_METHOD_PARAMETERS,
+                "params must be an array"))
+        return (call_id, method_name, params)
+
+    def _error_response(self, call_id, fault):  # pylint: disable=no-self-use
+        return {'jsonrpc': '2.0', 'id': call_id,
+                'error': {'code': fault.faultCode, 'message': fault.faultString}}
+
+
+# id of the JSON-RPC requests without id, which do not get a response
+_NOTIFICATION = object()
+
+
 class SystemAPI(ExposedAPI):
     """
     XML-RPC System API
@@ -559,9 +893,9 @@ class SystemAPI(ExposedAPI):
             import pydoc
             return pydoc.getdoc(impl)
 
-    def _multicall_dispatch_one(self, subcall):
+    def _multicall_parse_one(self, subcall):
         """
-        Dispatch one multicall request
+        Check one multicall request, returns (methodName, params) or a Fault
         """
         if not isinstance(subcall, dict):
             return xmlrpclib.Fault(
@@ -590,11 +924,7 @@ class SystemAPI(ExposedAPI):
                 FaultCodes.ServerError.INVALID_METHOD_PARAMETERS,
                 "system.multicall specified additional arguments %s" %
                 sorted(subcall.keys()))
-        try:
-            return self._context.dispatcher.dispatch(
-                methodName, params, self._context)
-        except xmlrpclib.Fault as fault:
-            return fault
+        return (methodName, params)
 
     @xml_rpc_signature('array', 'array')
     def multicall(self, subcalls):
@@ -609,7 +939,10 @@ class SystemAPI(ExposedAPI):
         Params must be an XML-RPC array of arguments for that method.
 
         All methods will be executed in order, failure of any method does not
-        prevent other methods from executing.
+        prevent other methods from executing. Consecutive calls to the same
+        method are handled at once by the methods supporting it, for
+        instance to check the permissions of all the calls with a few
+        database queries.
 
         The return value is an XML-RPC array of the same length as the lenght
         of the subcalls array. Each element of the result array holds either an
@@ -620,18 +953,34 @@ class SystemAPI(ExposedAPI):
             raise xmlrpclib.Fault(
                 FaultCodes.ServerError.INVALID_METHOD_PARAMETERS,
                 "system.multicall expected a list of methods to call")
+        calls = [self._multicall_parse_one(subcall) for subcall in subcalls]
         results = []
-        for subcall in subcalls:
-            result = self._multicall_dispatch_one(subcall)
-            if isinstance(result, xmlrpclib.Fault):
-                # Faults are returned directly
-                results.append(result)
+        index = 0
+        while index < len(calls):
+            if isinstance(calls[index], xmlrpclib.Fault):
+                run = [calls[index]]
+                index += 1
             else:
-                # We need to box each return value  in a list to distinguish
-                # them from faults which will be encoded as XML-RPC structs and
-                # might be indistinguishable from successul calls returning an
-                # XML-RCP struct.
-                results.append([result])
+                # dispatch the run of calls to the same method at once
+                methodName = calls[index][0]
+                end = index + 1
+                while end < len(calls) and not isinstance(calls[end], xmlrpclib.Fault) \
+                        and calls[end][0] == methodName:
+                    end += 1
+                run = self._context.dispatcher.dispatch_bulk(
+                    methodName, [params for (_, params) in calls[index:end]],
+                    self._context)
+                index = end
+            for result in run:
+                if isinstance(result, xmlrpclib.Fault):
+                    # Faults are returned directly
+                    results.append(result)
+                else:
+                    # We need to box each return value  in a list to distinguish
+                    # them from faults which will be encoded as XML-RPC structs and
+                    # might be indistinguishable from successul calls returning an
+                    # XML-RCP struct.
+                    results.append([result])
         return results
 
     def getCapabilities(self):
@@ -20,6 +20,7 @@
 Unit tests for Linaro Django XML-RPC Application
 """
 import re
+import json
 import logging
 import xmlrpclib
 
@@ -30,11 +31,14 @@ from django_testscenarios.ubertest import TestCase, TestCaseWithScenarios
 from linaro_django_xmlrpc.models import (
     AuthToken,
     CallContext,
+    TOKEN_CACHE,
     Dispatcher,
     ExposedAPI,
     FaultCodes,
+    JSONRPCDispatcher,
     Mapper,
     SystemAPI,
+    xml_rpc_bulk,
     xml_rpc_signature,
 )
 
@@ -331,6 +335,59 @@ class DispatcherTests(TestCase):
                           self.xml_rpc_call, "boom", 1, "str")
 
 
+class JSONRPCDispatcherTests(TestCase):
+
+    def setUp(self):
+        super(JSONRPCDispatcherTests, self).setUp()
+        self.mapper = Mapper()
+        self.mapper.register(TestAPI, '')
+        self.dispatcher = JSONRPCDispatcher(self.mapper)
+        self.dispatcher.handle_internal_error = lambda method, args: True
+
+    def json_rpc_call(self, request):
+        return json.loads(self.dispatcher.marshalled_dispatch(json.dumps(request)))
+
+    def test_call(self):
+        self.assertEqual(
+            self.json_rpc_call({"jsonrpc": "2.0", "id": 1, "method": "echo", "params": ["string"]}),
+            {"jsonrpc": "2.0", "id": 1, "result": "string"})
+
+    def test_faults(self):
+        response = self.json_rpc_call({"jsonrpc": "2.0", "id": 1, "method": "boom", "params": [1, "str"]})
+        self.assertEqual(response["error"], {"code": 1, "message": "str"})
+        response = self.json_rpc_call({"jsonrpc": "2.0", "id": 2, "method": "internal_boom"})
+        self.assertEqual(response["error"]["code"], FaultCodes.ServerError.INTERNAL_XML_RPC_ERROR)
+        response = self.json_rpc_call({"jsonrpc": "2.0", "id": 3, "method": "method_that_does_not_exist"})
+        self.assertEqual(response["error"]["code"], FaultCodes.ServerError.REQUESTED_METHOD_NOT_FOUND)
+        response = self.json_rpc_call({"id": 4, "method": "ping"})
+        self.assertEqual(response["error"]["code"], FaultCodes.ServerError.INVALID_XML_RPC)
+        response = json.loads(self.dispatcher.marshalled_dispatch("{"))
+        self.assertEqual(response["error"]["code"], FaultCodes.ParseError.NOT_WELL_FORMED)
+
+    def test_batch(self):
+        response = self.json_rpc_call([
+            {"jsonrpc": "2.0", "id": 1, "method": "ping"},
+            {"jsonrpc": "2.0", "method": "ping"},
+            {"jsonrpc": "2.0", "id": 2, "method": "echo", "params": [1.5]},
+            {"jsonrpc": "2.0", "id": 3, "method": "boom", "params": [1, "str"]},
+        ])
+        # no response for the notification
+        self.assertEqual([item["id"] for item in response], [1, 2, 3])
+        self.assertEqual(response[0]["result"], "pong")
+        self.assertEqual(response[1]["result"], 1.5)
+        self.assertEqual(response[2]["error"]["code"], 1)
+        self.assertEqual(self.dispatcher.marshalled_dispatch(
+            json.dumps({"jsonrpc": "2.0", "method": "ping"})), "")
+
+    def test_binary_and_dates(self):
+        response = self.json_rpc_call({"jsonrpc": "2.0", "id": 1, "method": "echo",
+                                       "params": [None]})
+        self.assertEqual(response["result"], None)
+        data = self.dispatcher.encode_response(
+            {"result": [xmlrpclib.Binary("data"), xmlrpclib.DateTime("20170101T10:00:00")]})
+        self.assertEqual(json.loads(data), {"result": ["ZGF0YQ==", "20170101T10:00:00"]})
+
+
 class SystemAPITest(TestCase):
 
     def setUp(self):
@@ -473,6 +530,39 @@ class SystemAPITest(TestCase):
         # echo is called with 'after'
         self.assertEqual(observed[2], ["after"])
 
+    def test_multicall_calls_bulk_methods(self):
+        class TestAPI(ExposedAPI):
+
+            bulk_calls = []
+
+            @xml_rpc_bulk('_echo_bulk')
+            def echo(self, arg):
+                return arg
+
+            def _echo_bulk(self, calls):
+                TestAPI.bulk_calls.append(calls)
+                return [arg if arg != "boom" else xmlrpclib.Fault(1, "boom")
+                        for (arg,) in calls]
+        self.mapper.register(TestAPI)
+        calls = [
+            {"methodName": "TestAPI.echo", "params": ["a"]},
+            {"methodName": "TestAPI.echo", "params": ["boom"]},
+            {"methodName": "TestAPI.echo", "params": ["b", "extra"]},
+            {"methodName": "TestAPI.echo", "params": ["c"]},
+            {"methodName": "system.listMethods"},
+            {"methodName": "TestAPI.echo", "params": ["d"]},
+        ]
+        observed = self.system_api.multicall(calls)
+        # one bulk call for the run of valid calls, the single call is
+        # dispatched as usual
+        self.assertEqual(TestAPI.bulk_calls, [[["a"], ["boom"], ["c"]]])
+        self.assertEqual(observed[0], ["a"])
+        self.assertEqual(observed[1].faultString, "boom")
+        self.assertEqual(observed[2].faultCode, FaultCodes.ServerError.INTERNAL_XML_RPC_ERROR)
+        self.assertEqual(observed[3], ["c"])
+        self.assertEqual(observed[4].faultCode, FaultCodes.ServerError.INVALID_METHOD_PARAMETERS)
+        self.assertEqual(observed[5], ["d"])
+
     def test_multicall_wants_a_list_of_sub_calls(self):
         # XXX: Use TestCaseWithInvariants in the future
         for bad_stuff in [None, {}, True, False, -1, 10000, "foobar"]:
@@ -606,6 +696,31 @@ class HandlerAuthTests(TestCaseWithScenarios):
         self.assertContains(response, text=self.text, status_code=self.status_code)
 
 
+class RPCHandlerTests(TestCase):
+
+    def setUp(self):
+        super(RPCHandlerTests, self).setUp()
+        self.url = reverse("linaro_django_xmlrpc.views.default_rpc_handler")
+
+    def test_json_call(self):
+        response = self.client.post(
+            self.url, content_type="application/json",
+            data=json.dumps({"jsonrpc": "2.0", "id": 1, "method": "system.listMethods"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("system.listMethods", json.loads(response.content)["result"])
+
+    def test_unsupported_content_type(self):
+        response = self.client.post(self.url, content_type="text/xml", data="<xml/>")
+        self.assertEqual(response.status_code, 415)
+
+    def test_gzip(self):
+        response = self.client.post(
+            self.url, content_type="application/json", HTTP_ACCEPT_ENCODING="gzip",
+            data=json.dumps({"jsonrpc": "2.0", "id": 1, "method": "system.listMethods"}))
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+
 class AuthTokenTests(TestCase):
 
     _USER = "user"
@@ -653,6 +768,28 @@ class AuthTokenTests(TestCase):
     def test_get_user_for_secret_sets_last_used_on(self):
         token = AuthToken.objects.create(user=self.user)
         AuthToken.get_user_for_secret(self.user.username, token.secret)
+        # The last use is written in the background
+        TOKEN_CACHE.flush()
         # Refresh token
         token = AuthToken.objects.get(id=token.id, user=self.user)
         self.assertNotEqual(token.last_used_on, None)
+
+    def test_get_user_for_secret_is_cached(self):
+        token = AuthToken.objects.create(user=self.user)
+        self.assertEqual(AuthToken.get_user_for_secret(self.user.username, token.secret), self.user)
+        # Only the user is loaded, no write
+        with self.assertNumQueries(1):
+            self.assertEqual(AuthToken.get_user_for_secret(self.user.username, token.secret), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(AuthToken.get_user_for_secret(self._INEXISTING_USER, token.secret), None)
+        with self.assertNumQueries(1):
+            TOKEN_CACHE.flush()
+        self.assertNotEqual(AuthToken.objects.get(id=token.id).last_used_on, None)
+
+    def test_deleted_token_is_not_cached(self):
+        token = AuthToken.objects.create(user=self.user)
+        secret = token.secret
+        self.assertEqual(AuthToken.get_user_for_secret(self.user.username, secret), self.user)
+        token.delete()
+        self.assertEqual(AuthToken.get_user_for_secret(self.user.username, secret), None)
+        TOKEN_CACHE.flush()
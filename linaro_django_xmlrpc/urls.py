@@ -22,7 +22,7 @@ from django.conf.urls import url
 from linaro_django_xmlrpc.globals import mapper
 from linaro_django_xmlrpc.views import (
     handler, create_token, delete_token,
-    delete_unused_tokens, edit_token, tokens,
+    delete_unused_tokens, edit_token, rpc_handler, tokens,
 )
 
 
@@ -34,6 +34,12 @@ default_mapper_urlpatterns = [
         }),
     url(r'^RPC2/$', handler,
         name='linaro_django_xmlrpc.views.default_handler',
+        kwargs={
+            'mapper': mapper,
+            'help_view': 'linaro_django_xmlrpc.views.default_help'
+        }),
+    url(r'^RPC2/json/$', rpc_handler,
+        name='linaro_django_xmlrpc.views.default_rpc_handler',
         kwargs={
             'mapper': mapper,
             'help_view': 'linaro_django_xmlrpc.views.default_help'
@@ -21,25 +21,64 @@ XML-RPC views
 """
 
 import base64
+import xmlrpclib
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, loader, get_object_or_404, redirect
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
 
 from linaro_django_xmlrpc.models import (
     AuthToken,
     CallContext,
     Dispatcher,
+    JSONRPCDispatcher,
     SystemAPI,
 )
 from linaro_django_xmlrpc.forms import AuthTokenForm
 
+# Size of the chunks of the streamed binary results
+BINARY_CHUNK = 65536
+
+
+def _authenticate(request):  # pylint: disable=too-many-return-statements
+    """
+    Authenticate the request with the user and token in the
+    HTTP_AUTHORIZATION header, or with the session.
+
+    Returns (user, None) or (None, error response)
+    """
+    auth_string = request.META.get('HTTP_AUTHORIZATION')
+    if auth_string is None:
+        return (request.user, None)
+    if ' ' not in auth_string:
+        return (None, HttpResponse("Invalid HTTP_AUTHORIZATION header", status=400))
+    scheme, value = auth_string.split(" ", 1)
+    if scheme != "Basic":
+        return (None, HttpResponse(
+            "Unsupported HTTP_AUTHORIZATION header, only Basic scheme is supported", status=400))
+    try:
+        decoded_value = base64.standard_b64decode(value)
+    except TypeError:
+        return (None, HttpResponse("Corrupted HTTP_AUTHORIZATION header, bad base64 encoding", status=400))
+    try:
+        username, secret = decoded_value.split(":", 1)
+    except ValueError:
+        return (None, HttpResponse("Corrupted HTTP_AUTHORIZATION header, no user:pass", status=400))
+    user = AuthToken.get_user_for_secret(username, secret)
+    if user is None:
+        response = HttpResponse("Invalid token", status=401)
+        response['WWW-Authenticate'] = 'Basic realm="XML-RPC Authentication token"'
+        return (None, response)
+    return (user, None)
+
 
 @csrf_exempt
-def handler(request, mapper, help_view):  # pylint: disable=too-many-return-statements
+@gzip_page
+def handler(request, mapper, help_view):
     """
     XML-RPC handler.
 
@@ -54,31 +93,9 @@ def handler(request, mapper, help_view):  # pylint: disable=too-many-return-stat
     if len(request.body):
         raw_data = request.body
         dispatcher = Dispatcher(mapper)
-
-        auth_string = request.META.get('HTTP_AUTHORIZATION')
-
-        if auth_string is not None:
-            if ' ' not in auth_string:
-                return HttpResponse("Invalid HTTP_AUTHORIZATION header", status=400)
-            scheme, value = auth_string.split(" ", 1)
-            if scheme != "Basic":
-                return HttpResponse(
-                    "Unsupported HTTP_AUTHORIZATION header, only Basic scheme is supported", status=400)
-            try:
-                decoded_value = base64.standard_b64decode(value)
-            except TypeError:
-                return HttpResponse("Corrupted HTTP_AUTHORIZATION header, bad base64 encoding", status=400)
-            try:
-                username, secret = decoded_value.split(":", 1)
-            except ValueError:
-                return HttpResponse("Corrupted HTTP_AUTHORIZATION header, no user:pass", status=400)
-            user = AuthToken.get_user_for_secret(username, secret)
-            if user is None:
-                response = HttpResponse("Invalid token", status=401)
-                response['WWW-Authenticate'] = 'Basic realm="XML-RPC Authentication token"'
-                return response
-        else:
-            user = request.user
+        user, error = _authenticate(request)
+        if error is not None:
+            return error
         result = dispatcher.marshalled_dispatch(raw_data, user, request)
         response = HttpResponse(content_type="application/xml")
         response.write(result)
@@ -88,6 +105,45 @@ def handler(request, mapper, help_view):  # pylint: disable=too-many-return-stat
         return redirect(help_view)
 
 
+@csrf_exempt
+@gzip_page
+def rpc_handler(request, mapper, help_view):
+    """
+    JSON-RPC 2.0 handler, for the methods of the XML-RPC mapper.
+
+    The requests are encoded in JSON or in msgpack, according to the
+    Content-Type header, and the response uses the same encoding. The
+    responses are compressed when the client accepts gzip.
+
+    A single call returning a binary value is answered with the raw value
+    when the client accepts application/octet-stream.
+    """
+    if not len(request.body):
+        return redirect(help_view)
+    dispatcher = JSONRPCDispatcher(mapper)
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip() or dispatcher.JSON
+    if content_type not in dispatcher.content_types():
+        return HttpResponse("Unsupported Content-Type, use one of %s" % ", ".join(dispatcher.content_types()),
+                            status=415)
+    user, error = _authenticate(request)
+    if error is not None:
+        return error
+
+    if 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = dispatcher.dispatch_request(request.body, user, request, content_type)
+        if isinstance(response, dict) and isinstance(response.get('result'), xmlrpclib.Binary):
+            data = response['result'].data
+            return StreamingHttpResponse(
+                (data[offset:offset + BINARY_CHUNK] for offset in xrange(0, len(data), BINARY_CHUNK)),
+                content_type='application/octet-stream')
+        result = '' if response is None else dispatcher.encode_response(response, content_type)
+    else:
+        result = dispatcher.marshalled_dispatch(request.body, user, request, content_type)
+    response = HttpResponse(result, content_type=content_type)
+    response['Content-length'] = str(len(response.content))
+    return response
+
+
 def help(request, mapper, template_name="linaro_django_xmlrpc/api.html"):  # pylint: disable=redefined-builtin
     context = CallContext(
         user=None, mapper=mapper, dispatcher=None, request=request)
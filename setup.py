@@ -112,6 +112,8 @@ setup(
          ['etc/lava-server.conf']),
         ('/etc/logrotate.d',
          ['etc/logrotate.d/django-log',
+          'etc/logrotate.d/lava-bundle-import-log',
+          'etc/logrotate.d/lava-event-stream-log',
           'etc/logrotate.d/lava-master-log',
           'etc/logrotate.d/lava-publisher-log',
           'etc/logrotate.d/lava-scheduler-log',
@@ -120,6 +122,7 @@ setup(
          ['instance.template']),
         ('/usr/share/lava-server',
          ['share/add_device.py',
+          'etc/lava-bundle-import.service',
           'etc/lava-master.service',
           'share/render-template.py']),
     ].extend(DEVICE_TYPE_TEMPLATES),